@@ -0,0 +1,573 @@
+# async_core.py
+r'''
+Asyncio variant of NanonisController.
+
+AsyncNanonisController exposes the command surface of NanonisController as
+coroutines on top of asyncio streams. Requests of concurrent coroutines go
+through one queue: every request is written as soon as it is made, and a
+single reader task hands the responses back in order. Many coroutines can
+therefore share the connection, and their requests are pipelined.
+
+    async def main():
+        async with AsyncNanonisController('127.0.0.1', 6501) as nanonis:
+            freq, current = await asyncio.gather(
+                nanonis.run(CheckFrequencyShift), nanonis.CurrentGet())
+
+The existing Operate subclasses are synchronous. They run in a worker thread
+on a blocking view of the controller (see blocking() and Operate.async_do).
+The deadline of the operation (see deadline.py) bounds every blocking call
+and is current in the coroutine serving it.
+'''
+
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import time
+
+from core import ExceptionType, NanonisController, decode_frame_data, decode_signal_names, stack_frames
+from waiter import Waiter
+from signal_registry import DEFAULT_CACHE_DIR, DEFAULT_TTL, SignalRegistry
+from param_cache import ParameterCache
+from scan_stream import ScanStream
+from interface import BatchResult, Cancelled, construct_command, current_deadline, from_binary, get_codec, \
+    nanonisException, nanonis_programming_interface, set_deadline
+
+
+async def _under(deadline, coroutine):
+    # the task has its own context, the deadline does not leak to other coroutines
+    set_deadline(deadline)
+    return await coroutine
+
+
+def wait_threadsafe(coroutine, loop, name):
+    r'''
+    Run coroutine on loop from another thread and wait for its result, under the deadline of the
+    calling thread: the coroutine is cancelled and Cancelled raised when the deadline passes.
+    '''
+    deadline = current_deadline()
+    if deadline is None:
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+    try:
+        deadline.check(name)
+    except Cancelled:
+        coroutine.close()
+        raise
+    future = asyncio.run_coroutine_threadsafe(_under(deadline, coroutine), loop)
+    while True:
+        try:
+            # in slices, so that cancel() from another thread is seen
+            return future.result(deadline.limit(0.1))
+        except concurrent.futures.TimeoutError:
+            if deadline.expired:
+                future.cancel()
+                deadline.check(name)
+
+
+class AsyncNanonisController:
+
+    r'''
+    Args:
+        IP : str
+        PORT : int
+        max_in_flight : int
+            Maximum number of requests written but not answered yet.
+    '''
+
+    def __init__(self, IP='127.0.0.1', PORT=6501, max_in_flight=64, signal_ttl=DEFAULT_TTL,
+                 signal_cache_dir=DEFAULT_CACHE_DIR, param_ttls=None):
+        self.address = (IP, PORT)
+        self.max_in_flight = max_in_flight
+        self._reader = None
+        self._writer = None
+        self._pending = collections.deque()
+        self._slots = None
+        self._reader_task = None
+        self._loop = None
+        self.waiter = Waiter()
+        # filled with update() here, the registry cannot fetch over the async connection itself
+        self.signals = SignalRegistry(None, IP, signal_ttl, signal_cache_dir, PORT)
+        self.params = ParameterCache(param_ttls)
+
+        self.BiasLimit = 10
+        self.XScannerLimit = 1e-6
+        self.YScannerLimit = 1e-6
+        self.ZScannerLimit = 1e-7
+        self.LowerSetpointLimit = 0
+        self.UpperSetpointLimit = 1e-3
+
+    # helpers without any protocol traffic are shared with the blocking controller
+    convert = nanonis_programming_interface.convert
+    cached = nanonis_programming_interface.cached
+    recorded = nanonis_programming_interface.recorded
+    server_timeout = nanonis_programming_interface.server_timeout
+    telemetry = None
+    profiler = None
+    # no frame archive nor background writer on this controller (see NanonisController)
+    archive = None
+    io = None
+    try_convert = NanonisController.try_convert
+    convert_many = NanonisController.convert_many
+    to_nano = NanonisController.to_nano
+    channel_name_filter = NanonisController.channel_name_filter
+
+    async def connect(self):
+        self._loop = asyncio.get_running_loop()
+        self._reader, self._writer = await asyncio.open_connection(*self.address)
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self._reader_task = asyncio.ensure_future(self._read_responses())
+        return self
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+            self._writer = None
+        if self.telemetry is not None:
+            self.telemetry.close()
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def _read_responses(self):
+        error = None
+        try:
+            while True:
+                header = await self._reader.readexactly(40)
+                body_size = from_binary('int', header[32:36])
+                body = await self._reader.readexactly(body_size)
+                handler, future = self._pending.popleft()
+                if future.cancelled():
+                    continue
+                try:
+                    future.set_result(handler(header, body))
+                except nanonisException as e:
+                    future.set_exception(e)
+        except asyncio.IncompleteReadError:
+            error = nanonisException('Connection closed by Nanonis')
+        except asyncio.CancelledError:
+            error = nanonisException('Connection closed')
+            raise
+        finally:
+            while self._pending:
+                future = self._pending.popleft()[1]
+                if not future.done():
+                    future.set_exception(error or nanonisException('Connection closed'))
+
+    async def _request(self, message, handler):
+        if self._writer is None:
+            raise nanonisException('Not connected')
+        async with self._slots:
+            future = self._loop.create_future()
+            # Queue and write without awaiting in between, so the order of the
+            # pending queue is the order of the requests on the wire.
+            self._pending.append((handler, future))
+            self._writer.write(message)
+            await self._writer.drain()
+            return await future
+
+    async def send(self, command_name, *vargs):
+        r'''Coroutine version of nanonis_programming_interface.send.'''
+        def handler(header, body):
+            return {'command_name': from_binary('string', header[:32]),
+                    'body_size': len(body),
+                    'body': body}
+        message = construct_command(command_name, *vargs)
+        start = time.perf_counter()
+        try:
+            response = await self._request(message, handler)
+        except Exception as e:
+            self.recorded(command_name, start, len(message), 0, None, e)
+            raise
+        self.cached(command_name, None, None)
+        self.recorded(command_name, start, len(message), response['body_size'] + 40, response)
+        return response
+
+    async def query(self, command_name, *args):
+        r'''Coroutine version of nanonis_programming_interface.query.'''
+        return await self.execute(get_codec(command_name), *args)
+
+    async def execute(self, codec, *args):
+        r'''Coroutine version of nanonis_programming_interface.execute.'''
+        if self.params.cacheable(codec.command_name):
+            hit, value = self.params.lookup(codec.command_name, args)
+            if hit:
+                return value
+        message = codec.encode(*args)
+        start = time.perf_counter()
+        try:
+            value, failed = await self._request(
+                message, lambda header, body: (codec.shape(codec.decode(body)), codec.error_status(body)))
+        except Exception as e:
+            self.recorded(codec.command_name, start, len(message), 0, None, e)
+            raise
+        self.cached(codec.command_name, None if failed else args, value)
+        self.recorded(codec.command_name, start, len(message), codec.unpacker.size + 40, value)
+        return value
+
+    def batch(self):
+        r'''Returns an AsyncCommandBatch, the counterpart of nanonis_programming_interface.batch.'''
+        return AsyncCommandBatch(self)
+
+    # running the synchronous operations
+
+    def blocking(self):
+        r'''
+        Returns a synchronous view of this controller for code running in another thread,
+        e.g. the Operate subclasses. Every coroutine method becomes a blocking call.
+        '''
+        return BlockingController(self)
+
+    async def run(self, operate_class, *args, deadline=None, **kwargs):
+        r'''
+        Construct an Operate subclass on the blocking view and run its do() in a worker thread,
+        under deadline (see Operate.do) if given.
+        '''
+        blocking = self.blocking()
+        return await asyncio.to_thread(lambda: operate_class(blocking, *args, **kwargs).do(deadline=deadline))
+
+    # commands
+
+    async def BiasSet(self, bias):
+        bias_val = self.try_convert(bias)
+        if not -self.BiasLimit <= bias_val <= self.BiasLimit:
+            raise nanonisException('Bias out of bounds')
+        await self.query('Bias.Set', bias_val)
+
+    async def BiasGet(self):
+        return await self.query('Bias.Get')
+
+    async def BiasPulse(self, bais, width=0.1, wait=True):
+        await self.query('Bias.Pulse', int(wait), float(width), float(bais), 0, 0)
+
+    async def TipXYSet(self, X, Y, wait=1):
+        X_val = self.try_convert(X)
+        Y_val = self.try_convert(Y)
+        if not (-self.XScannerLimit <= X_val <= self.XScannerLimit):
+            raise nanonisException('X out of bounds')
+        if not (-self.YScannerLimit <= Y_val <= self.YScannerLimit):
+            raise nanonisException('Y out of bounds')
+        await self.query('FolMe.XYPosSet', X_val, Y_val, wait)
+
+    async def TipXYGet(self, wait=1):
+        return await self.query('FolMe.XYPosGet', wait)
+
+    async def TipZSet(self, Z):
+        Z_val = self.try_convert(Z)
+        if not (-self.ZScannerLimit <= Z_val <= self.ZScannerLimit):
+            raise nanonisException('Z out of bounds')
+        await self.query('ZCtrl.ZPosSet', Z_val)
+
+    async def TipZGet(self):
+        return await self.query('ZCtrl.ZPosGet')
+
+    async def FeedbackOnOffSet(self, feedbackStatus):
+        status = {'on': 1, 'off': 0, 1: 1, 0: 0}.get(
+            feedbackStatus.lower() if type(feedbackStatus) is str else feedbackStatus)
+        if status is None or type(feedbackStatus) not in (str, int):
+            raise nanonisException('Feedback On or Off?')
+        await self.query('ZCtrl.OnOffSet', status)
+
+    async def FeedbackOnOffGet(self):
+        status = await self.query('ZCtrl.OnOffGet')
+        if status == 1:
+            return 'On'
+        elif status == 0:
+            return 'Off'
+        raise nanonisException('Unknown Feedback State')
+
+    async def ZCtrlOnOffGet(self):
+        return await self.query('ZCtrl.OnOffGet')
+
+    async def ZCtrlOnOffSet(self, on=True):
+        await self.query('ZCtrl.OnOffSet', int(on))
+
+    async def Withdraw(self, wait=1, timeout=-1):
+        timeout, deadline = self.server_timeout(timeout)
+        start = time.monotonic()
+        await self.query('ZCtrl.Withdraw', wait, timeout)
+        if deadline is not None and wait and time.monotonic() - start >= timeout / 1000:
+            deadline.cut('ZCtrl.Withdraw')
+
+    async def Home(self):
+        await self.query('ZCtrl.Home')
+
+    async def SetpointSet(self, setpoint):
+        setpoint_val = self.try_convert(setpoint)
+        if not (self.LowerSetpointLimit <= setpoint_val <= self.UpperSetpointLimit):
+            raise nanonisException('Setpoint out of bounds')
+        await self.query('ZCtrl.SetpntSet', setpoint_val)
+
+    async def SetpointGet(self):
+        return await self.query('ZCtrl.SetpntGet')
+
+    async def CurrentGet(self):
+        return await self.query('Current.Get')
+
+    async def MotorMoveSet(self, direction, steps, wait=True):
+        direct_map = {'X+': 0, 'X-': 1, 'Y+': 2, 'Y-': 3, 'Z+': 4, 'Z-': 5}
+        try:
+            direction = direct_map[direction.upper()]
+        except KeyError:
+            raise nanonisException(
+                'Invalid direction. Please use X+, X-, Y+, Y-, Z+, Z- expressions.')
+        if direction == 5:
+            raise nanonisException('Moving Z- is not Safe.')
+        await self.query('Motor.StartMove', direction, steps, 0, int(wait))
+
+    async def AutoApproachOpen(self):
+        await self.query('AutoApproach.Open')
+
+    async def AutoApproachSet(self, on=True):
+        await self.query('AutoApproach.OnOffSet', int(on))
+
+    async def AutoApproachGet(self):
+        return await self.query('AutoApproach.OnOffGet')
+
+    async def ZGainGet(self):
+        return await self.query('ZCtrl.GainGet')
+
+    async def ZGainSet(self, P, T, I):
+        await self.query('ZCtrl.GainSet', self.try_convert(P), self.try_convert(T), self.try_convert(I))
+
+    async def ZGainPSet(self, P):
+        present = await self.ZGainGet()
+        await self.ZGainSet(self.try_convert(P), present.T, present.I)
+
+    async def ZGainTSet(self, T):
+        present = await self.ZGainGet()
+        await self.ZGainSet(present.P, self.try_convert(T), present.I)
+
+    async def ZLimitsGet(self):
+        return await self.query('ZCtrl.LimitsGet')
+
+    async def ZLimitCheck(self):
+        z1, (z_max, z_min) = await asyncio.gather(self.TipZGet(), self.ZLimitsGet())
+        if abs(z_max-z1)/z_max < 0.01:  # if the tip is at the piezo top limit
+            await self.Withdraw()
+            logging.info('Piezo reached the z-high-limit, withdraw')
+            raise nanonisException(
+                'Piezo reached the z-high-limit', ExceptionType.Z_HIGH_LIMIT_REACHED)
+        if abs(z1-z_min/z_min) < 0.01:
+            logging.info('Piezo reached the z-low-limit, need auto approach')
+            raise nanonisException(
+                'Piezo reached the z-low-limit', ExceptionType.Z_LOW_LIMIT_REACHED)
+
+    async def ZLimitCheckWithAction(self):
+        try:
+            await self.ZLimitCheck()
+        except nanonisException as e:
+            if e.code == ExceptionType.Z_HIGH_LIMIT_REACHED:
+                await self.Withdraw()
+                await self.MotorMoveSet('Z+', 1)
+                await self.AutoApproachSet()
+            elif e.code == ExceptionType.Z_LOW_LIMIT_REACHED:
+                await self.Withdraw()
+                await self.AutoApproachSet()
+            else:
+                raise e
+        finally:
+            await self.WaitForZCtrlWork()
+
+    async def PLLOutputSet(self, on=True):
+        await self.query('PLL.OutOnOffSet', 1, int(on))
+
+    async def PLLFreqShiftGet(self):
+        return await self.query('PLL.FreqShiftGet', 1)
+
+    async def PLLAmpCtrlSet(self, on=True):
+        await self.query('PLL.AmpCtrlOnOffSet', 1, int(on))
+
+    async def PLLPhasCtrlSet(self, on=True):
+        await self.query('PLL.PhasCtrlOnOffSet', 1, int(on))
+
+    async def PiezoRangeGet(self):
+        return await self.query('Piezo.RangeGet')
+
+    async def _ensure_signals(self):
+        if self.signals.expired() and not self.signals._load():
+            response = await self.send('Signals.NamesGet')
+            self.signals.fetches += 1
+            self.signals.update(decode_signal_names(response['body']))
+
+    async def SignalsNamesGet(self):
+        await self._ensure_signals()
+        return [name for name in self.signals.names
+                if self.channel_name_filter(name)]
+
+    async def SignalIndexGet(self, name):
+        await self._ensure_signals()
+        return self.signals.index(name)
+
+    async def SignalNameGet(self, index):
+        await self._ensure_signals()
+        return self.signals.name(index)
+
+    async def ScanStart(self, direction='down'):
+        if direction == 'down':
+            d = 0
+        elif direction == 'up':
+            d = 1
+        else:
+            raise nanonisException('Invalid direction. Please use down or up.')
+        await self.query('Scan.Action', 0, d)
+
+    async def ScanStop(self):
+        await self.query('Scan.Action', 1, 0)
+
+    async def ScanPause(self):
+        await self.query('Scan.Action', 2, 0)
+
+    async def ScanResume(self):
+        await self.query('Scan.Action', 3, 0)
+
+    async def ScanStatusGet(self):
+        return await self.query('Scan.StatusGet')
+
+    async def ScanFrameSet(self, center_x, center_y, width, height, angle=0):
+        await self.query('Scan.FrameSet', center_x, center_y, width, height, angle)
+
+    async def ScanFrameData(self, channel_index, data_dir=1, view=False):
+        response = await self.send('Scan.FrameDataGrab', 'uint32', channel_index, 'uint32', data_dir)
+        return decode_frame_data(response['body'], view)
+
+    async def ScanFramesGrab(self, channels, directions=(1, 0)):
+        indices = [await self.SignalIndexGet(c) if type(c) is str else int(c) for c in channels]
+        responses = await asyncio.gather(*(self.send('Scan.FrameDataGrab', 'uint32', index, 'uint32', data_dir)
+                                           for index in indices for data_dir in directions))
+        return stack_frames([r['body'] for r in responses], indices, directions)
+
+    def ScanStream(self, channel_index, data_dir=1, interval=0.2, timeout=None):
+        r'''
+        A ScanStream on the blocking view, for the Operate subclasses running in a worker thread (see run()).
+        It must not be run on the event loop.
+        '''
+        return ScanStream(self.blocking(), channel_index, data_dir, interval, timeout)
+
+    async def WaitEndOfScan(self):
+        timeout, deadline = self.server_timeout(-1)
+        response = await self.send('Scan.WaitEndOfScan', 'int', timeout)
+        if deadline is not None and from_binary('uint32', response['body'][:4]):
+            deadline.cut('Scan.WaitEndOfScan')
+
+    async def isZCtrlWork(self):
+        curr, point = await asyncio.gather(self.CurrentGet(), self.SetpointGet())
+        return (abs(curr)-abs(point))/abs(point) < 0.1
+
+    async def WaitForZCtrlWork(self, timeout=None):
+        await self.waiter.until_async(self.isZCtrlWork, 'Z-controller work', timeout)
+
+    async def WaitForApproach(self, timeout=None):
+        async def finished():
+            return not await self.AutoApproachGet()
+        await self.waiter.until_async(finished, 'auto approach', timeout, initial=0.2, max_interval=2)
+
+    async def WaitForScanEnd(self, timeout=None):
+        async def finished():
+            return not await self.ScanStatusGet()
+        await self.waiter.until_async(finished, 'scan end', timeout, initial=0.1, max_interval=1)
+
+    async def WaitForZSettle(self, max_time, tolerance='10p', window=0.5, name='Z settle'):
+        return await self.waiter.stable_async(self.TipZGet, name, self.try_convert(tolerance), window, timeout=max_time)
+
+    async def TipShaperPropsSet(self, tip_lift='-300p', left_time_1='90m', bias_lift=3, bias_setting_t='90m'):
+        await self.query('TipShaper.PropsSet', 0.05, 0, 0., self.try_convert(tip_lift),
+                         self.try_convert(left_time_1), self.try_convert(bias_lift),
+                         self.try_convert(bias_setting_t), 0., 0.02, 0.1, 0)
+
+
+class AsyncCommandBatch:
+
+    r'''
+    Collects requests like CommandBatch and sends them together on flush.
+
+    It is used with "async with" in coroutines. Code on the blocking view
+    (e.g. MultiPulse) uses a plain "with", which flushes from the worker thread.
+    '''
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.calls = []
+
+    def query(self, command_name, *args):
+        result = BatchResult(command_name)
+        self.calls.append((self.controller.query(command_name, *args), result))
+        return result
+
+    def send(self, command_name, *vargs):
+        result = BatchResult(command_name)
+        self.calls.append((self.controller.send(command_name, *vargs), result))
+        return result
+
+    async def flush(self):
+        calls, self.calls = self.calls, []
+        values = await asyncio.gather(*(call[0] for call in calls))
+        for (_, result), value in zip(calls, values):
+            result.set(value)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            await self.flush()
+        else:
+            for coroutine, _ in self.calls:
+                coroutine.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            wait_threadsafe(self.flush(), self.controller._loop, 'batch')
+        else:
+            for coroutine, _ in self.calls:
+                coroutine.close()
+
+
+class BlockingController:
+
+    r'''
+    Synchronous view of an AsyncNanonisController for use from worker threads.
+
+    Coroutine methods are submitted to the event loop of the controller and
+    the calling thread waits for their result. Calling them from the event
+    loop thread itself would deadlock and raises nanonisException instead.
+    '''
+
+    def __init__(self, controller):
+        self._controller = controller
+        self._loop = controller._loop
+
+    def __getattr__(self, name):
+        attribute = getattr(self._controller, name)
+        if not asyncio.iscoroutinefunction(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            if self._loop_is_current():
+                raise nanonisException(
+                    'Blocking call of {} from the event loop, use AsyncNanonisController.run'.format(name))
+            return wait_threadsafe(attribute(*args, **kwargs), self._loop, name)
+        call.__name__ = name
+        return call
+
+    def _loop_is_current(self):
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._controller, name, value)
@@ -0,0 +1,50 @@
+# bench_codec.py
+# Encode/decode cost of construct_command + parse_response against the
+# precompiled CommandCodec registry, in ns/op.
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from interface import construct_command, get_codec, nanonis_programming_interface, to_binary
+
+parse_response = nanonis_programming_interface.parse_response
+
+# (command, legacy vargs, argument values, returned types, returned values)
+CASES = [
+    ('ZCtrl.GainGet', (), (), ('float32', 'float32', 'float32'), (1e-11, 5e-5, 2e-7)),
+    ('FolMe.XYPosGet', ('uint32', 1), (1,), ('float64', 'float64'), (1e-8, -2e-8)),
+    ('ZCtrl.LimitsGet', (), (), ('float32', 'float32'), (2e-7, -2e-7)),
+    ('FolMe.XYPosSet', ('float64', 1e-8, 'float64', -2e-8, 'uint32', 1), (1e-8, -2e-8, 1), (), ()),
+]
+
+
+def response_body(types, values):
+    body = b''.join(to_binary(t, v) for t, v in zip(types, values))
+    return body + to_binary('uint32', 0) + to_binary('int', 0)
+
+
+def ns_per_op(stmt, number=100000):
+    return min(timeit.repeat(stmt, number=number, repeat=5)) / number * 1e9
+
+
+def main():
+    print('{:<18}{:>14}{:>14}{:>14}{:>14}'.format(
+        'command', 'encode before', 'encode after', 'decode before', 'decode after'))
+    for name, vargs, args, types, values in CASES:
+        codec = get_codec(name)
+        assert codec.encode(*args) == construct_command(name, *vargs)
+        body = response_body(types, values)
+        response = {'body': body, 'body_size': len(body)}
+        enc_before = ns_per_op(lambda: construct_command(name, *vargs))
+        enc_after = ns_per_op(lambda: codec.encode(*args))
+        dec_before = ns_per_op(lambda: parse_response(response, *types))
+        dec_after = ns_per_op(lambda: codec.shape(codec.decode(body)))
+        print('{:<18}{:>11.0f} ns{:>11.0f} ns{:>11.0f} ns{:>11.0f} ns'.format(
+            name, enc_before, enc_after, dec_before, dec_after))
+
+
+if __name__ == '__main__':
+    main()
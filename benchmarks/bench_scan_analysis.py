@@ -0,0 +1,54 @@
+# bench_scan_analysis.py
+# Time the scan frame analysis of scan_analysis on synthetic tilted frames,
+# and compare where the raw global minimum and the leveled lowest area lie.
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scan_analysis import flat_regions, gaussian_smooth, line_level, local_minima, lowest_points, plane_level
+
+
+def synthetic_frame(rows, cols, seed=0):
+    r'''Tilted surface with a pit at (rows/4, 3*cols/4) and noise, in metres, big-endian like Nanonis.'''
+    rng = np.random.default_rng(seed)
+    row, col = np.mgrid[0:rows, 0:cols]
+    tilt = 3e-9 * row / rows + 2e-9 * col / cols
+    pit = -1e-9 * np.exp(-((row - rows / 4) ** 2 + (col - 3 * cols / 4) ** 2) / (2 * (rows / 50) ** 2))
+    return (tilt + pit + 1e-11 * rng.standard_normal((rows, cols))).astype('>f4')
+
+
+def best_of(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    for size in (256, 512):
+        frame = synthetic_frame(size, size)
+        leveled = plane_level(frame)
+        print('{0}x{0}: raw minimum at {1}, leveled lowest area at {2}'.format(
+            size, tuple(int(i) for i in np.unravel_index(np.argmin(frame), frame.shape)),
+            tuple(int(i) for i in lowest_points(frame)[0])))
+        for name, func in (('plane_level', lambda: plane_level(frame)),
+                           ('line_level', lambda: line_level(frame)),
+                           ('line_level order 1', lambda: line_level(frame, 1)),
+                           ('gaussian_smooth sigma 1', lambda: gaussian_smooth(frame, 1.)),
+                           ('local_minima k 5', lambda: local_minima(leveled, 5)),
+                           ('lowest_points', lambda: lowest_points(frame)),
+                           ('flat_regions', lambda: flat_regions(frame))):
+            print('    {:<26}{:8.2f} ms'.format(name, best_of(func, 10) * 1e3))
+    stack = np.stack([synthetic_frame(512, 512, seed) for seed in range(16)])
+    print('stack of 16 512x512: lowest_points {:.1f} ms per frame'.format(
+        best_of(lambda: lowest_points(stack), 3) * 1e3 / len(stack)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# bench_scan_frame.py
+# Compare the per-pixel ScanFrameData decoder with the vectorized one
+# on synthetic Scan.FrameDataGrab bodies.
+
+import os
+import sys
+import time
+import struct
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core import decode_frame_data
+from interface import from_binary
+
+
+def synthetic_body(rows, cols, channel_name='Z (m)'):
+    name = channel_name.encode('latin1')
+    frame = np.random.default_rng(0).standard_normal((rows, cols)).astype('>f4')
+    return struct.pack('>i', len(name)) + name + struct.pack('>ii', rows, cols) + \
+        frame.tobytes() + struct.pack('>I', 1)
+
+
+def legacy_decode(body):
+    cursor = 0
+    name_length = from_binary('int', body[cursor: cursor+4])
+    cursor += 4
+    channel_name = from_binary('string', body[cursor: cursor + name_length])
+    cursor += name_length
+    row_length = from_binary('int', body[cursor: cursor + 4])
+    cursor += 4
+    col_length = from_binary('int', body[cursor: cursor + 4])
+    cursor += 4
+    data = np.empty((row_length, col_length))
+    for i in range(row_length):
+        for j in range(col_length):
+            data[i, j] = from_binary('float32', body[cursor: cursor + 4])
+            cursor += 4
+    scan_direction = from_binary('uint32', body[cursor: cursor + 4])
+    return {'data': data, 'row': row_length, 'col': col_length,
+            'scan_direction': scan_direction, 'channel_name': channel_name}
+
+
+def best_of(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    for size in (256, 1024):
+        body = synthetic_body(size, size)
+        fast = best_of(lambda: decode_frame_data(body, view=True), 20)
+        native = best_of(lambda: decode_frame_data(body), 20)
+        legacy = best_of(lambda: legacy_decode(body), 1)
+        assert np.array_equal(legacy_decode(body)['data'], decode_frame_data(body)['data'])
+        print('{0}x{0}: legacy {1:.3f} s, view {2:.1f} us, native copy {3:.1f} us, speedup x{4:.0f}'.format(
+            size, legacy, fast * 1e6, native * 1e6, legacy / native))
+
+
+if __name__ == '__main__':
+    main()
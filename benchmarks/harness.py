@@ -0,0 +1,120 @@
+# harness.py
+r'''
+A small timing harness for the benchmark suite.
+
+Each benchmark is timed in rounds of an auto-calibrated number of calls.
+Results are stored as JSON (one file per label, e.g. a version or a git
+revision) so regressions can be compared across versions:
+
+    python benchmarks/run.py --label v1
+    python benchmarks/run.py --label v2 --compare benchmarks/results/v1.json
+'''
+
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+class BenchmarkSuite:
+
+    def __init__(self, min_time=0.2, rounds=5):
+        self.min_time = min_time
+        self.rounds = rounds
+        self.results = {}
+
+    def _calibrate(self, func):
+        number = 1
+        while True:
+            t0 = time.perf_counter()
+            for _ in range(number):
+                func()
+            elapsed = time.perf_counter() - t0
+            if elapsed >= self.min_time / self.rounds or number >= 1 << 20:
+                return number
+            number *= 2 if elapsed == 0 else max(2, int(self.min_time / self.rounds / elapsed))
+
+    def bench(self, name, func, number=None, rounds=None, unit='call'):
+        r'''
+        Time func and record the per-call statistics (seconds) under name.
+        Give number=1 for slow end-to-end benchmarks to skip the calibration.
+        '''
+        rounds = rounds or self.rounds
+        if number is None:
+            number = self._calibrate(func)
+        timings = []
+        for _ in range(rounds):
+            t0 = time.perf_counter()
+            for _ in range(number):
+                func()
+            timings.append((time.perf_counter() - t0) / number)
+        result = {
+            'min': min(timings),
+            'mean': statistics.mean(timings),
+            'stddev': statistics.stdev(timings) if len(timings) > 1 else 0.,
+            'rounds': rounds,
+            'number': number,
+            'unit': unit,
+        }
+        self.results[name] = result
+        print('{:<40} {:>12} / {}  (mean {}, {} x {})'.format(
+            name, format_time(result['min']), unit, format_time(result['mean']), rounds, number))
+        return result
+
+    def save(self, label, path=None):
+        if path is None:
+            os.makedirs(RESULTS_DIR, exist_ok=True)
+            path = os.path.join(RESULTS_DIR, label + '.json')
+        with open(path, 'w') as f:
+            json.dump({'label': label, 'machine': machine_info(), 'results': self.results}, f, indent=2)
+        return path
+
+
+def format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return '{:.3f} {}'.format(seconds / scale, unit)
+    return '{:.1f} ns'.format(seconds / 1e-9)
+
+
+def machine_info():
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                           cwd=os.path.dirname(RESULTS_DIR),
+                                           stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'revision': revision,
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+
+def compare(previous_path, results, threshold=0.1):
+    r'''
+    Print the ratio of each result against a saved run, flagging the ones
+    slower by more than threshold. Returns the names of the regressions.
+    '''
+    with open(previous_path) as f:
+        previous = json.load(f)['results']
+    regressions = []
+    print('\n{:<40} {:>12} {:>12} {:>8}'.format('benchmark', 'before', 'after', 'ratio'))
+    for name, result in results.items():
+        if name not in previous:
+            continue
+        ratio = result['min'] / previous[name]['min']
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  slower'
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            flag = '  faster'
+        print('{:<40} {:>12} {:>12} {:>7.2f}x{}'.format(
+            name, format_time(previous[name]['min']), format_time(result['min']), ratio, flag))
+    return regressions
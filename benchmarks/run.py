@@ -0,0 +1,127 @@
+# run.py
+# Benchmark suite for the protocol, parsing and workflow hot paths.
+#
+#   python benchmarks/run.py [--label NAME] [--compare results/OLD.json] [--quick]
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from harness import BenchmarkSuite, compare
+from bench_scan_frame import synthetic_body
+from bench_scan_analysis import synthetic_frame
+from core import NanonisController, decode_frame_data, decode_signal_names
+from param_cache import QUASI_STATIC_TTLS
+from frame_archive import FrameArchive
+from interface import construct_command, get_codec, nanonis_programming_interface, to_binary
+from path_planner import PLANNERS, plan, spiral_walk
+from quantity import parse_quantities, parse_quantity
+from scan_analysis import flat_regions, lowest_points, plane_level
+from simulator import NanonisSimulator, SIGNAL_NAMES, pack_string
+from tasks.TipRepair import SingleAreaTipRepairer
+
+
+def protocol_benchmarks(suite):
+    suite.bench('protocol.construct_command FolMe.XYPosSet',
+                lambda: construct_command('FolMe.XYPosSet', 'float64', 1e-8, 'float64', -2e-8, 'uint32', 1))
+    codec = get_codec('FolMe.XYPosSet')
+    suite.bench('protocol.codec_encode FolMe.XYPosSet', lambda: codec.encode(1e-8, -2e-8, 1))
+
+    body = to_binary('float32', 1e-11) + to_binary('float32', 5e-5) + to_binary('float32', 2e-7) + \
+        to_binary('uint32', 0) + to_binary('int', 0)
+    response = {'body': body, 'body_size': len(body)}
+    parse_response = nanonis_programming_interface.parse_response
+    suite.bench('protocol.parse_response ZCtrl.GainGet',
+                lambda: parse_response(response, 'float32', 'float32', 'float32'))
+    codec = get_codec('ZCtrl.GainGet')
+    suite.bench('protocol.codec_decode ZCtrl.GainGet', lambda: codec.shape(codec.decode(body)))
+
+
+def parsing_benchmarks(suite, quick):
+    names = b''.join(pack_string(name) for name in SIGNAL_NAMES)
+    body = to_binary('int', len(names)) + to_binary('int', len(SIGNAL_NAMES)) + names
+    suite.bench('parse.signals_names ({} names)'.format(len(SIGNAL_NAMES)),
+                lambda: decode_signal_names(body))
+    for size in (256,) if quick else (256, 1024):
+        body = synthetic_body(size, size)
+        suite.bench('parse.scan_frame {0}x{0}'.format(size), lambda: decode_frame_data(body))
+        suite.bench('parse.scan_frame {0}x{0} view'.format(size),
+                    lambda: decode_frame_data(body, view=True))
+    for size in (256,) if quick else (256, 512):
+        frame = synthetic_frame(size, size)
+        suite.bench('analysis.plane_level {0}x{0}'.format(size), lambda: plane_level(frame))
+        suite.bench('analysis.lowest_points {0}x{0}'.format(size), lambda: lowest_points(frame))
+        suite.bench('analysis.flat_regions {0}x{0}'.format(size), lambda: flat_regions(frame))
+    with tempfile.TemporaryDirectory() as directory, FrameArchive(directory) as archive:
+        frame = synthetic_frame(256, 256)
+        suite.bench('archive.append 256x256', lambda: archive.append(frame, channel='Z (m)'), rounds=3)
+        suite.bench('archive.random_access', lambda: archive[len(archive) // 2], rounds=3)
+
+
+def quantity_benchmarks(suite):
+    uncached = parse_quantity.__wrapped__
+    suite.bench('quantity.parse uncached -300p', lambda: uncached('-300p'))
+    suite.bench('quantity.parse uncached 2.5e-9', lambda: uncached('2.5e-9'))
+    suite.bench('quantity.parse uncached 5nA', lambda: uncached('5nA'))
+    suite.bench('quantity.parse cached -300p', lambda: parse_quantity('-300p'))
+    sweep = ['{}m'.format(v) for v in range(-1000, 1001, 10)] * 5
+    suite.bench('quantity.parse_quantities 1005 literals', lambda: parse_quantities(sweep))
+    suite.bench('quantity.parse_quantities 1005 literals (loop)', lambda: [uncached(v) for v in sweep])
+
+
+def session_benchmarks(suite, session, quick):
+    suite.bench('convert.si_prefix', lambda: session.convert('-300p'))
+    suite.bench('convert.try_convert float', lambda: session.try_convert(1.5e-9))
+    suite.bench('iterate.spiral_walk 441 points', lambda: list(spiral_walk(441)))
+    for name in PLANNERS:
+        suite.bench('iterate.plan {} 21x11'.format(name), lambda: list(plan(name, 10, 5)))
+    suite.bench('roundtrip.CurrentGet', session.CurrentGet)
+    suite.bench('roundtrip.ZLimitCheck (batched)', session.ZLimitCheck)
+    channels = [session.SignalIndexGet(name) for name in ('Z (m)', 'Current (A)', 'Frequency Shift (Hz)')]
+    suite.bench('roundtrip.ScanFrameData 3 channels x 2 directions (serial)',
+                lambda: [session.ScanFrameData(c, d) for c in channels for d in (1, 0)], rounds=3)
+    suite.bench('roundtrip.ScanFramesGrab 3 channels x 2 directions', lambda: session.ScanFramesGrab(channels), rounds=3)
+    if quick:
+        return
+    # one whole area of the pulse tip repairer: 3x3 points, one pulse per point
+    session.AutoApproachSet()
+    while session.AutoApproachGet():
+        time.sleep(0.05)
+    suite.bench('e2e.SingleAreaTipRepairer 9 points',
+                lambda: SingleAreaTipRepairer(session, gridX='400n', gridY='400n', interval_time=0).do(),
+                number=1, rounds=3, unit='area')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark suite of nanonis_control')
+    parser.add_argument('--label', default=time.strftime('%Y%m%d-%H%M%S'))
+    parser.add_argument('--compare', help='JSON results of a previous run')
+    parser.add_argument('--latency', type=float, default=0., help='simulated network latency (s)')
+    parser.add_argument('--quick', action='store_true', help='skip the slow benchmarks')
+    args = parser.parse_args()
+
+    suite = BenchmarkSuite()
+    protocol_benchmarks(suite)
+    parsing_benchmarks(suite, args.quick)
+    quantity_benchmarks(suite)
+
+    simulator = NanonisSimulator(port=0, latency=args.latency, seed=0)
+    simulator.state.elevate_probability = 1.  # every pulse elevates Z, keeps the e2e time stable
+    with simulator:
+        session = NanonisController('127.0.0.1', simulator.port, signal_cache_dir=None, param_ttls=QUASI_STATIC_TTLS)
+        logging.getLogger().setLevel(logging.WARNING)
+        session_benchmarks(suite, session, args.quick)
+        session.close()
+
+    print('\nsaved to', suite.save(args.label))
+    if args.compare:
+        compare(args.compare, suite.results)
+
+
+if __name__ == '__main__':
+    main()
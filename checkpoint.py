@@ -0,0 +1,185 @@
+# checkpoint.py
+r'''
+Durable progress of long-running tasks.
+
+A CheckpointStore is a SQLite database holding, for every run of a task,
+its parameters, a small key -> value state (area count, pulse bias, ...)
+and the grid points already processed in every area. Every write is
+committed at once, so a run killed at any point can be resumed with
+exactly the points it had not processed yet, and with the parameters it
+was started with. Starting a new run supersedes the unfinished runs of
+the task, and only the last runs of a task are kept.
+
+    store = CheckpointStore('tip_repairer.sqlite')
+    checkpoint, params = store.open('TipRepair', {'direction': 'Y-', 'area_counts': 100}, resume=True)
+    TipRepair(nanonis, checkpoint=checkpoint, **params).do()
+'''
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    task TEXT NOT NULL,
+    params TEXT NOT NULL,
+    started REAL NOT NULL,
+    updated REAL NOT NULL,
+    finished INTEGER NOT NULL DEFAULT 0  -- 0 running, 1 finished, 2 superseded by a newer run
+);
+CREATE TABLE IF NOT EXISTS state (
+    run INTEGER NOT NULL REFERENCES runs(id),
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (run, key)
+);
+CREATE TABLE IF NOT EXISTS visited (
+    run INTEGER NOT NULL REFERENCES runs(id),
+    area INTEGER NOT NULL,
+    x INTEGER NOT NULL,
+    y INTEGER NOT NULL,
+    time REAL NOT NULL,
+    PRIMARY KEY (run, area, x, y)
+);
+'''
+
+
+class CheckpointStore:
+
+    r'''
+    Args:
+        path : str
+            SQLite database file, created if missing (':memory:' for a throwaway store).
+        keep : int
+            Runs kept per task, the older ones are deleted when a run starts. None keeps them all.
+    '''
+
+    def __init__(self, path, keep=20):
+        self.path = path
+        self.keep = keep
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self, task, params=None):
+        r'''
+        Record a new run of task, returns its Checkpoint. The unfinished runs of task
+        can no longer be resumed, and the runs beyond the last keep are deleted.
+        '''
+        now = time.time()
+        with self._lock, self.db:
+            self.db.execute('UPDATE runs SET finished = 2 WHERE task = ? AND finished = 0', (task,))
+            cursor = self.db.execute('INSERT INTO runs (task, params, started, updated) VALUES (?, ?, ?, ?)',
+                                     (task, json.dumps(params or {}), now, now))
+            if self.keep is not None:
+                old = [row[0] for row in self.db.execute(
+                    'SELECT id FROM runs WHERE task = ? ORDER BY id DESC LIMIT -1 OFFSET ?', (task, self.keep))]
+                for table, column in (('visited', 'run'), ('state', 'run'), ('runs', 'id')):
+                    self.db.executemany('DELETE FROM {} WHERE {} = ?'.format(table, column), [(run,) for run in old])
+        return Checkpoint(self, cursor.lastrowid, task, params or {})
+
+    def open(self, task, params, resume=False):
+        r'''
+        The Checkpoint of the last unfinished run of task with its parameters when resume is set and there
+        is one, otherwise of a new run with params. Returns (checkpoint, params).
+        '''
+        checkpoint = self.resume(task) if resume else None
+        if checkpoint is None:
+            if resume:
+                logging.warn('No unfinished run of {} to resume, starting a new one.'.format(task))
+            return self.start(task, params), dict(params)
+        # a parameter added since the run was started keeps its given value
+        return checkpoint, dict(params, **checkpoint.params)
+
+    def resume(self, task):
+        r'''The Checkpoint of the last unfinished run of task, None if there is none.'''
+        with self._lock:
+            row = self.db.execute('SELECT id, params FROM runs WHERE task = ? AND finished = 0 '
+                                  'ORDER BY id DESC LIMIT 1', (task,)).fetchone()
+        if row is None:
+            return None
+        return Checkpoint(self, row[0], task, json.loads(row[1]))
+
+    def runs(self, task=None):
+        r'''(id, task, started, updated, finished) of all runs, newest first.'''
+        query = 'SELECT id, task, started, updated, finished FROM runs'
+        with self._lock:
+            if task is None:
+                return self.db.execute(query + ' ORDER BY id DESC').fetchall()
+            return self.db.execute(query + ' WHERE task = ? ORDER BY id DESC', (task,)).fetchall()
+
+    def _write(self, run, state=None, visit=None, finished=None):
+        # one transaction: a point and the state it left behind are saved together
+        now = time.time()
+        with self._lock, self.db:
+            if visit is not None:
+                area, x, y = visit
+                self.db.execute('INSERT OR REPLACE INTO visited (run, area, x, y, time) VALUES (?, ?, ?, ?, ?)',
+                                (run, area, x, y, now))
+            if state:
+                self.db.executemany('INSERT OR REPLACE INTO state (run, key, value) VALUES (?, ?, ?)',
+                                    [(run, key, json.dumps(value)) for key, value in state.items()])
+            if finished is not None:
+                self.db.execute('UPDATE runs SET finished = ? WHERE id = ?', (int(finished), run))
+            self.db.execute('UPDATE runs SET updated = ? WHERE id = ?', (now, run))
+
+    def _state(self, run):
+        with self._lock:
+            rows = self.db.execute('SELECT key, value FROM state WHERE run = ?', (run,)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def _visited(self, run, area):
+        with self._lock:
+            rows = self.db.execute('SELECT x, y FROM visited WHERE run = ? AND area = ?', (run, area)).fetchall()
+        return set(rows)
+
+
+class Checkpoint:
+
+    r'''
+    Progress of one run in a CheckpointStore. The state is cached in memory and
+    written through on every update.
+    '''
+
+    def __init__(self, store, run, task, params):
+        self.store = store
+        self.run = run
+        self.task = task
+        self.params = params
+        self.state = store._state(run)
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def update(self, **state):
+        r'''Save state values (JSON serializable).'''
+        self.state.update(state)
+        self.store._write(self.run, state)
+
+    def visit(self, area, cell, **state):
+        r'''Mark the grid cell (x, y) of area as processed, together with the state after it.'''
+        self.state.update(state)
+        self.store._write(self.run, state, (area, int(cell[0]), int(cell[1])))
+
+    def visited(self, area):
+        r'''The set of cells of area already processed.'''
+        return self.store._visited(self.run, area)
+
+    def finish(self):
+        self.store._write(self.run, finished=True)
+        logging.info('Run {} of {} finished.'.format(self.run, self.task))
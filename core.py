@@ -1,17 +1,52 @@
 # core.py by CoccaGuo at 2022/05/16 16:45
 from abc import ABCMeta, abstractmethod
 from enum import Enum
+import asyncio
 import logging
 import time
 import numpy as np
 
 from interface import *
+from waiter import Waiter
+from sampler import SignalSampler
+from scan_stream import ScanStream
+from signal_registry import DEFAULT_CACHE_DIR, DEFAULT_TTL, SignalRegistry
+from param_cache import ParameterCache
+from telemetry import TelemetryRecorder
+from frame_archive import FrameArchive
+from io_worker import IOWorker
+from retry import RetryPolicy
+from deadline import budget
+from profiler import Profiler
+from quantity import QuantityError, parse_quantities
 
 
 class NanonisController(nanonis_programming_interface):
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, signal_ttl=DEFAULT_TTL, signal_cache_dir=DEFAULT_CACHE_DIR, param_ttls=None,
+                 telemetry_dir=None, profile=False, archive_dir=None, retries=3, **kwargs):
         super().__init__(*args, **kwargs)
+        self.waiter = Waiter()
+        # a broken connection is reopened and idempotent commands are sent again (see retry.RetryPolicy)
+        self.retry = RetryPolicy(retries)
+        if profile:
+            # command latencies, waits and Operate phases (see profiler.Profiler.report)
+            self.profiler = Profiler()
+            self.waiter.profiler = self.profiler
+        if telemetry_dir is not None or archive_dir is not None:
+            # the disk writes are done on one background thread, off the command path
+            self.io = IOWorker().start()
+        if telemetry_dir is not None:
+            # every command and operation is recorded to NPZ chunks (see telemetry.TelemetryReader)
+            self.telemetry = TelemetryRecorder(telemetry_dir, worker=self.io).start()
+        if archive_dir is not None:
+            # every frame grabbed by a Scan is kept with its metadata (see frame_archive.FrameArchive)
+            self.archive = FrameArchive(archive_dir, worker=self.io)
+        # quasi-static parameters (Z limits, piezo range, gains, ...) listed in param_ttls are read once per TTL,
+        # e.g. param_ttls=param_cache.QUASI_STATIC_TTLS; none by default
+        self.params = ParameterCache(param_ttls)
+        self.signals = SignalRegistry(self._fetch_signal_names, self.connection.address[0],
+                                      signal_ttl, signal_cache_dir, self.connection.address[1])
         setupLog()
 
     def try_convert(self, value):
@@ -20,6 +55,15 @@ class NanonisController(nanonis_programming_interface):
         else:
             return float(value)
 
+    def convert_many(self, values):
+        '''
+        Parse a list / array / comma separated string of values at once, e.g. a bias sweep.
+        '''
+        try:
+            return parse_quantities(values)
+        except QuantityError as e:
+            raise nanonisException(str(e))
+
     def MotorMoveSet(self, direction, steps, wait=True):
         direct_map = {'X+': 0, 'X-': 1, 'Y+': 2, 'Y-': 3, 'Z+': 4, 'Z-': 5}
         try:
@@ -29,28 +73,19 @@ class NanonisController(nanonis_programming_interface):
                 'Invalid direction. Please use X+, X-, Y+, Y-, Z+, Z- expressions.')
         if direction == 5:
             raise nanonisException('Moving Z- is not Safe.')
-        self.send('Motor.StartMove', 'uint32', direction, 'uint16',
-                  steps, 'uint32', 0, 'uint32', int(wait))
+        self.query('Motor.StartMove', direction, steps, 0, int(wait))
 
     def AutoApproachOpen(self):
-        self.send('AutoApproach.Open')
+        self.query('AutoApproach.Open')
 
     def AutoApproachSet(self, on=True):
-        self.send('AutoApproach.OnOffSet', 'uint16', int(on))
+        self.query('AutoApproach.OnOffSet', int(on))
 
     def AutoApproachGet(self):
-        parsedResponse = self.parse_response(
-            self.send('AutoApproach.OnOffGet'), 'uint16')
-        return parsedResponse['0']
+        return self.query('AutoApproach.OnOffGet')
 
     def ZGainGet(self):
-        parsedResponse = self.parse_response(
-            self.send('ZCtrl.GainGet'), 'float32', 'float32', 'float32')
-        return {
-            'P': parsedResponse['0'],
-            'T': parsedResponse['1'],
-            'I': parsedResponse['2']
-        }
+        return self.query('ZCtrl.GainGet')
 
     def ZGainSet(self, P, T, I):
         if type(P) is str:
@@ -65,8 +100,7 @@ class NanonisController(nanonis_programming_interface):
             I_val = self.convert(I)
         else:
             I_val = float(I)
-        self.send('ZCtrl.GainSet', 'float32', P_val,
-                  'float32', T_val, 'float32', I_val)
+        self.query('ZCtrl.GainSet', P_val, T_val, I_val)
 
     def ZGainPSet(self, P):
         if type(P) is str:
@@ -74,7 +108,7 @@ class NanonisController(nanonis_programming_interface):
         else:
             P_val = float(P)
         present = self.ZGainGet()
-        self.ZGainSet(P_val, present['T'], present['I'])
+        self.ZGainSet(P_val, present.T, present.I)
 
     def ZGainTSet(self, T):
         if type(T) is str:
@@ -82,46 +116,38 @@ class NanonisController(nanonis_programming_interface):
         else:
             T_val = float(T)
         present = self.ZGainGet()
-        self.ZGainSet(present['P'], T_val, present['I'])
+        self.ZGainSet(present.P, T_val, present.I)
 
     def PLLOutputSet(self, on=True):
-        self.send('PLL.OutOnOffSet', 'int', 1, 'uint32', int(on))
+        self.query('PLL.OutOnOffSet', 1, int(on))
 
     def PLLFreqShiftGet(self):
-        parsedResponse = self.parse_response(
-            self.send('PLL.FreqShiftGet', 'int', 1), 'float32')
-        return parsedResponse['0']
+        return self.query('PLL.FreqShiftGet', 1)
 
     def PLLAmpCtrlSet(self, on=True):
-        self.send('PLL.AmpCtrlOnOffSet', 'int', 1, 'uint32', int(on))
+        self.query('PLL.AmpCtrlOnOffSet', 1, int(on))
 
     def PLLPhasCtrlSet(self, on=True):
-        self.send('PLL.PhasCtrlOnOffSet', 'int', 1, 'uint32', int(on))
+        self.query('PLL.PhasCtrlOnOffSet', 1, int(on))
 
     def ZCtrlOnOffGet(self):
-        parsedResponse = self.parse_response(
-            self.send('ZCtrl.OnOffGet'), 'uint32')
-        return parsedResponse['0']
+        return self.query('ZCtrl.OnOffGet')
 
     def ZCtrlOnOffSet(self, on=True):
-        self.send('ZCtrl.OnOffSet', 'uint32', int(on))
+        self.query('ZCtrl.OnOffSet', int(on))
 
     def ZLimitsGet(self):
-        parsedResponse = self.parse_response(
-            self.send('ZCtrl.LimitsGet'), 'float32', 'float32')
-        return {
-            'high': parsedResponse['0'],
-            'low': parsedResponse['1']
-        }
+        return self.query('ZCtrl.LimitsGet')
 
     def ZLimitCheck(self):
         '''
         intermediate api
         '''
-        z1 = self.TipZGet()
-        z_limits = self.ZLimitsGet()
-        z_max = z_limits['high']
-        z_min = z_limits['low']
+        with self.batch() as batch:
+            z = batch.query('ZCtrl.ZPosGet')
+            z_limits = batch.query('ZCtrl.LimitsGet')
+        z1 = z.value
+        z_max, z_min = z_limits.value
         if abs(z_max-z1)/z_max < 0.01:  # if the tip is at the piezo top limit
             self.Withdraw()
             logging.info('Piezo reached the z-high-limit, withdraw')
@@ -149,40 +175,43 @@ class NanonisController(nanonis_programming_interface):
             self.WaitForZCtrlWork()
 
     def BiasPulse(self, bais, width=0.1, wait=True):
-        self.send('Bias.Pulse', 'uint32', int(wait), 'float32', float(
-            width), 'float32', float(bais), 'uint16', 0, 'uint16', 0)
+        self.query('Bias.Pulse', int(wait), float(width), float(bais), 0, 0)
 
     def PiezoRangeGet(self):
-        parsedResponse = self.parse_response(
-            self.send('Piezo.RangeGet'), 'float32', 'float32', 'float32')
-        return {
-            'x': parsedResponse['0'],
-            'y': parsedResponse['1'],
-            'z': parsedResponse['2'],
-        }
+        return self.query('Piezo.RangeGet')
+
+    def _fetch_signal_names(self):
+        return decode_signal_names(self.send('Signals.NamesGet')['body'])
 
     def SignalsNamesGet(self):
-        response = self.send('Signals.NamesGet')
-        cursor = 4
-        name_number = from_binary('int', response['body'][cursor: cursor+4])
-        cursor += 4
-        names = []
-        for i in range(name_number):
-            name_size = from_binary('int', response['body'][cursor: cursor+4])
-            cursor += 4
-            name = from_binary(
-                'string', response['body'][cursor: cursor+name_size])
-            if self.channel_name_filter(name):
-                names.append(name)
-            cursor += name_size
-        return names
+        '''
+        names of the signals available on this machine, from the signal registry.
+        '''
+        self.signals.ensure()
+        return [name for name in self.signals.names
+                if self.channel_name_filter(name)]
 
     def SignalIndexGet(self, name):
-        if not hasattr(self, 'signal_chart'):
-            self.signal_chart = self.SignalsNamesGet()
-        if name not in self.signal_chart:
-            raise nanonisException('Invalid signal name.')
-        return self.signal_chart.index(name)
+        '''
+        raw Nanonis index of a signal, as used by Signals.ValGet and Scan.FrameDataGrab.
+        '''
+        return self.signals.index(name)
+
+    def SignalNameGet(self, index):
+        return self.signals.name(index)
+
+    def StreamSignals(self, signals, rate=10., capacity=10000, wait=False):
+        '''
+        Start a background SignalSampler on the signals (names or indices).
+        '''
+        indices = [self.SignalIndexGet(s) if type(s) is str else int(s) for s in signals]
+        return SignalSampler(self, indices, rate, capacity, wait).start()
+
+    def ScanStream(self, channel_index, data_dir=1, interval=0.2, timeout=None):
+        '''
+        A ScanStream following the running scan line by line on channel_index.
+        '''
+        return ScanStream(self, channel_index, data_dir, interval, timeout)
 
     def ScanStart(self, direction='down'):
         if direction == 'down':
@@ -191,56 +220,47 @@ class NanonisController(nanonis_programming_interface):
             d = 1
         else:
             raise nanonisException('Invalid direction. Please use down or up.')
-        self.send('Scan.Action', 'uint16', 0, 'uint32', d)
+        self.query('Scan.Action', 0, d)
 
     def ScanStop(self):
-        self.send('Scan.Action', 'uint16', 1, 'uint32', 0)
+        self.query('Scan.Action', 1, 0)
 
     def ScanPause(self):
-        self.send('Scan.Action', 'uint16', 2, 'uint32', 0)
+        self.query('Scan.Action', 2, 0)
 
     def ScanResume(self):
-        self.send('Scan.Action', 'uint16', 3, 'uint32', 0)
+        self.query('Scan.Action', 3, 0)
 
     def ScanStatusGet(self):
-        return self.parse_response(self.send('Scan.StatusGet'), 'uint32')['0']
+        return self.query('Scan.StatusGet')
 
     def ScanFrameSet(self, center_x, center_y, width, height, angle=0):
-        self.send('Scan.FrameSet', 'float32', center_x, 'float32',
-                  center_y, 'float32', width, 'float32', height, 'float32', angle)
+        self.query('Scan.FrameSet', center_x, center_y, width, height, angle)
 
-    def ScanFrameData(self, channel_index, data_dir=1):
+    def ScanFrameData(self, channel_index, data_dir=1, view=False):
         '''
-        need to be rewritten, use this version first, I don't want to think.
+        Grab the data of the current scan frame.
+
+        The frame body is decoded in one step (no per-pixel unpacking) into a
+        writable native float64 array. Set view=True to get a read-only
+        big-endian float32 view on the response instead (no copy).
         '''
         response = self.send('Scan.FrameDataGrab', 'uint32',
                              channel_index, 'uint32', data_dir)
-        cursor = 0
-        name_length = from_binary('int', response['body'][cursor: cursor+4])
-        cursor += 4
-        channel_name = from_binary(
-            'string', response['body'][cursor: cursor + name_length])
-        cursor += name_length
-        row_length = from_binary('int', response['body'][cursor: cursor + 4])
-        cursor += 4
-        col_length = from_binary('int', response['body'][cursor: cursor + 4])
-        cursor += 4
-        data = np.empty((row_length, col_length))
-        for i in range(row_length):
-            for j in range(col_length):
-                data[i, j] = from_binary(
-                    'float32', response['body'][cursor: cursor + 4])
-                cursor += 4
-        scan_direction = from_binary(
-            'uint32', response['body'][cursor: cursor + 4])
-        cursor += 4
-        return {
-            'data': data,
-            'row': row_length,
-            'col': col_length,
-            'scan_direction': scan_direction,
-            'channel_name': channel_name
-        }
+        return decode_frame_data(response['body'], view)
+
+    def ScanFramesGrab(self, channels, directions=(1, 0)):
+        '''
+        Grab several channels (names or indices) of the current scan frame in both directions
+        (1: forward, 0: backward) with one pipelined round-trip.
+        Returns the frames stacked as data[channel, direction, row, col] (native float32)
+        with the channel names, indices and directions, see stack_frames.
+        '''
+        indices = [self.SignalIndexGet(c) if type(c) is str else int(c) for c in channels]
+        with self.batch() as batch:
+            responses = [batch.send('Scan.FrameDataGrab', 'uint32', index, 'uint32', data_dir)
+                         for index in indices for data_dir in directions]
+        return stack_frames([r.value['body'] for r in responses], indices, directions)
 
     def to_nano(self, value):
         return "{:.1f}n".format(value/1e-9)
@@ -265,26 +285,49 @@ class NanonisController(nanonis_programming_interface):
             return True
 
     def WaitEndOfScan(self):
-        self.send('Scan.WaitEndOfScan', 'int', -1)
+        timeout, deadline = self.server_timeout(-1)
+        response = self.send('Scan.WaitEndOfScan', 'int', timeout)
+        # timeout status first: the scan is still running
+        if deadline is not None and from_binary('uint32', response['body'][:4]):
+            deadline.cut('Scan.WaitEndOfScan')
 
     def isZCtrlWork(self):
         '''
         make sure it is current mode.
         '''
-        curr = self.CurrentGet()
-        point = self.SetpointGet()
+        with self.batch() as batch:
+            current = batch.query('Current.Get')
+            setpoint = batch.query('ZCtrl.SetpntGet')
+        curr = current.value
+        point = setpoint.value
         if (abs(curr)-abs(point))/abs(point) < 0.1:
             return True
         else:
             return False
 
-    def WaitForZCtrlWork(self):
-        while not self.isZCtrlWork():
-            time.sleep(1)
+    def WaitForZCtrlWork(self, timeout=None):
+        self.waiter.until(self.isZCtrlWork, 'Z-controller work', timeout)
+
+    def WaitForApproach(self, timeout=None):
+        '''
+        wait till auto-approach is finished
+        '''
+        self.waiter.until(lambda: not self.AutoApproachGet(), 'auto approach',
+                          timeout, initial=0.2, max_interval=2)
+
+    def WaitForScanEnd(self, timeout=None):
+        self.waiter.until(lambda: not self.ScanStatusGet(), 'scan end',
+                          timeout, initial=0.1, max_interval=1)
+
+    def WaitForZSettle(self, max_time, tolerance='10p', window=0.5, name='Z settle'):
+        '''
+        replaces a fixed settle sleep of max_time seconds: returns as soon as Z stayed within tolerance for window seconds.
+        '''
+        return self.waiter.stable(self.TipZGet, name, self.try_convert(tolerance), window, timeout=max_time)
 
     
     def TipShaperStart(self):
-        print(self.transmit(construct_command('TipShaper.PropsGet')))
+        print(bytes(self.transmit(construct_command('TipShaper.PropsGet'))))
 
     
     def TipShaperPropsSet(self, tip_lift='-300p', left_time_1='90m', bias_lift=3, bias_setting_t='90m'):
@@ -293,9 +336,98 @@ class NanonisController(nanonis_programming_interface):
         left_time_1 = self.try_convert(left_time_1)
         bias_lift = self.try_convert(bias_lift)
         bias_setting_t = self.try_convert(bias_setting_t)
-        self.send('TipShaper.PropsSet', 'float32', 0.05, 'uint32', 0, 'float32', 0., 'float32', tip_lift,
-                'float32', left_time_1, 'float32', bias_lift, 'float32', bias_setting_t, 'float32', 0., 
-                'float32', 0.02, 'float32', 0.1, 'uint32', 0)
+        self.query('TipShaper.PropsSet', 0.05, 0, 0., tip_lift, left_time_1, bias_lift,
+                   bias_setting_t, 0., 0.02, 0.1, 0)
+
+
+def decode_signal_names(body):
+    '''
+    Decode the body of a Signals.NamesGet response into the list of all signal names.
+    '''
+    cursor = 4
+    name_number = from_binary('int', body[cursor: cursor+4])
+    cursor += 4
+    names = []
+    for i in range(name_number):
+        name_size = from_binary('int', body[cursor: cursor+4])
+        cursor += 4
+        names.append(from_binary('string', body[cursor: cursor+name_size]))
+        cursor += name_size
+    return names
+
+
+def decode_frame_data(body, view=False):
+    '''
+    Decode the body of a Scan.FrameDataGrab response, data is a writable native float64 array,
+    or with view=True a read-only big-endian float32 view on body.
+    '''
+    buffer = memoryview(body)
+    cursor = 0
+    name_length = from_binary('int', buffer[cursor: cursor+4])
+    cursor += 4
+    channel_name = from_binary('string', bytes(buffer[cursor: cursor + name_length]))
+    cursor += name_length
+    row_length = from_binary('int', buffer[cursor: cursor + 4])
+    cursor += 4
+    col_length = from_binary('int', buffer[cursor: cursor + 4])
+    cursor += 4
+    count = row_length * col_length
+    data = np.frombuffer(buffer, dtype='>f4', count=count,
+                         offset=cursor).reshape(row_length, col_length)
+    if not view:
+        data = data.astype(np.float64)
+    cursor += count * 4
+    scan_direction = from_binary('uint32', buffer[cursor: cursor + 4])
+    return {
+        'data': data,
+        'row': row_length,
+        'col': col_length,
+        'scan_direction': scan_direction,
+        'channel_name': channel_name
+    }
+
+
+def stack_frames(bodies, channel_indices, directions):
+    '''
+    Decode the Scan.FrameDataGrab bodies of every (channel, direction), channel-major,
+    into one native float32 array of shape (channels, directions, rows, cols).
+    '''
+    shape = (len(channel_indices), len(directions))
+    frames = [decode_frame_data(body, view=True) for body in bodies]
+    if len(frames) != shape[0] * shape[1]:
+        raise nanonisException('Expected {} frames, got {}'.format(shape[0] * shape[1], len(frames)))
+    if not frames:
+        return {'data': np.empty(shape + (0, 0), dtype=np.float32), 'row': 0, 'col': 0, 'channel_names': [],
+                'channel_indices': list(channel_indices), 'directions': list(directions), 'scan_direction': None}
+    rows, cols = frames[0]['row'], frames[0]['col']
+    data = np.empty(shape + (rows, cols), dtype=np.float32)
+    for i, frame in enumerate(frames):
+        if (frame['row'], frame['col']) != (rows, cols):
+            raise nanonisException('Frame of {} is {}x{}, expected {}x{}'.format(
+                frame['channel_name'], frame['row'], frame['col'], rows, cols))
+        data[divmod(i, shape[1])] = frame['data']  # byte swap into the stack, the only copy
+    return {
+        'data': data,
+        'row': rows,
+        'col': cols,
+        'channel_names': [frames[i * shape[1]]['channel_name'] for i in range(shape[0])],
+        'channel_indices': list(channel_indices),
+        'directions': list(directions),
+        'scan_direction': frames[-1]['scan_direction'],
+    }
+
+
+class Resource(Enum):
+    '''
+    Hardware an operation drives, operations sharing a resource never run concurrently (see scheduler).
+    '''
+    Z_CONTROLLER = 1
+    XY_PIEZO = 2
+    PLL = 3
+    MOTOR = 4
+    BIAS = 5
+    SCAN = 6
+    USER_OUTPUT = 7
 
 
 class Operate(metaclass=ABCMeta):
@@ -303,6 +435,11 @@ class Operate(metaclass=ABCMeta):
     The base class of all Operations.
     '''
 
+    # hardware driven by the operation, all of it unless a subclass declares less
+    resources = frozenset(Resource)
+    # time budget (s) of every do(), None for none (see deadline.py)
+    timeout = None
+
     def __init__(self, session: NanonisController):
         self.session = session
 
@@ -317,14 +454,61 @@ class Operate(metaclass=ABCMeta):
     def _reset(self):
         pass
 
-    def do(self):
-        if self.safety_check():
-            result = self._operate()
-            self._reset()
+    def do(self, timeout=None, deadline=None):
+        '''
+        With a timeout (s, the timeout attribute by default) or a deadline.Deadline, the operation runs under a
+        child of deadline (of the enclosing operation by default): safety_check, _operate and every command and
+        wait stop with Cancelled when it passes or is cancelled. Nested operations inherit it.
+        '''
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is None and deadline is None:
+            return self._measured()
+        with budget(timeout, type(self).__name__, deadline):
+            return self._measured()
+
+    def _measured(self):
+        telemetry = getattr(self.session, 'telemetry', None)
+        profiler = getattr(self.session, 'profiler', None)
+        if telemetry is None and profiler is None:
+            return self._do()
+        start = time.time()
+        try:
+            if profiler is None:
+                result = self._do()
+            else:
+                with profiler.span(type(self).__name__):
+                    result = self._do()
+        except Exception as e:
+            if telemetry is not None:
+                telemetry.operation(type(self).__name__, start, time.time() - start, None, e)
+            raise
+        if telemetry is not None:
+            telemetry.operation(type(self).__name__, start, time.time() - start, result)
+        return result
+
+    def _do(self):
+        if self._phase('safety_check', self.safety_check):
+            result = self._phase('_operate', self._operate)
+            self._phase('_reset', self._reset)
             return result
         else:
             raise nanonisException('Safety check failed.')
 
+    def _phase(self, name, method):
+        profiler = getattr(self.session, 'profiler', None)
+        if profiler is None:
+            return method()
+        with profiler.span(name):
+            return method()
+
+    async def async_do(self, timeout=None, deadline=None):
+        '''
+        Run do() in a worker thread, so the event loop keeps serving other coroutines.
+        The session should be the blocking() view of an AsyncNanonisController.
+        '''
+        return await asyncio.to_thread(self.do, timeout, deadline)
+
 
 class ExceptionType(Enum):
     '''
@@ -0,0 +1,136 @@
+# deadline.py
+r'''
+Time budgets and cancellation of operations.
+
+A Deadline is a token holding the time by which an operation must be
+done and a cancelled flag. Operate.do(timeout=...) makes a Deadline the
+current one of its thread for the whole operation: nested operations get
+a child deadline which never outlives the parent, every wait of the
+Waiter ends at the deadline, and every command sent checks it before
+taking the lock and uses the time left as its socket timeout. Waits done
+by Nanonis itself (ZCtrl.Withdraw, Scan.WaitEndOfScan) are given the time
+left and raise Cancelled if they were still waiting. When the deadline
+passes or cancel() is called (from any thread), the operation stops with
+Cancelled at the next command or wait.
+
+    area = Deadline(600, name='area 3')
+    SingleAreaTipRepairer(nanonis).do(deadline=area)   # this area gets 10 minutes
+    ...
+    area.cancel('operator stop')                       # from another thread
+'''
+
+import threading
+import time
+from contextlib import contextmanager
+
+from interface import Cancelled, current_deadline, set_deadline
+
+
+class Deadline:
+
+    r'''
+    Args:
+        timeout : float
+            Seconds from now, None for no time limit (cancel() still works).
+        parent : Deadline
+            Enclosing deadline, this one expires and is cancelled with it.
+        name : str
+            Shown in the Cancelled message.
+    '''
+
+    def __init__(self, timeout=None, parent=None, name=''):
+        self.parent = parent
+        self.name = name
+        self.expires = None if timeout is None else time.monotonic() + timeout
+        if parent is not None and parent.expires is not None:
+            self.expires = parent.expires if self.expires is None else min(self.expires, parent.expires)
+        self.reason = None
+        self._cancelled = threading.Event()
+
+    def child(self, timeout=None, name=''):
+        return Deadline(timeout, self, name)
+
+    def cancel(self, reason='cancelled'):
+        r'''Stop the operation at its next command or wait, thread-safe.'''
+        self.reason = reason
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set() or (self.parent is not None and self.parent.cancelled)
+
+    def remaining(self):
+        r'''Seconds left, None without time limit.'''
+        if self.expires is None:
+            return None
+        return max(0., self.expires - time.monotonic())
+
+    @property
+    def expired(self):
+        return self.cancelled or (self.expires is not None and time.monotonic() >= self.expires)
+
+    def _reason(self):
+        deadline = self
+        while deadline is not None:
+            if deadline._cancelled.is_set():
+                return deadline.reason
+            deadline = deadline.parent
+        return 'deadline passed'
+
+    def check(self, what=''):
+        r'''Raise Cancelled if the deadline passed or it was cancelled.'''
+        if self.expired:
+            raise Cancelled('{}{}: {}'.format(self.name or 'operation', ' at ' + what if what else '', self._reason()))
+
+    def cut(self, what):
+        r'''Raise Cancelled for what, a wait which Nanonis ended at the time left of this deadline.'''
+        raise Cancelled('{} at {}: still waiting at the deadline'.format(self.name or 'operation', what))
+
+    def limit(self, timeout):
+        r'''timeout (s, None for none) shortened to the time left.'''
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        return remaining if timeout is None else min(timeout, remaining)
+
+    def sleep(self, seconds, what=''):
+        r'''Sleep, but raise Cancelled as soon as the deadline passes or it is cancelled.'''
+        end = time.monotonic() + seconds
+        while True:
+            self.check(what)
+            left = end - time.monotonic()
+            if left <= 0:
+                return
+            # cancel() of this deadline wakes the wait at once, the parents are polled
+            self._cancelled.wait(min(self.limit(left), 0.1 if self.parent is not None else left))
+
+    @contextmanager
+    def active(self):
+        r'''Make this the current deadline of the thread for the block.'''
+        previous = set_deadline(self)
+        try:
+            yield self
+        finally:
+            set_deadline(previous)
+
+
+@contextmanager
+def budget(timeout=None, name='', deadline=None):
+    r'''
+    Run the block under a child of deadline (the current deadline by default) limited to timeout seconds.
+    '''
+    parent = current_deadline() if deadline is None else deadline
+    with Deadline(timeout, parent, name).active() as child:
+        yield child
+
+
+@contextmanager
+def unbounded():
+    r'''
+    Run the block without a deadline: the cleanup (Home, Withdraw) of an operation which ran out of time.
+    '''
+    previous = set_deadline(None)
+    try:
+        yield
+    finally:
+        set_deadline(previous)
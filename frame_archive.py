@@ -0,0 +1,239 @@
+# frame_archive.py
+r'''
+On-disk archive of scan frames.
+
+Every archived frame is written into a slot of a preallocated .npy chunk,
+and one JSON line with its metadata (frame geometry, channel, time, tip
+state, ...) is appended to the index:
+
+    <directory>/index.jsonl
+    <directory>/chunk-000001.npy    frames of one shape and dtype, (chunk_frames, *shape)
+    <directory>/chunk-000002.npy
+
+Appending costs one write into the page cache whatever the size of the
+archive (no fsync, the kernel writes the pages back), and reading returns
+read-only memory-mapped views on the chunks, so neither grows with the
+number of frames in RAM. A frame is only listed in the index once its
+data is written, so an archive of a killed run is consistent up to the
+last complete frame. With an IOWorker (see io_worker.py) the writes are
+done on its thread, the frame is handed over without a copy.
+
+    archive = FrameArchive('frames/run1')
+    archive.append(data, center_x=0., center_y=0., width=150e-9, height=50e-9, channel='Z (m)')
+    ...
+    deep = archive.select(channel='Z (m)', area=lambda a: a < 10)
+    stack = archive.load(deep)
+'''
+
+import collections
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from io_worker import write_at
+
+
+class FrameArchive:
+
+    r'''
+    Args:
+        directory : str
+            Directory of the archive, created if missing; an existing archive is appended to.
+        chunk_frames : int
+            Frames per chunk file.
+        open_chunks : int
+            Chunks kept mapped for reading at most.
+        worker : IOWorker
+            Background writer of the frames and the index, None writes them in place.
+    '''
+
+    def __init__(self, directory, chunk_frames=64, open_chunks=16, worker=None):
+        self.directory = directory
+        self.worker = worker
+        self.chunk_frames = chunk_frames
+        self.open_chunks = open_chunks
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, 'index.jsonl')
+        self.entries = []  # frame id -> metadata, with 'chunk', 'slot', 'shape' and 'dtype'
+        self.next_chunk = 1
+        self._writers = {}  # (shape, dtype) -> [chunk, file descriptor, data offset, next slot]
+        self._readers = collections.OrderedDict()  # chunk -> read-only memmap, least recently used first
+        self._lock = threading.Lock()
+        self._load_index()
+        self._index = open(self.index_path, 'a')
+
+    def _chunk_path(self, chunk):
+        return os.path.join(self.directory, 'chunk-{:06d}.npy'.format(chunk))
+
+    def _open_chunk(self, chunk):
+        return os.open(self._chunk_path(chunk), os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+
+    def _submit(self, function, *args):
+        if self.worker is None:
+            function(*args)
+        else:
+            self.worker.call(function, *args)
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        filled = {}  # (shape, dtype) -> (last chunk, slots used)
+        with open(self.index_path, 'rb+') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # the last line was cut short, the next entry must not be glued to it
+                    logging.warning('Dropping the torn last line of {}'.format(self.index_path))
+                    f.truncate(f.tell() - len(line))
+                    break
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logging.warning('Skipping a torn line of {}'.format(self.index_path))
+                    continue
+                self.entries.append(entry)
+                self.next_chunk = max(self.next_chunk, entry['chunk'] + 1)
+                filled[(tuple(entry['shape']), entry['dtype'])] = (entry['chunk'], entry['slot'] + 1)
+        # continue filling the last chunk of every shape
+        for key, (chunk, used) in filled.items():
+            if used < self.chunk_frames:
+                memmap = np.load(self._chunk_path(chunk), mmap_mode='r')
+                if memmap.shape[0] == self.chunk_frames:
+                    self._writers[key] = [chunk, self._open_chunk(chunk), memmap.offset, used]
+
+    def close(self):
+        if self.worker is not None:
+            self.worker.flush()
+        with self._lock:
+            for writer in self._writers.values():
+                os.close(writer[1])
+            self._writers.clear()
+            self._readers.clear()
+            if not self._index.closed:
+                self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def flush(self):
+        r'''Write the chunks and the index to disk.'''
+        if self._index.closed:
+            return
+        self._submit(self._index.flush)
+        if self.worker is not None:
+            self.worker.flush()
+        with self._lock:
+            for writer in self._writers.values():
+                os.fsync(writer[1])
+            os.fsync(self._index.fileno())
+
+    # writing
+
+    def append(self, data, **metadata):
+        r'''
+        Archive data (any shape) with JSON serializable metadata, returns the frame id.
+        A native, contiguous array is written straight from its buffer and made read-only,
+        it must not change until written.
+        '''
+        array = np.asarray(data)
+        data = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('='))
+        if self.worker is not None:
+            data.flags.writeable = False
+            if np.may_share_memory(array, data):
+                array.flags.writeable = False
+        key = (data.shape, data.dtype.str)
+        with self._lock:
+            writer = self._writers.get(key)
+            if writer is None or writer[3] == self.chunk_frames:
+                if writer is not None:
+                    self._submit(os.close, writer[1])
+                chunk = self.next_chunk
+                self.next_chunk += 1
+                path = self._chunk_path(chunk)
+                # a sparse file with the .npy header, the frames are written in place
+                memmap = np.lib.format.open_memmap(path, mode='w+', dtype=data.dtype,
+                                                   shape=(self.chunk_frames,) + data.shape)
+                offset = memmap.offset
+                del memmap
+                writer = self._writers[key] = [chunk, self._open_chunk(chunk), offset, 0]
+            chunk, fd, offset, slot = writer
+            writer[3] += 1
+            entry = dict(metadata, id=len(self.entries), chunk=chunk, slot=slot, shape=list(data.shape),
+                         dtype=data.dtype.str)
+            entry.setdefault('time', time.time())
+            # indexed after the frame is written: the index never lists a frame which is not on disk
+            index = functools.partial(self._index.write, json.dumps(entry) + '\n')
+            if self.worker is None:
+                write_at(fd, [memoryview(data).cast('B')], offset + slot * data.nbytes)
+                index()
+            else:
+                self.worker.write(fd, data, offset + slot * data.nbytes, then=index)
+            self.entries.append(entry)
+            return entry['id']
+
+    # reading
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _chunk(self, chunk):
+        memmap = self._readers.get(chunk)
+        if memmap is None:
+            memmap = self._readers[chunk] = np.load(self._chunk_path(chunk), mmap_mode='r')
+            if len(self._readers) > self.open_chunks:
+                self._readers.popitem(last=False)
+        else:
+            self._readers.move_to_end(chunk)
+        return memmap
+
+    def __getitem__(self, frame_id):
+        r'''Read-only view on the frame, loaded from disk on access.'''
+        entry = self.entries[frame_id]
+        if self.worker is not None:
+            self.worker.flush()
+        with self._lock:
+            return self._chunk(entry['chunk'])[entry['slot']]
+
+    def metadata(self, frame_id):
+        return self.entries[frame_id]
+
+    def select(self, **criteria):
+        r'''
+        Ids of the frames whose metadata match every criterion, a value to compare with
+        or a predicate, e.g. select(channel='Z (m)', time=lambda t: t > start).
+        '''
+        def match(entry):
+            for key, expected in criteria.items():
+                if key not in entry:
+                    return False
+                value = entry[key]
+                if callable(expected):
+                    if not expected(value):
+                        return False
+                elif value != expected:
+                    return False
+            return True
+        return [entry['id'] for entry in self.entries if match(entry)]
+
+    def frames(self, frame_ids=None):
+        r'''Lazily yields (id, view) of the frames, all of them by default.'''
+        for frame_id in range(len(self.entries)) if frame_ids is None else frame_ids:
+            yield frame_id, self[frame_id]
+
+    def load(self, frame_ids):
+        r'''Copy of the frames (of one shape) stacked along a new first axis.'''
+        frame_ids = list(frame_ids)
+        if not frame_ids:
+            return np.empty((0,))
+        first = self.entries[frame_ids[0]]
+        out = np.empty((len(frame_ids),) + tuple(first['shape']), dtype=np.dtype(first['dtype']))
+        for i, frame_id in enumerate(frame_ids):
+            out[i] = self[frame_id]
+        return out
@@ -5,9 +5,15 @@ TCP/IP connection.
 '''
 
 import socket
+import logging
 import atexit
+import contextvars
 import struct
+import time
 import _thread as thread
+from collections import namedtuple
+
+from quantity import QuantityError, SI_PREFIXES, parse_quantity
 
 # Defines data types and their sizes in bytes
 datatype_dict = {'int':'>i', \
@@ -23,20 +29,44 @@ datasize_dict = {'int':4, \
                  'float64':8 \
                 }
 
-si_prefix = {'':1.0, \
-             'a':1e-18, \
-             'f':1e-15, \
-             'p':1e-12, \
-             'n':1e-9, \
-             'u':1e-6, \
-             'm':1e-3 \
-            }
+si_prefix = SI_PREFIXES
 
 class nanonisException(Exception):
     def __init__(self, message, code=0):
         super(nanonisException, self).__init__(message)
         self.code = code
 
+class ConnectionLost(nanonisException):
+    r'''
+    The connection to Nanonis broke or its framing is out of sync.
+    '''
+    pass
+
+class CommandTimeout(ConnectionLost):
+    r'''
+    No response within the timeout of the command. The connection is closed,
+    a late response would put its framing out of sync.
+    '''
+    pass
+
+class Cancelled(nanonisException):
+    r'''
+    The deadline of the running operation passed or it was cancelled (see deadline.Deadline).
+    '''
+    pass
+
+# The deadline.Deadline of the operation running on each thread (and asyncio task, see async_core).
+_deadline = contextvars.ContextVar('deadline', default = None)
+
+def current_deadline():
+    return _deadline.get()
+
+def set_deadline(deadline):
+    r'''Make deadline (or None) the current one of the thread, returns the previous one.'''
+    previous = _deadline.get()
+    _deadline.set(deadline)
+    return previous
+
 def decode_hex_from_string(input_string):
     r'''
     Converts a ([A-Fa-f0-9]{2})* string to a sequence of bytes
@@ -103,6 +133,378 @@ def construct_command(command_name, *vargs):
     header = construct_header(command_name, body_size)
     return header + body
 
+class CommandCodec:
+
+    r'''
+    A command compiled once into struct packers.
+
+    The 40 byte header is prebuilt because the body size of a command with
+    fixed-size arguments never changes. The unpacker reads the returned values
+    followed by the error status and the error size in a single call.
+
+    Args:
+        command_name : str
+        args : tuple of data type names of the arguments
+        returns : tuple of data type names of the returned values
+        result : optional callable (e.g. a namedtuple) applied to the returned values
+    '''
+
+    def __init__(self, command_name, args = (), returns = (), result = None):
+        self.command_name = command_name
+        self.args = tuple(args)
+        self.returns = tuple(returns)
+        self.result = result
+        try:
+            self.packer = struct.Struct('>' + ''.join(datatype_dict[arg][1:] for arg in self.args))
+            self.unpacker = struct.Struct('>' + ''.join(datatype_dict[ret][1:] for ret in self.returns) + 'Ii')
+            self.status = struct.Struct('>I')
+        except KeyError as e:
+            raise nanonisException('Unknown Data Type: ' + str(e))
+        self.header = construct_header(command_name, self.packer.size)
+
+    def encode(self, *values):
+        return self.header + self.packer.pack(*values)
+
+    def decode(self, body):
+        r'''
+        Unpack the values of a response body (bytes or memoryview) and check the error fields.
+        Returns a tuple of the values, without the error status and size.
+        '''
+        if len(body) < self.unpacker.size:
+            raise nanonisException('Response parse error: ' + self.command_name + \
+                                   ', body_size = ' + str(len(body)))
+        values = self.unpacker.unpack_from(body)
+        if len(body) != self.unpacker.size + values[-1]:
+            raise nanonisException('Response parse error: ' + self.command_name + \
+                                   ', body_size = ' + str(len(body)))
+        return values[:-2]
+
+    def error_status(self, body):
+        r'''The error status of a response body accepted by decode, 0 when the command succeeded.'''
+        return self.status.unpack_from(body, self.unpacker.size - 8)[0]
+
+    def shape(self, values):
+        r'''
+        Turn decoded values into what the getter returns:
+        None, a single value, the result type or a plain tuple.
+        '''
+        if self.result is not None:
+            return self.result(*values)
+        if len(values) == 1:
+            return values[0]
+        if len(values) == 0:
+            return None
+        return values
+
+command_registry = {}
+
+# Commands which can be sent again after the connection broke before they were answered (see retry.py).
+idempotent_commands = set()
+
+def register_command(command_name, args = (), returns = (), result = None, idempotent = None):
+    r'''
+    Add a command with fixed-size arguments and return values to the registry.
+    idempotent defaults to True for the getters (names ending with Get).
+    '''
+    codec = CommandCodec(command_name, args, returns, result)
+    command_registry[command_name] = codec
+    if idempotent is None:
+        idempotent = command_name.endswith('Get')
+    if idempotent:
+        idempotent_commands.add(command_name)
+    else:
+        idempotent_commands.discard(command_name)
+    return codec
+
+def is_idempotent(command_name):
+    r'''
+    True if sending command_name twice has the same effect as sending it once,
+    which is assumed for every getter.
+    '''
+    return command_name in idempotent_commands or command_name.endswith('Get')
+
+def get_codec(command_name):
+    try:
+        return command_registry[command_name]
+    except KeyError:
+        raise nanonisException('Unregistered command: ' + str(command_name))
+
+TipXY = namedtuple('TipXY', ['X', 'Y'])
+ZGain = namedtuple('ZGain', ['P', 'T', 'I'])
+ZLimits = namedtuple('ZLimits', ['high', 'low'])
+PiezoRange = namedtuple('PiezoRange', ['x', 'y', 'z'])
+
+register_command('Bias.Set', ('float32',), idempotent = True)
+register_command('Bias.Get', (), ('float32',))
+register_command('Bias.Pulse', ('uint32', 'float32', 'float32', 'uint16', 'uint16'))
+register_command('FolMe.XYPosSet', ('float64', 'float64', 'uint32'), idempotent = True)
+register_command('FolMe.XYPosGet', ('uint32',), ('float64', 'float64'), TipXY)
+register_command('ZCtrl.ZPosSet', ('float32',))
+register_command('ZCtrl.ZPosGet', (), ('float32',))
+register_command('ZCtrl.OnOffSet', ('uint32',), idempotent = True)
+register_command('ZCtrl.OnOffGet', (), ('uint32',))
+register_command('ZCtrl.Withdraw', ('uint32', 'int'))
+register_command('ZCtrl.Home')
+register_command('ZCtrl.SetpntSet', ('float32',), idempotent = True)
+register_command('ZCtrl.SetpntGet', (), ('float32',))
+register_command('ZCtrl.GainSet', ('float32', 'float32', 'float32'), idempotent = True)
+register_command('ZCtrl.GainGet', (), ('float32', 'float32', 'float32'), ZGain)
+register_command('ZCtrl.LimitsGet', (), ('float32', 'float32'), ZLimits)
+register_command('Current.Get', (), ('float32',))
+register_command('Motor.StartMove', ('uint32', 'uint16', 'uint32', 'uint32'))
+register_command('AutoApproach.Open')
+register_command('AutoApproach.OnOffSet', ('uint16',))
+register_command('AutoApproach.OnOffGet', (), ('uint16',))
+register_command('PLL.OutOnOffSet', ('int', 'uint32'), idempotent = True)
+register_command('PLL.AmpCtrlOnOffSet', ('int', 'uint32'), idempotent = True)
+register_command('PLL.PhasCtrlOnOffSet', ('int', 'uint32'), idempotent = True)
+register_command('PLL.FreqShiftGet', ('int',), ('float32',))
+register_command('Piezo.RangeGet', (), ('float32', 'float32', 'float32'), PiezoRange)
+register_command('Scan.Action', ('uint16', 'uint32'))
+register_command('Scan.StatusGet', (), ('uint32',))
+register_command('Scan.FrameSet', ('float32', 'float32', 'float32', 'float32', 'float32'), idempotent = True)
+register_command('Signals.ValGet', ('int', 'uint32'), ('float32',))
+register_command('UserOut.ModeSet', ('int', 'uint16'), idempotent = True)
+register_command('UserOut.ValSet', ('int', 'float32'))
+register_command('TipShaper.PropsSet', ('float32', 'uint32', 'float32', 'float32', 'float32', 'float32',
+                                        'float32', 'float32', 'float32', 'float32', 'uint32'))
+# Read-only, with a variable-size response sent by send().
+idempotent_commands.add('Scan.FrameDataGrab')
+
+class NanonisConnection:
+
+    r'''
+    A TCP connection to Nanonis which reads whole length-prefixed frames.
+
+    Every response starts with a 40 byte header whose bytes 32:36 hold the
+    size of the body. The header is read first, then exactly body_size bytes
+    are read with recv_into, however the reply is split by the network.
+    The receive buffer is kept per connection and only grows, so large frames
+    such as Scan.FrameDataGrab do not allocate a new buffer on every call.
+
+    A connection whose exchange was interrupted (timeout, cancellation) is
+    dead: what is left of the response would be read as the next one.
+    '''
+
+    HEADER_SIZE = 40
+
+    def __init__(self, IP = '127.0.0.1', PORT = 6501, buffer_size = 4096, connect_timeout = 10.):
+        self.address = (IP, PORT)
+        self.connect_timeout = connect_timeout
+        self.timeout = None
+        self.dead = False
+        self.socket = self._connect()
+        self.buffer = bytearray(max(buffer_size, self.HEADER_SIZE))
+
+    def _connect(self):
+        sock = socket.create_connection(self.address, self.connect_timeout)
+        sock.settimeout(self.timeout)
+        return sock
+
+    def close(self):
+        self.socket.close()
+
+    def kill(self):
+        r'''
+        Close a connection left out of sync, the next command reconnects.
+        '''
+        self.dead = True
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+
+    def reconnect(self):
+        r'''
+        Replace the socket by a new connection to the same address, which also resyncs the framing.
+        '''
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+        self.socket = self._connect()
+        self.dead = False
+
+    def settimeout(self, timeout):
+        r'''Timeout (s) of every send and receive, None blocks forever.'''
+        if timeout != self.timeout:
+            self.socket.settimeout(timeout)
+            self.timeout = timeout
+
+    def sendall(self, message):
+        self.socket.sendall(message)
+
+    def recv_into_exactly(self, view):
+        r'''
+        Fill the writable memoryview completely from the socket.
+        '''
+        while len(view):
+            received = self.socket.recv_into(view)
+            if received == 0:
+                raise ConnectionLost('Connection closed by Nanonis')
+            view = view[received:]
+
+    def recv_frame(self):
+        r'''
+        Receive one response frame (header + body).
+
+        Returns a memoryview on the connection buffer, which is only valid until the next call.
+        '''
+        header_size = self.HEADER_SIZE
+        self.recv_into_exactly(memoryview(self.buffer)[:header_size])
+        body_size = from_binary('int', self.buffer[32:36])
+        if body_size < 0:
+            raise ConnectionLost('Response body size error: ' + str(body_size))
+        frame_size = header_size + body_size
+        if frame_size > len(self.buffer):
+            # Grow to a new buffer, views handed out earlier keep the old one alive
+            buffer = bytearray(max(frame_size, 2 * len(self.buffer)))
+            buffer[:header_size] = self.buffer[:header_size]
+            self.buffer = buffer
+        view = memoryview(self.buffer)
+        self.recv_into_exactly(view[header_size:frame_size])
+        return view[:frame_size]
+
+    def exchange(self, message):
+        r'''
+        Send one command and receive its response frame.
+        '''
+        self.sendall(message)
+        return self.recv_frame()
+
+class BatchResult:
+
+    r'''
+    Placeholder for the result of a command queued in a CommandBatch.
+    The value is available once the batch has been flushed.
+    '''
+
+    def __init__(self, command_name):
+        self.command_name = command_name
+        self.done = False
+        self._value = None
+
+    def set(self, value):
+        self._value = value
+        self.done = True
+
+    @property
+    def value(self):
+        if not self.done:
+            raise nanonisException('Batch not flushed yet: ' + self.command_name)
+        return self._value
+
+class CommandBatch:
+
+    r'''
+    Pipelines several commands over one socket round-trip.
+
+    The encoded commands are written back-to-back, then the responses are
+    read in the same order and matched to the BatchResult of each call.
+    Nanonis answers the commands of one connection in order.
+
+    Usage:
+        with nanonis.batch() as batch:
+            z = batch.query('ZCtrl.ZPosGet')
+            limits = batch.query('ZCtrl.LimitsGet')
+        z.value, limits.value
+    '''
+
+    def __init__(self, interface):
+        self.interface = interface
+        self.calls = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def query(self, command_name, *args):
+        r'''
+        Queue a registered command, the value is decoded like nanonis_programming_interface.query.
+        Cached parameters are answered at once without being sent.
+        '''
+        codec = get_codec(command_name)
+        result = BatchResult(command_name)
+        params = self.interface.params
+        if params is not None and params.cacheable(command_name):
+            hit, value = params.lookup(command_name, args)
+            if hit:
+                result.set(value)
+                return result
+        self.calls.append((command_name, codec.encode(*args), codec, result, args))
+        return result
+
+    def send(self, command_name, *vargs):
+        r'''Queue any command, the value is the response dictionary of nanonis_programming_interface.send.'''
+        result = BatchResult(command_name)
+        self.calls.append((command_name, construct_command(command_name, *vargs), None, result, None))
+        return result
+
+    def flush(self):
+        calls, self.calls = self.calls, []
+        # Commands routed to different connections are pipelined per connection.
+        groups = {}
+        for call in calls:
+            connection, lock = self.interface.route(call[0])
+            groups.setdefault(id(connection), (connection, lock, []))[2].append(call)
+        error = None
+        deadline = current_deadline()
+        for connection, lock, group in groups.values():
+            self.interface.acquire(lock, group[0][0])
+            try:
+                attempt = 0
+                while group:
+                    answered = 0
+                    self.interface.prepare(connection, [call[0] for call in group], deadline)
+                    start = time.perf_counter()
+                    try:
+                        connection.sendall(b''.join(call[1] for call in group))
+                        # Always read every response so the framing stays in sync, even if one fails to decode.
+                        for command_name, message, codec, result, args in group:
+                            response = connection.recv_frame()
+                            if response[:32] != message[:32]:
+                                raise ConnectionLost('Out of sync: batch sent {}, received a response to {}'.format(
+                                    command_name, from_binary('string', bytes(response[:32])).rstrip('\0')))
+                            answered += 1
+                            received = len(response)
+                            try:
+                                if codec is None:
+                                    result.set({'command_name':from_binary('string', bytes(response[:32])), \
+                                                'body_size':len(response) - 40, \
+                                                'body':bytes(response[40:]) \
+                                               })
+                                else:
+                                    result.set(codec.shape(codec.decode(response[40:])))
+                                    if codec.error_status(response[40:]):
+                                        args = None
+                            except nanonisException as e:
+                                if error is None:
+                                    error = e
+                                self.interface.recorded(command_name, start, len(message), received, None, e)
+                                continue
+                            self.interface.cached(command_name, args, result.value)
+                            self.interface.recorded(command_name, start, len(message), received, result.value)
+                        group = []
+                    except socket.timeout:
+                        group = group[answered:]
+                        self.interface.timed_out(connection, [call[0] for call in group], attempt, deadline)
+                        attempt += 1
+                    except (OSError, ConnectionLost) as e:
+                        # the answered calls are done, the others are sent again if the retry policy allows it
+                        group = group[answered:]
+                        self.interface.recover(connection, [call[0] for call in group], attempt, e)
+                        attempt += 1
+                    except BaseException:
+                        connection.kill()
+                        raise
+            finally:
+                lock.release()
+        if error is not None:
+            raise error
+
 class nanonis_programming_interface:
 
     r'''
@@ -117,6 +519,10 @@ class nanonis_programming_interface:
             Defaults to 6501.
             Nanonis can only serve one client per port. If a port is being used, use 6502, 6503, or 6504.
             If multiple clients connect to Nanonis, Nanonis will silently ignore the second or later connections.
+        command_timeout : float
+            Seconds to wait for the response to a command, None waits forever.
+            Defaults to 10. Commands which block until Nanonis is done (see command_timeouts)
+            are only limited by the deadline of the running operation.
     
     Attributes:
         BiasLimit : float (defaults to 10)
@@ -134,6 +540,8 @@ class nanonis_programming_interface:
 
     Methods:
         send(command_name, *vargs)
+        query(command_name, *args)
+        batch()
         BiasSet(bias)
         BiasGet()
         TipXYSet(X, Y, wait = 1)
@@ -149,13 +557,34 @@ class nanonis_programming_interface:
         CurrentGet()
     '''
     
-    def __init__(self, IP = '127.0.0.1', PORT = 6501):
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((IP, PORT))
+    # Parameter cache consulted by query, execute and batch (see param_cache.ParameterCache), None disables it.
+    params = None
+    # Recorder of every command sent (see telemetry.TelemetryRecorder), None disables it.
+    telemetry = None
+    # Latency profiler (see profiler.Profiler), None disables it.
+    profiler = None
+    # Archive of the grabbed scan frames (see frame_archive.FrameArchive), None disables it.
+    archive = None
+    # Background writer of the archive and the telemetry (see io_worker.IOWorker), flushed on close.
+    io = None
+    # Reconnect and retry on broken connections (see retry.RetryPolicy), None lets the errors through.
+    retry = None
+    # Response timeouts (s) overriding command_timeout, None waits as long as the deadline allows.
+    command_timeouts = {
+        'Scan.WaitEndOfScan': None,
+        'ZCtrl.Withdraw': None,
+        'Motor.StartMove': None,
+        'Bias.Pulse': None,
+        # with wait = 1 the response only comes once the tip got there
+        'FolMe.XYPosSet': None,
+    }
+
+    def __init__(self, IP = '127.0.0.1', PORT = 6501, command_timeout = 10.):
+        self.command_timeout = command_timeout
+        self.connection = NanonisConnection(IP, PORT)
+        self.socket = self.connection.socket
         self.lock = thread.allocate_lock()
 
-        self.regex = None
-        
         # Parameter limits in SI units (without prefixes, usually an SI base unit)
         self.BiasLimit = 10
         self.XScannerLimit = 1e-6
@@ -170,18 +599,173 @@ class nanonis_programming_interface:
             self.close()
 
     def close(self):
-        self.socket.close()
+        self.connection.close()
+        if self.telemetry is not None:
+            self.telemetry.close()
+        if self.archive is not None:
+            self.archive.close()
+        if self.io is not None:
+            self.io.close()
+
+    def route(self, command_name):
+        r'''
+        Returns the (connection, lock) pair the command is sent over.
+        There is only one connection here, see pool.PooledNanonisController for several.
+        '''
+        return self.connection, self.lock
 
-    def transmit(self, message):
+    def transmit(self, message, connection = None):
         '''
-        sometimes the buffer should be bigger
+        Send a message and return the whole response frame.
+        The returned memoryview is only valid until the next transmit on the same connection.
         '''
-        self.socket.sendall(message)
-        data = self.socket.recv(1024)
-        body_size = from_binary('int', data[32:36])
-        if body_size > 1024 - 40:
-            data += self.socket.recv(body_size - 1024 + 40)
-        return data
+        if connection is None:
+            connection = self.connection
+        return connection.exchange(message)
+
+    def exchange(self, command_name, message, connection):
+        r'''
+        transmit with recovery: the response must echo the command name, otherwise the framing is out of sync.
+        A broken connection is reopened and command_name sent again if the retry policy allows it.
+        Called with the lock of the connection held.
+        '''
+        deadline = current_deadline()
+        attempt = 0
+        while True:
+            self.prepare(connection, (command_name,), deadline)
+            try:
+                response = self.transmit(message, connection)
+                if response[:32] != message[:32]:
+                    raise ConnectionLost('Out of sync: sent {}, received a response to {}'.format(
+                        command_name, from_binary('string', bytes(response[:32])).rstrip('\0')))
+                return response
+            except socket.timeout:
+                self.timed_out(connection, (command_name,), attempt, deadline)
+                attempt += 1
+            except (OSError, ConnectionLost) as e:
+                self.recover(connection, (command_name,), attempt, e)
+                attempt += 1
+            except BaseException:
+                # e.g. KeyboardInterrupt halfway through the response
+                connection.kill()
+                raise
+
+    def server_timeout(self, timeout):
+        r'''
+        timeout (ms) of a command which Nanonis times out itself, -1 (infinite) included, cut to the time left
+        of the deadline minus a margin, so that Nanonis answers before the socket times out.
+        Returns (timeout, deadline): deadline is the one which cut timeout short, None if it did not.
+        When Nanonis then times out, the caller must raise (see deadline.Deadline.cut) instead of
+        going on as if the wait had ended.
+        '''
+        deadline = current_deadline()
+        remaining = None if deadline is None else deadline.remaining()
+        if remaining is None:
+            return timeout, None
+        limit = max(int((remaining - 0.5) * 1000), 1)
+        if 0 <= timeout <= limit:
+            return timeout, None
+        return limit, deadline
+
+    def timeout_of(self, command_name):
+        return self.command_timeouts.get(command_name, self.command_timeout)
+
+    def acquire(self, lock, command_name):
+        r'''
+        Take the lock of a connection, giving up with Cancelled when the deadline of the thread passes
+        while another thread holds it.
+        '''
+        deadline = current_deadline()
+        if deadline is None:
+            lock.acquire()
+            return
+        while True:
+            deadline.check(command_name)
+            if lock.acquire(timeout = 0.1):
+                return
+
+    def prepare(self, connection, command_names, deadline):
+        r'''
+        Before sending command_names: check the deadline, reopen a dead connection and set
+        the socket timeout to the longest of theirs, cut to the time left. Called with the lock held.
+        '''
+        if deadline is not None:
+            deadline.check(command_names[0])
+        if connection.dead:
+            self.reconnect(connection)
+        timeouts = [self.timeout_of(name) for name in command_names]
+        timeout = None if None in timeouts else max(timeouts)
+        if deadline is not None:
+            timeout = deadline.limit(timeout)
+        # 0 would make the socket non-blocking
+        connection.settimeout(None if timeout is None else max(timeout, 1e-3))
+
+    def timed_out(self, connection, command_names, attempt, deadline):
+        r'''
+        Handle a response which did not come in time: the connection is out of sync and closed, then
+        Cancelled is raised if the deadline passed, otherwise it is recovered from like a broken connection.
+        '''
+        connection.kill()
+        if deadline is not None:
+            deadline.check(command_names[0])
+        self.recover(connection, command_names, attempt, CommandTimeout(
+            'No response to {} within {} s'.format(', '.join(command_names), connection.timeout)))
+
+    def recover(self, connection, command_names, attempt, error):
+        r'''
+        Handle the error which broke connection while command_names were unanswered: reopen the connection,
+        then return if they may be sent again (attempt is the number of retries so far), raise otherwise.
+        Without a retry policy the error itself is raised, the next command reopens the connection.
+        '''
+        retry = self.retry
+        if retry is None:
+            connection.kill()
+            raise error
+        if isinstance(error, CommandTimeout):
+            retry.count('timeouts')
+        else:
+            retry.count('desyncs' if 'Out of sync' in str(error) else 'lost')
+        self.reconnect(connection, error)
+        refused = [name for name in command_names if not is_idempotent(name)]
+        if refused or attempt >= retry.retries:
+            retry.count('not_retried')
+            reason = 'not idempotent' if refused else 'retried {} times'.format(attempt)
+            raise ConnectionLost('{} not sent again ({}) after the connection broke: {}'.format(
+                ', '.join(refused or command_names), reason, error)) from error
+        for name in command_names:
+            retry.count('retries', name)
+        logging.warning('Sending {} again after the connection broke: {}'.format(', '.join(command_names), error))
+
+    def reconnect(self, connection, cause = None):
+        r'''
+        Reopen connection in place, with the backoff of the retry policy. Called with its lock held.
+        The ConnectionLost raised when it cannot be reopened is chained to cause, the error which broke
+        the connection (to the last failed attempt without one).
+        '''
+        retry = self.retry
+        deadline = current_deadline()
+        attempts = 1 if retry is None else retry.reconnect_attempts
+        for attempt in range(attempts):
+            if retry is not None:
+                if deadline is None:
+                    time.sleep(retry.delay(attempt))
+                else:
+                    deadline.sleep(retry.delay(attempt), 'reconnect')
+            try:
+                connection.reconnect()
+            except OSError as e:
+                error = e
+                continue
+            if connection is self.connection:
+                self.socket = connection.socket
+            if retry is not None:
+                retry.count('reconnects')
+            logging.warning('Reconnected to Nanonis at {}:{}'.format(*connection.address))
+            return
+        if retry is not None:
+            retry.count('reconnect_failures')
+        raise ConnectionLost('Could not reconnect to Nanonis at {}:{} after {} attempts: {}'.format(
+            connection.address[0], connection.address[1], attempts, error)) from (error if cause is None else cause)
 
 
     def send(self, command_name, *vargs):
@@ -193,32 +777,105 @@ class nanonis_programming_interface:
         The following arguments come in pairs: a string specifying the data type, the value of the data.
         '''
 
+        message = construct_command(command_name, *vargs)
+        connection, lock = self.route(command_name)
+        start = time.perf_counter()
+        # Acquire an atomic lock to prevent receiving a response that is unrelated to the request.
+        self.acquire(lock, command_name)
         try:
-            # Acquire an atomic lock to prevent receiving a response that is unrelated to the request.
-            # This is actually unnecessary right now since there are no features that use concurrency.
-            self.lock.acquire()
-
-            response = self.transmit(construct_command(command_name, *vargs))
-            returned_command = from_binary('string', response[:32])
+            response = self.exchange(command_name, message, connection)
+            returned_command = from_binary('string', bytes(response[:32]))
             body_size = from_binary('int', response[32:36])
-            body = response[40:]
-
-            # Check to make sure the body size actually matches the body size specified in the response header.
-            if body_size != len(body):
-                errorMessage = 'Response body size error: ' + \
-                                returned_command + ', ' + \
-                                str(body_size) + ', ' + \
-                                from_binary('string', body)
-                raise nanonisException(errorMessage)
-        except:
+            # Copy the body out of the connection buffer before releasing the lock.
+            body = bytes(response[40:])
+        except Exception as e:
+            self.recorded(command_name, start, len(message), 0, None, e)
             raise
         finally:
-            self.lock.release() # Release lock
-        return {'command_name':returned_command, \
-                'body_size':body_size, \
-                'body':body \
-                }
+            lock.release() # Release lock
+        self.cached(command_name, None, None)
+        result = {'command_name':returned_command, \
+                  'body_size':body_size, \
+                  'body':body \
+                 }
+        self.recorded(command_name, start, len(message), body_size + 40, result)
+        return result
     
+    def query(self, command_name, *args):
+
+        r'''
+        Send a registered command and return its decoded result.
+
+        The command is encoded and decoded by its precompiled CommandCodec,
+        the values are read straight from the connection buffer.
+        '''
+
+        return self.execute(get_codec(command_name), *args)
+
+    def execute(self, codec, *args):
+
+        r'''
+        Send a command with the given CommandCodec, which does not need to be registered
+        (e.g. a codec compiled for a fixed number of array elements).
+        '''
+
+        params = self.params
+        if params is not None and params.cacheable(codec.command_name):
+            hit, value = params.lookup(codec.command_name, args)
+            if hit:
+                return value
+        message = codec.encode(*args)
+        connection, lock = self.route(codec.command_name)
+        start = time.perf_counter()
+        self.acquire(lock, codec.command_name)
+        try:
+            response = self.exchange(codec.command_name, message, connection)
+            received = len(response)
+            values = codec.decode(response[40:])
+            failed = codec.error_status(response[40:])
+        except Exception as e:
+            self.recorded(codec.command_name, start, len(message), 0, None, e)
+            raise
+        finally:
+            lock.release()
+        value = codec.shape(values)
+        self.cached(codec.command_name, None if failed else args, value)
+        self.recorded(codec.command_name, start, len(message), received, value)
+        return value
+
+    def cached(self, command_name, args, value):
+        r'''
+        Update the parameter cache after command_name was answered: store the value of a cached getter,
+        write the arguments of a setter through (args is None when they are not known, or when Nanonis
+        returned an error status: nothing is stored and the getters a setter changes are invalidated).
+        '''
+        params = self.params
+        if params is None:
+            return
+        if params.cacheable(command_name):
+            if args is not None:
+                params.store(command_name, args, value)
+        else:
+            params.written(command_name, args)
+
+    def recorded(self, command_name, start, sent, received, result, error = None):
+        r'''
+        Pass a finished command to the telemetry recorder and the profiler. start is the time.perf_counter() before sending,
+        sent and received are the sizes of the frames in bytes.
+        '''
+        telemetry, profiler = self.telemetry, self.profiler
+        if telemetry is None and profiler is None:
+            return
+        latency = time.perf_counter() - start
+        if telemetry is not None:
+            telemetry.command(command_name, time.time() - latency, latency, sent, received, result, error)
+        if profiler is not None:
+            profiler.command(command_name, latency)
+
+    def batch(self):
+        r'''Returns a CommandBatch which sends its commands in one round-trip.'''
+        return CommandBatch(self)
+
     @staticmethod
     def parse_response(response, *vargs):
 
@@ -257,7 +914,8 @@ class nanonis_programming_interface:
     def convert(self, input_data):
 
         r'''
-        Converts a number followed by an SI prefix into number * 10^{prefix exponent}
+        Converts a number followed by an SI prefix into number * 10^{prefix exponent},
+        see quantity.parse_quantity for the accepted forms ('-300p', '1e-9', '5nA', ...).
 
         Args:
             input_data : str
@@ -266,23 +924,10 @@ class nanonis_programming_interface:
             Float
         '''
 
-        if self.regex is None:
-            import re
-            self.regex = re.compile(r'^(-)?([0-9.]+)\s*([A-Za-z]*)$')
-        match = self.regex.match(input_data)
-        if match is None:
-            raise nanonisException('Malformed number: Not a correctly formatted number')
-        groups = match.groups()
-        if groups[0] is None:
-            sign = 1
-        elif groups[0] == '-':
-            sign = -1
-        else:
-            pass
         try:
-            return sign * float(groups[1]) * si_prefix[groups[2]]
-        except KeyError:
-            raise nanonisException('Malformed number: SI prefix not recognized')
+            return parse_quantity(input_data)
+        except QuantityError as e:
+            raise nanonisException(str(e))
     
     def BiasSet(self, bias):
 
@@ -301,13 +946,13 @@ class nanonis_programming_interface:
         else:
             bias_val = float(bias)
         if -self.BiasLimit <= bias_val <= self.BiasLimit:
-            self.send('Bias.Set', 'float32', bias_val)
+            self.query('Bias.Set', bias_val)
         else:
             raise nanonisException('Bias out of bounds')
     
     def BiasGet(self):
         r'''Get the bias (V).'''
-        return self.parse_response(self.send('Bias.Get'), 'float32')['0']
+        return self.query('Bias.Get')
 
     # Does not "scrub" wait parameter for invalid input.
     def TipXYSet(self, X, Y, wait = 1):
@@ -338,12 +983,11 @@ class nanonis_programming_interface:
             raise nanonisException('X out of bounds')
         if not (-self.YScannerLimit <= Y_val <= self.YScannerLimit):
             raise nanonisException('Y out of bounds')
-        self.send('FolMe.XYPosSet', 'float64', X_val, 'float64', Y_val, 'uint32', wait)
+        self.query('FolMe.XYPosSet', X_val, Y_val, wait)
 
     def TipXYGet(self, wait = 1):
-        r'''Returns a dictionary containing the X, Y tip coordinates (m).'''
-        parsedResponse = self.parse_response(self.send('FolMe.XYPosGet', 'uint32', wait), 'float64', 'float64')
-        return {'X': parsedResponse['0'], 'Y': parsedResponse['1']}
+        r'''Returns a TipXY named tuple containing the X, Y tip coordinates (m).'''
+        return self.query('FolMe.XYPosGet', wait)
 
     def TipZSet(self, Z):
 
@@ -363,12 +1007,11 @@ class nanonis_programming_interface:
             Z_val = float(Z)
         if not (-self.ZScannerLimit <= Z_val <= self.ZScannerLimit):
             raise nanonisException('Z out of bounds')
-        self.send('ZCtrl.ZPosSet', 'float32', Z_val)
+        self.query('ZCtrl.ZPosSet', Z_val)
 
     def TipZGet(self):
         r'''Get the Z tip height (m).'''
-        parsedResponse = self.parse_response(self.send('ZCtrl.ZPosGet'), 'float32')['0']
-        return parsedResponse
+        return self.query('ZCtrl.ZPosGet')
 
     def FeedbackOnOffSet(self, feedbackStatus):
 
@@ -400,11 +1043,11 @@ class nanonis_programming_interface:
                 raise nanonisException('Feedback On or Off?')
         else:
             raise nanonisException('Feedback On or Off?')
-        self.send('ZCtrl.OnOffSet', 'uint32', ZCtrlStatus)
+        self.query('ZCtrl.OnOffSet', ZCtrlStatus)
 
     def FeedbackOnOffGet(self):
         r'''Returns the Z-controller feedback status as a string ('On' or 'Off')'''
-        parsedResponse = self.parse_response(self.send('ZCtrl.OnOffGet'), 'uint32')['0']
+        parsedResponse = self.query('ZCtrl.OnOffGet')
         if parsedResponse == 1:
             return 'On'
         elif parsedResponse == 0:
@@ -417,13 +1060,19 @@ class nanonis_programming_interface:
         Turn off the feedback and fully withdraw the tip.
         
         By default, this method blocks until the tip is fully withdrawn or timeout (ms) is exceeded.
-        timeout = -1 is infinite timeout.
+        timeout = -1 is infinite timeout, or the time left of the deadline of the running operation:
+        if the tip is still withdrawing when it comes, Cancelled is raised.
         '''
-        self.send('ZCtrl.Withdraw', 'uint32', wait, 'int', timeout)
+        timeout, deadline = self.server_timeout(timeout)
+        start = time.monotonic()
+        self.query('ZCtrl.Withdraw', wait, timeout)
+        # the response does not tell whether Nanonis timed out, a wait as long as the timeout did
+        if deadline is not None and wait and time.monotonic() - start >= timeout / 1000:
+            deadline.cut('ZCtrl.Withdraw')
 
     def Home(self):
         r'''Turn off feedback and move the tip to the Home position.'''
-        self.send('ZCtrl.Home')
+        self.query('ZCtrl.Home')
 
     def SetpointSet(self, setpoint):
 
@@ -443,15 +1092,13 @@ class nanonis_programming_interface:
             setpoint_val = float(setpoint)
         if not (self.LowerSetpointLimit <= setpoint_val <= self.UpperSetpointLimit):
             raise nanonisException('Setpoint out of bounds')
-        self.send('ZCtrl.SetpntSet', 'float32', setpoint_val)
+        self.query('ZCtrl.SetpntSet', setpoint_val)
 
     def SetpointGet(self):
         r'''Get the setpoint value (usually the setpoint current (A))'''
-        parsedResponse = self.parse_response(self.send('ZCtrl.SetpntGet'), 'float32')['0']
-        return parsedResponse
+        return self.query('ZCtrl.SetpntGet')
 
     def CurrentGet(self):
         r'''Get the value of the current (A)'''
-        parsedResponse = self.parse_response(self.send('Current.Get'), 'float32')['0']
-        return parsedResponse
+        return self.query('Current.Get')
         
\ No newline at end of file
@@ -0,0 +1,254 @@
+# io_worker.py
+r'''
+Background thread for the disk I/O of a session.
+
+The control thread hands write jobs to an IOWorker and goes on with the
+next command; the worker thread does the writing. Buffers are handed
+over without a copy (the worker keeps a reference to the array or
+memoryview, so it must not be modified afterwards) and consecutive
+writes to adjacent offsets of one file are gathered into a single
+pwritev, so frames appended one by one reach the disk as large
+sequential writes.
+
+The queue is bounded in jobs and in bytes: when the disk cannot keep
+up, submit blocks until there is room again (backpressure) instead of
+growing without limit, and the time blocked is counted in stats().
+
+    worker = IOWorker().start()
+    worker.write(fd, frame, offset)
+    worker.call(index.write, line)
+    worker.every(5., telemetry.flush)
+    worker.flush()   # wait until everything submitted so far is written
+'''
+
+import collections
+import logging
+import os
+import threading
+import time
+
+from interface import nanonisException
+
+
+# buffers gathered by one pwritev at most
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+def write_at(fd, buffers, offset):
+    r'''
+    Write the memoryviews back to back at offset of the file descriptor fd, with one pwritev
+    where available. Windows has neither pwritev nor pwrite, there the caller must be the only
+    writer of fd (seek then write).
+    '''
+    if hasattr(os, 'pwritev') and len(buffers) > 1:
+        written = os.pwritev(fd, buffers, offset)
+        for i, buffer in enumerate(buffers):
+            if written < buffer.nbytes:
+                # short write, the rest buffer by buffer
+                buffers = [buffer[written:]] + buffers[i + 1:]
+                offset += written
+                break
+            written -= buffer.nbytes
+            offset += buffer.nbytes
+        else:
+            return
+    for buffer in buffers:
+        while buffer.nbytes:
+            if hasattr(os, 'pwrite'):
+                written = os.pwrite(fd, buffer, offset)
+            else:
+                os.lseek(fd, offset, os.SEEK_SET)
+                written = os.write(fd, buffer)
+            buffer = buffer[written:]
+            offset += written
+
+
+class IOWorker:
+
+    r'''
+    Args:
+        max_jobs : int
+            Jobs waiting in the queue at most.
+        max_bytes : int
+            Bytes of the buffers waiting in the queue at most.
+        batch_bytes : int
+            Bytes gathered into one write at most.
+    '''
+
+    def __init__(self, max_jobs=256, max_bytes=256 << 20, batch_bytes=16 << 20):
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self.batch_bytes = batch_bytes
+        self.jobs = collections.deque()  # ('write', fd, [buffers], offset, nbytes, [then]) or ('call', function, args)
+        self.pending_bytes = 0
+        self.periodic = []  # [interval, next time, function]
+        self.submitted = 0
+        self.done = 0
+        self.written = 0
+        self.writes = 0
+        self.errors = 0
+        self.stalls = 0
+        self.stalled = 0.  # seconds the submitters were blocked by backpressure
+        self._changed = threading.Condition()
+        self._closing = False
+        self._thread = None
+
+    def start(self):
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name='IOWorker', daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        r'''Write everything submitted, run the periodic jobs a last time and stop the thread.'''
+        with self._changed:
+            self._closing = True
+            self._changed.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for _, _, function in self.periodic:
+            self._execute(('call', function, ()))
+        self.periodic = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # submitting, from the control thread
+
+    def _submit(self, job, nbytes, timeout):
+        with self._changed:
+            if self._closing or self._thread is None:
+                # no thread to hand over to, write in place
+                inline = True
+            else:
+                inline = False
+                if len(self.jobs) >= self.max_jobs or (self.jobs and self.pending_bytes + nbytes > self.max_bytes):
+                    self.stalls += 1
+                    start = time.perf_counter()
+                    room = self._changed.wait_for(
+                        lambda: len(self.jobs) < self.max_jobs and
+                        (not self.jobs or self.pending_bytes + nbytes <= self.max_bytes), timeout)
+                    self.stalled += time.perf_counter() - start
+                    if not room:
+                        raise nanonisException('I/O queue still full after {} s'.format(timeout))
+                self.jobs.append(job)
+                self.pending_bytes += nbytes
+                self.submitted += 1
+                self._changed.notify_all()
+        if inline:
+            self._execute(job)
+
+    def write(self, fd, buffer, offset, then=None, timeout=None):
+        r'''
+        Write buffer (bytes, memoryview or contiguous array, not copied) at offset of the file descriptor fd,
+        then call then() if given (e.g. to index what was written). Unlike a call() job, then()
+        does not keep the write from being gathered with the next ones.
+        '''
+        view = memoryview(buffer).cast('B')
+        self._submit(('write', fd, [view], offset, view.nbytes, [] if then is None else [then]), view.nbytes, timeout)
+
+    def call(self, function, *args, timeout=None):
+        r'''Run function(*args) on the worker thread, after the jobs submitted before.'''
+        self._submit(('call', function, args), 0, timeout)
+
+    def every(self, interval, function):
+        r'''Run function() on the worker thread every interval seconds, and once more on close.'''
+        with self._changed:
+            self.periodic.append([interval, time.monotonic() + interval, function])
+            self._changed.notify_all()
+
+    def cancel(self, function):
+        with self._changed:
+            self.periodic = [task for task in self.periodic if task[2] is not function]
+
+    def flush(self, timeout=None):
+        r'''Wait until every job submitted so far is done.'''
+        if threading.current_thread() is self._thread:
+            return
+        with self._changed:
+            target = self.submitted
+            if not self._changed.wait_for(lambda: self.done >= target or self._thread is None, timeout):
+                raise nanonisException('I/O queue not flushed after {} s'.format(timeout))
+
+    def stats(self):
+        return {'submitted': self.submitted, 'pending': len(self.jobs), 'pending_bytes': self.pending_bytes,
+                'written': self.written, 'writes': self.writes, 'errors': self.errors,
+                'stalls': self.stalls, 'stalled': self.stalled}
+
+    # writing, on the worker thread
+
+    def _batch(self):
+        r'''Pop the next job, with the writes which continue it in the same file gathered into it.'''
+        job = self.jobs.popleft()
+        if job[0] != 'write':
+            return job, 1, 0
+        _, fd, buffers, offset, size, then = job
+        buffers, then = list(buffers), list(then)
+        count = 1
+        while self.jobs and len(buffers) < IOV_MAX:
+            following = self.jobs[0]
+            if following[0] != 'write' or following[1] != fd or following[3] != offset + size or \
+                    size + following[4] > self.batch_bytes:
+                break
+            self.jobs.popleft()
+            buffers.extend(following[2])
+            then.extend(following[5])
+            size += following[4]
+            count += 1
+        return ('write', fd, buffers, offset, size, then), count, size
+
+    def _execute(self, job):
+        try:
+            if job[0] == 'write':
+                _, fd, buffers, offset, size, then = job
+                write_at(fd, buffers, offset)
+                self.written += size
+                self.writes += 1
+                for function in then:
+                    function()
+            else:
+                job[1](*job[2])
+        except Exception as e:
+            self.errors += 1
+            logging.error('I/O job failed: {}'.format(e))
+
+    def _due(self):
+        now = time.monotonic()
+        due = []
+        for task in self.periodic:
+            if task[1] <= now:
+                task[1] = now + task[0]
+                due.append(task[2])
+        return due
+
+    def _next_tick(self):
+        if not self.periodic:
+            return None
+        return max(0., min(task[1] for task in self.periodic) - time.monotonic())
+
+    def _run(self):
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: self.jobs or self._closing, self._next_tick())
+                if not self.jobs and self._closing:
+                    self.done = self.submitted
+                    self._changed.notify_all()
+                    return
+                batch = self._batch() if self.jobs else None
+                due = self._due()
+            if batch is not None:
+                self._execute(batch[0])
+            for function in due:
+                self._execute(('call', function, ()))
+            with self._changed:
+                if batch is not None:
+                    self.done += batch[1]
+                    self.pending_bytes -= batch[2]
+                self._changed.notify_all()
@@ -1,8 +1,7 @@
 # BaisOperation.py by CoccaGuo at 2022/05/16 21:17
 
 import logging
-import time
-from core import ExceptionType, Operate
+from core import ExceptionType, Operate, Resource
 from interface import nanonisException
 
 
@@ -13,6 +12,8 @@ class MultiPulse(Operate):
           >0: do count times
     '''
 
+    resources = frozenset({Resource.BIAS, Resource.Z_CONTROLLER})
+
     def __init__(self, session, value, count=0, duration=2, tip_touched_current='5n'):
         super().__init__(session)
         self.value = self.session.try_convert(value)
@@ -25,7 +26,7 @@ class MultiPulse(Operate):
             self.session.ZCtrlOnOffSet()
             logging.warning('Z-control is off, turn on Z-control')
             self.session.WaitForZCtrlWork()
-            time.sleep(3)
+            self.session.WaitForZSettle(3)
             return True
         elif (self.count != 0):
             logging.warning('Manual pulse is not safe present, avoid to use.')
@@ -37,7 +38,7 @@ class MultiPulse(Operate):
         if self.count > 0:
             for i in range(self.count):
                 self.session.BiasPulse(self.value)
-                time.sleep(self.duration)
+                self.session.waiter.sleep(self.duration, 'pulse interval')
             logging.info('Pulse finished {} times at {:.1f} V'.format(
                 self.count, self.value))
             return self.count
@@ -51,11 +52,12 @@ class MultiPulse(Operate):
             z0 = s.TipZGet()
             s.BiasPulse(self.value)
             count += 1
-            time.sleep(0.2)  # wait for 200ms  to see the change on Z
-            z1 = s.TipZGet()
-            z_limits = s.ZLimitsGet()
-            z_max = z_limits['high']
-            z_min = z_limits['low']
+            s.waiter.sleep(0.2, 'pulse Z response')  # wait for 200ms  to see the change on Z
+            with s.batch() as batch:
+                z = batch.query('ZCtrl.ZPosGet')
+                z_limits = batch.query('ZCtrl.LimitsGet')
+            z1 = z.value
+            z_max, z_min = z_limits.value
             if abs(z_max-z1)/z_max < 0.01:  # if the tip is at the piezo top limit
                 _curr = abs(s.CurrentGet())
                 if _curr > self.tip_touched_current:  # tip touched the substrate
@@ -75,7 +77,7 @@ class MultiPulse(Operate):
             diff = z1 - z0
             if diff <= 0:
                 logging.info('Z-position not elevated, continue to pulse')
-                time.sleep(self.duration)
+                s.waiter.sleep(self.duration, 'pulse interval')
             else:
                 logging.info(
                     'Z-position elevated by {:.2e} m, stop'.format(diff))
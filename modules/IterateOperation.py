@@ -1,9 +1,9 @@
 # IterateOperation.py by CoccaGuo at 2022/05/17 14:18
 
 import logging
-import time
 from core import ExceptionType, NanonisController, Operate
 from interface import nanonisException
+from path_planner import grid_size, in_grid, plan, skip, spiral_walk, travel_distance
 
 
 class IterateOperation(Operate):
@@ -11,14 +11,15 @@ class IterateOperation(Operate):
     try to iterate a area to do something point by point.
     '''
 
-    def __init__(self, session: NanonisController, gridX='200n', gridY='200n', padding='20n', interval_time=1):
+    def __init__(self, session: NanonisController, gridX='200n', gridY='200n', padding='20n', interval_time=1,
+                 planner='spiral', blacklist=None, checkpoint=None, area=0):
         super().__init__(session)
         self.gridX = self.session.try_convert(gridX)
         self.gridY = self.session.try_convert(gridY)
         self.padding = self.session.try_convert(padding)
         ranges = self.session.PiezoRangeGet()
-        self.x_range = ranges['x']
-        self.y_range = ranges['y']
+        self.x_range = ranges.x
+        self.y_range = ranges.y
         self.x_max = int((self.x_range/2 - self.padding)//self.gridX)
         self.y_max = int((self.y_range/2 - self.padding)//self.gridY)
         self.x_recorder = 0
@@ -26,16 +27,27 @@ class IterateOperation(Operate):
         self.x = 0
         self.y = 0 # absolute position of the current point
         self.this = 0 # the processing point index
-        self.points = (min(self.x_max, self.y_max)*2 + 1) ** 2
+        # visiting order, see path_planner.PLANNERS
+        self.planner = planner
+        self.visited = set()
+        self.blacklist = set() if blacklist is None else set(blacklist)
+        in_range = in_grid(self.x_max, self.y_max)
+        self.points = grid_size(self.x_max, self.y_max) - sum(1 for cell in self.blacklist if in_range(cell))
         self.interval = interval_time
+        # durable progress (see checkpoint.Checkpoint): the points of this area already processed are skipped
+        self.checkpoint = checkpoint
+        self.area = area
+        if checkpoint is not None:
+            self.visited = checkpoint.visited(area)
+            self.this = len(self.visited)
         # use this to pass values during the iteration
         self.iter_cxt = {}
 
     def safety_check(self):
         # try to change the tip position at the center of the Z range
         z_limits = self.session.ZLimitsGet()
-        z_max = z_limits['high']
-        z_min = z_limits['low']
+        z_max = z_limits.high
+        z_min = z_limits.low
         while True:
             if not self.session.ZCtrlOnOffGet():
                 self.session.ZCtrlOnOffSet(True)  # turn on Z controller
@@ -55,7 +67,7 @@ class IterateOperation(Operate):
                 logging.info(
                     'Iterator Safety check passed, moving to area center.')
                 self.session.Home()
-                time.sleep(0.2)
+                self.session.waiter.sleep(0.2, 'home')
                 self.session.TipXYSet(0, 0)
                 return True
 
@@ -66,13 +78,13 @@ class IterateOperation(Operate):
         if abs(x) <= self.x_max and abs(y) <= self.y_max:
             self.x = x * self.gridX
             self.y = y * self.gridY
-            self.session.Home()
+            # straight from the previous point, the planner keeps the moves short
             n = self.session.to_nano
             logging.info('Moving to ({}, {})'.format(n(x*self.gridX), n(y*self.gridY)))
             self.session.TipXYSet(x*self.gridX, y*self.gridY)
             self.session.ZCtrlOnOffSet(True)
             self.session.WaitForZCtrlWork()
-            time.sleep(self.interval)
+            self.session.WaitForZSettle(self.interval)
             try:
                 self.session.ZLimitCheck()
                 self._task()
@@ -85,30 +97,31 @@ class IterateOperation(Operate):
                     self.session.Withdraw()
                     self.session.AutoApproachSet()
                 else: raise e
-            time.sleep(self.interval)
+            self.session.waiter.sleep(self.interval, 'iterate interval')
 
 
+    def progress(self):
+        '''
+        the adaptive parameters to save in the checkpoint after every point.
+        '''
+        return {}
+
+    def path(self):
+        '''
+        the cells (x, y) still to visit, in the order of the planner.
+        '''
+        return skip(plan(self.planner, self.x_max, self.y_max), self.visited, self.blacklist)
+
     def _operate(self):
-        logging.info('{} points to process in this area.'.format(self.points))
-        _x_directions = [1, 0, -1, 0]
-        _y_directions = [0, 1, 0, -1]
-        _direction_adder = 0
-        _length = 1
-        _line_indicator = 0
-        _length_add_flag = False
-        while self.this < self.points:
-            self._xy_move_and_do(self.x_recorder, self.y_recorder)
+        travel = travel_distance(self.path(), scale=(self.gridX, self.gridY))
+        logging.info('{} points to process in this area ({} planner, {} of travel).'.format(
+            self.points - len(self.visited), getattr(self.planner, '__name__', self.planner), self.session.to_nano(travel)))
+        for x, y in self.path():
+            self.x_recorder, self.y_recorder = x, y
+            self._xy_move_and_do(x, y)
+            self.visited.add((x, y))
             self.this += 1
+            if self.checkpoint is not None:
+                self.checkpoint.visit(self.area, (x, y), **self.progress())
             logging.info('{}/{} points processed.'.format(self.this, self.points))
-            xd = _x_directions[_direction_adder % 4]
-            yd = _y_directions[_direction_adder % 4]
-            self.x_recorder += xd
-            self.y_recorder += yd
-            _line_indicator += 1
-            if _line_indicator == _length:
-                _line_indicator = 0
-                _direction_adder += 1
-                if _length_add_flag:
-                    _length += 1
-                _length_add_flag = not _length_add_flag
-        
\ No newline at end of file
+
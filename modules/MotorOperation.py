@@ -1,10 +1,11 @@
 # MotorOperation.py by CoccaGuo at 2022/05/16 19:09
 
-import time
 from core import *
 
 
 class ChangeArea(Operate):
+    resources = frozenset({Resource.MOTOR, Resource.Z_CONTROLLER, Resource.XY_PIEZO})
+
     def __init__(self, session, direction='Y-', Zsteps=100, XYsteps=100, P='40p', setpoint='40p', interval_time=2):
         super().__init__(session)
         self.direction = direction
@@ -23,9 +24,9 @@ class ChangeArea(Operate):
         logging.info('Start to change area')
         self.session.MotorMoveSet('Z+', self.Zsteps)  # rise the tip
         logging.info('Raised the tip for {} steps'.format(self.Zsteps))
-        time.sleep(self.interval)
+        self.session.waiter.sleep(self.interval, 'coarse motion settle')
         self.session.MotorMoveSet(self.direction, self.XYsteps)  # change area
-        time.sleep(self.interval)
+        self.session.waiter.sleep(self.interval, 'coarse motion settle')
         logging.info('Changed area at {} for {} steps'.format(
             self.direction, self.XYsteps))
         prev_gain = self.session.ZGainGet()
@@ -38,13 +39,11 @@ class ChangeArea(Operate):
         self.session.AutoApproachSet()
         logging.warn('Start to approach...')
 
-        # wait till auto-approach is finished
-        while self.session.AutoApproachGet():
-            time.sleep(2)
+        self.session.WaitForApproach()
 
         self.session.Withdraw()
         logging.info('Approach finished')
-        self.session.ZGainSet(prev_gain['P'], prev_gain['T'], prev_gain['I'])
+        self.session.ZGainSet(*prev_gain)
         self.session.SetpointSet(prev_setpnt)
         logging.info('Reset proportional to {:.2e}, setpoint to {:.2e}'.format(
-            prev_gain['P'], prev_setpnt))
+            prev_gain.P, prev_setpnt))
@@ -1,32 +1,54 @@
 # PLLOperation.py by CoccaGuo at 2022/05/16 20:35
 
-import time
 from core import *
 
 class CheckFrequencyShift(Operate):
-    def __init__(self, session: NanonisController):
+    resources = frozenset({Resource.PLL})
+
+    def __init__(self, session: NanonisController, tolerance=0.05, window=0.5, lock_time=2, hold=2):
+        '''
+        the PLL is locked once the frequency shift stayed within tolerance (Hz) for window seconds, or after
+        lock_time seconds; the frequency shift is read hold seconds later.
+        '''
         super().__init__(session)
+        self.tolerance = tolerance
+        self.window = window
+        self.lock_time = lock_time
+        self.hold = hold
     
     def safety_check(self):
         return True
-    
-    def _operate(self):
+
+    def lock(self):
+        '''
+        turn the PLL on and wait for it to lock: at most lock_time, less once the frequency shift is stable.
+        '''
         logging.info('Checking frequency shift')
         self.session.PLLOutputSet(True)
         self.session.PLLAmpCtrlSet(True)
         self.session.PLLPhasCtrlSet(True)
-        time.sleep(2)
+        self.session.waiter.stable(
+            self.session.PLLFreqShiftGet, 'PLL settle', self.tolerance, self.window, timeout=self.lock_time)
+
+    def read(self):
+        '''
+        read the frequency shift of the locked PLL, then turn it off.
+        '''
+        self.session.waiter.sleep(self.hold, 'PLL hold')
         freq_shift = self.session.PLLFreqShiftGet()
-        time.sleep(2)
         self.session.PLLOutputSet(False)
         self.session.PLLAmpCtrlSet(False)
         self.session.PLLPhasCtrlSet(False)
         logging.info('Frequency shift: {:.2f}'.format(freq_shift))
         return freq_shift
     
+    def _operate(self):
+        self.lock()
+        return self.read()
+    
     @staticmethod
     def check_frequency_shift(freq_shift):
         if (freq_shift < -1 and freq_shift > -2):
             return True
         else:
-            return False
\ No newline at end of file
+            return False
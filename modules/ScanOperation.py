@@ -2,11 +2,14 @@
 
 import logging
 import time
-from core import NanonisController, Operate
+from core import NanonisController, Operate, Resource
 
 
 class Scan(Operate):
-    def __init__(self, session: NanonisController, center_x, center_y, width_x, width_y, angle=0, channel='Z (m)'):
+    resources = frozenset({Resource.SCAN, Resource.XY_PIEZO, Resource.Z_CONTROLLER})
+
+    def __init__(self, session: NanonisController, center_x, center_y, width_x, width_y, angle=0, channel='Z (m)',
+                 tip_state=None):
         super().__init__(session)
         self.center_x = self.session.try_convert(center_x)
         self.center_y = self.session.try_convert(center_y)
@@ -14,6 +17,8 @@ class Scan(Operate):
         self.width_y = self.session.try_convert(width_y)
         self.angle = angle
         self.channel = channel
+        # archived with the frames, e.g. the area and the frequency shift of the tip
+        self.tip_state = {} if tip_state is None else tip_state
 
     def safety_check(self):
         s = self.session
@@ -22,7 +27,7 @@ class Scan(Operate):
         s.ScanFrameSet(self.center_x, self.center_y, self.width_x, self.width_y, self.angle)
         s.ZCtrlOnOffSet()
         s.WaitForZCtrlWork()
-        time.sleep(2) # wait for Z to settle
+        s.WaitForZSettle(2) # wait for Z to settle
         return True
 
         
@@ -32,15 +37,48 @@ class Scan(Operate):
         logging.info('Scanning start at {}, {}, Size {}.'.format(n(self.center_x), n(self.center_y), n(self.width_x)))
         s.ZCtrlOnOffSet()
         s.WaitForZCtrlWork()
-        time.sleep(4)
+        s.WaitForZSettle(4)
         s.ScanStart()
-        time.sleep(2)
+        s.waiter.sleep(2, 'scan start')
     
-    def _get_scan_data(self, channel=None):
+    def _get_scan_data(self, channel=None, directions=(1,)):
+        '''
+        The frame of channel, or with a list of channels the frames stacked as
+        data[channel, direction, row, col] (grabbed in one round-trip, see NanonisController.ScanFramesGrab).
+        '''
+        s = self.session
+        if channel is None:
+            channel = self.channel
+        if isinstance(channel, (list, tuple)):
+            data = s.ScanFramesGrab(channel, directions)['data']
+            self._archive(data, list(channel), directions=list(directions))
+            return data
+        data = s.ScanFramesGrab([channel], directions[:1])['data'][0, 0]
+        self._archive(data, channel, directions=list(directions[:1]))
+        return data
+
+    def _archive(self, data, channel, **metadata):
+        '''
+        Keep the frame in the archive of the session, if it has one.
+        '''
+        archive = self.session.archive
+        if archive is None:
+            return None
+        return archive.append(data, center_x=self.center_x, center_y=self.center_y, width=self.width_x,
+                              height=self.width_y, angle=self.angle, channel=channel, time=time.time(),
+                              **dict(self.tip_state, **metadata))
+
+    def _stream_scan_data(self, predicate=None, channel=None, interval=0.2):
+        '''
+        Follow the running scan line by line until it ends or predicate(frame, rows) is True
+        (the scan is then stopped), returns the possibly partial frame.
+        '''
         s = self.session
         if channel is None:
             channel = self.channel
-        ind = s.SignalIndexGet(channel)
-        data = s.ScanFrameData(ind)['data']
+        stream = s.ScanStream(s.SignalIndexGet(channel), interval=interval)
+        data = stream.run(predicate)
+        if stream.stopped_early:
+            logging.info('Scan stopped early after {} of {} lines.'.format(stream.lines_done, len(data)))
+        self._archive(data, channel, lines=stream.lines_done, stopped_early=stream.stopped_early)
         return data
-    
\ No newline at end of file
@@ -1,8 +1,7 @@
 # TipShaper.py by CoccaGuo at 2022/05/21 18:19
 
 import logging
-import time
-from core import NanonisController, Operate
+from core import NanonisController, Operate, Resource
 
 
 class TipShaper(Operate):
@@ -10,6 +9,8 @@ class TipShaper(Operate):
     TipShaper in nanonis api is not available, so we use the following code to simulate it.
     '''
 
+    resources = frozenset({Resource.BIAS, Resource.Z_CONTROLLER})
+
     def __init__(self, session: NanonisController, bias=3, tip_lift='-300p'):
         super().__init__(session)
         self.bias = self.session.try_convert(bias)
@@ -28,11 +29,11 @@ class TipShaper(Operate):
         s.ZCtrlOnOffSet(False)
         logging.info('TipShaper: bias {}, tip lift {}.'.format(
             self.bias, self.tip_lift))
-        time.sleep(1)
+        s.waiter.sleep(1, 'tip shaper')
         s.TipZSet(z_c+self.tip_lift)
         s.BiasSet(self.bias)
-        time.sleep(0.1)
+        s.waiter.sleep(0.1, 'tip shaper')
         s.TipZSet(z_c)
         s.BiasSet(b_c)
         s.ZCtrlOnOffSet(True)
-        time.sleep(0.5)
+        s.waiter.sleep(0.5, 'tip shaper')
@@ -0,0 +1,133 @@
+# param_cache.py
+r'''
+Read-through cache for quasi-static Nanonis parameters.
+
+Getters of parameters which change rarely (Z limits, piezo range, Z gains,
+setpoint, bias) are answered from the cache after the first read. Setters
+write through once Nanonis accepted them: the value just set replaces the
+cached one, and commands which may change a parameter without returning it
+(or a setter which failed) invalidate the entry. Each getter has its own
+time-to-live, so changes made in the Nanonis GUI are picked up after at most
+that time. Nothing is cached unless asked for, e.g.
+
+    nanonis = NanonisController(param_ttls=QUASI_STATIC_TTLS)
+'''
+
+import threading
+import time
+
+from interface import PiezoRange, ZGain, ZLimits
+
+
+# getter -> time-to-live (s), None never expires
+QUASI_STATIC_TTLS = {
+    'Piezo.RangeGet': None,
+    'ZCtrl.LimitsGet': 60.,
+    'ZCtrl.GainGet': 30.,
+    'ZCtrl.SetpntGet': 10.,
+    'Bias.Get': 10.,
+}
+
+# setter -> (getter, value of the getter built from the setter arguments)
+WRITE_THROUGH = {
+    'Piezo.RangeSet': ('Piezo.RangeGet', lambda args: PiezoRange(*args[:3])),
+    'ZCtrl.LimitsSet': ('ZCtrl.LimitsGet', lambda args: ZLimits(*args[:2])),
+    'ZCtrl.GainSet': ('ZCtrl.GainGet', lambda args: ZGain(*args[:3])),
+    'ZCtrl.SetpntSet': ('ZCtrl.SetpntGet', lambda args: args[0]),
+    'Bias.Set': ('Bias.Get', lambda args: args[0]),
+}
+
+# command -> getters it may change without telling the new value
+INVALIDATES = {
+    'Piezo.CalibrSet': ('Piezo.RangeGet',),
+    'ZCtrl.LimitsEnabledSet': ('ZCtrl.LimitsGet',),
+}
+
+
+class CacheEntry:
+
+    __slots__ = ('value', 'expires')
+
+    def __init__(self, value, expires):
+        self.value = value
+        self.expires = expires
+
+
+class ParameterCache:
+
+    r'''
+    Args:
+        ttls : dict
+            getter -> time-to-live (s). Only these getters are cached, none by default.
+        enabled : bool
+    '''
+
+    def __init__(self, ttls=None, enabled=True):
+        self.ttls = {} if ttls is None else dict(ttls)
+        self.enabled = enabled
+        self.entries = {}
+        self.hits = {}
+        self.misses = {}
+        self._lock = threading.Lock()
+
+    def cacheable(self, command_name):
+        return self.enabled and command_name in self.ttls
+
+    def set_ttl(self, command_name, ttl):
+        r'''Cache command_name for ttl seconds (None: forever).'''
+        with self._lock:
+            self.ttls[command_name] = ttl
+            self._drop(command_name)
+
+    def lookup(self, command_name, args=()):
+        r'''
+        Returns (True, value) for a fresh entry, (False, None) otherwise, and counts the hit or miss.
+        '''
+        with self._lock:
+            entry = self.entries.get((command_name, args))
+            if entry is not None and (entry.expires is None or entry.expires > time.monotonic()):
+                self.hits[command_name] = self.hits.get(command_name, 0) + 1
+                return True, entry.value
+            self.misses[command_name] = self.misses.get(command_name, 0) + 1
+            return False, None
+
+    def store(self, command_name, args, value):
+        with self._lock:
+            self._store(command_name, args, value)
+
+    def _store(self, command_name, args, value):
+        ttl = self.ttls.get(command_name)
+        expires = None if ttl is None else time.monotonic() + ttl
+        self.entries[(command_name, args)] = CacheEntry(value, expires)
+
+    def written(self, command_name, args=None):
+        r'''
+        Called after command_name was sent. Setters with known arguments write through,
+        otherwise the getters they change are invalidated.
+        '''
+        if command_name in WRITE_THROUGH:
+            getter, build = WRITE_THROUGH[command_name]
+            with self._lock:
+                self._drop(getter)
+                if args is not None and self.cacheable(getter):
+                    self._store(getter, (), build(args))
+        elif command_name in INVALIDATES:
+            self.invalidate(*INVALIDATES[command_name])
+
+    def invalidate(self, *command_names):
+        r'''Drop the entries of the given getters, all entries without arguments.'''
+        with self._lock:
+            if not command_names:
+                self.entries.clear()
+            for command_name in command_names:
+                self._drop(command_name)
+
+    def _drop(self, command_name):
+        for key in [key for key in self.entries if key[0] == command_name]:
+            del self.entries[key]
+
+    def stats(self):
+        r'''Hits and misses per getter.'''
+        names = set(self.hits) | set(self.misses)
+        return {name: {'hits': self.hits.get(name, 0), 'misses': self.misses.get(name, 0)}
+                for name in sorted(names)}
@@ -0,0 +1,159 @@
+# path_planner.py
+r'''
+Visiting orders for the grid points of IterateOperation.
+
+A grid is given by its half sizes (x_max, y_max): the cells (x, y) with
+|x| <= x_max and |y| <= y_max, in grid units. Every planner is a lazy
+generator of cells, so a run can stop at any point without building the
+whole path:
+
+    spiral(x_max, y_max)        from the center outwards (the original order)
+    serpentine(x_max, y_max)    row by row, alternating direction
+    hilbert(x_max, y_max)       along a Hilbert curve, local in both directions
+    nearest(x_max, y_max)       greedy nearest neighbour tour of the cells
+    nearest_neighbour(points)   greedy nearest neighbour tour of any points
+
+skip() drops visited or blacklisted cells, travel_distance() estimates the
+piezo travel of a path.
+'''
+
+import math
+
+import numpy as np
+
+
+def spiral_walk(points):
+    '''
+    yield the grid indices (x, y) of a square spiral starting at (0, 0).
+    '''
+    _x_directions = [1, 0, -1, 0]
+    _y_directions = [0, 1, 0, -1]
+    _direction_adder = 0
+    _length = 1
+    _line_indicator = 0
+    _length_add_flag = False
+    x, y = 0, 0
+    for _ in range(points):
+        yield x, y
+        x += _x_directions[_direction_adder % 4]
+        y += _y_directions[_direction_adder % 4]
+        _line_indicator += 1
+        if _line_indicator == _length:
+            _line_indicator = 0
+            _direction_adder += 1
+            if _length_add_flag:
+                _length += 1
+            _length_add_flag = not _length_add_flag
+
+
+def grid_size(x_max, y_max):
+    return (2 * x_max + 1) * (2 * y_max + 1)
+
+
+def in_grid(x_max, y_max):
+    return lambda cell: abs(cell[0]) <= x_max and abs(cell[1]) <= y_max
+
+
+def spiral(x_max, y_max):
+    r'''Square spiral from (0, 0), clipped to a grid which may be rectangular.'''
+    side = 2 * max(x_max, y_max) + 1
+    return filter(in_grid(x_max, y_max), spiral_walk(side * side))
+
+
+def serpentine(x_max, y_max):
+    r'''Boustrophedon: the rows from bottom to top, every other row right to left.'''
+    for i, y in enumerate(range(-y_max, y_max + 1)):
+        xs = range(-x_max, x_max + 1)
+        for x in (xs if i % 2 == 0 else reversed(xs)):
+            yield x, y
+
+
+def hilbert_cell(order, d):
+    r'''Cell (x, y) at distance d along the Hilbert curve filling a 2**order square.'''
+    x = y = 0
+    s = 1
+    while s < 1 << order:
+        rx = 1 & (d // 2)
+        ry = 1 & (d ^ rx)
+        if ry == 0:
+            if rx == 1:
+                x, y = s - 1 - x, s - 1 - y
+            x, y = y, x
+        x += s * rx
+        y += s * ry
+        d //= 4
+        s *= 2
+    return x, y
+
+
+def hilbert(x_max, y_max):
+    r'''Hilbert curve over the smallest power-of-two square holding the grid, clipped to the grid.'''
+    order = max(0, math.ceil(math.log2(2 * max(x_max, y_max) + 1)))
+    keep = in_grid(x_max, y_max)
+    for d in range(1 << (2 * order)):
+        x, y = hilbert_cell(order, d)
+        cell = (x - x_max, y - y_max)
+        if keep(cell):
+            yield cell
+
+
+def nearest_neighbour(points, start=(0, 0)):
+    r'''
+    Greedy nearest neighbour tour of any points (tuples of coordinates), starting from the point
+    closest to start. Each step picks the closest point not visited yet.
+    '''
+    points = list(points)
+    if not points:
+        return
+    coordinates = np.asarray(points, dtype=np.float64)
+    remaining = np.ones(len(points), dtype=bool)
+    here = np.asarray(start, dtype=np.float64)
+    for _ in range(len(points)):
+        distance = np.einsum('ij,ij->i', coordinates - here, coordinates - here)
+        distance[~remaining] = np.inf
+        i = int(np.argmin(distance))
+        remaining[i] = False
+        here = coordinates[i]
+        yield points[i]
+
+
+def nearest(x_max, y_max):
+    r'''Greedy nearest neighbour tour of the grid cells from (0, 0).'''
+    cells = [(x, y) for y in range(-y_max, y_max + 1) for x in range(-x_max, x_max + 1)]
+    return nearest_neighbour(cells)
+
+
+PLANNERS = {
+    'spiral': spiral,
+    'serpentine': serpentine,
+    'hilbert': hilbert,
+    'nearest': nearest,
+}
+
+
+def plan(planner, x_max, y_max):
+    r'''The path of planner (a name of PLANNERS or a function of (x_max, y_max)) over the grid.'''
+    if callable(planner):
+        return iter(planner(x_max, y_max))
+    try:
+        return iter(PLANNERS[planner](x_max, y_max))
+    except KeyError:
+        raise ValueError('Unknown planner {}, use one of {}'.format(planner, ', '.join(PLANNERS)))
+
+
+def skip(path, *excluded):
+    r'''
+    Drop the cells in any of the excluded sets. The sets are checked lazily, so cells
+    added to them during the iteration (e.g. the visited cells) are skipped too.
+    '''
+    for cell in path:
+        if not any(cell in cells for cells in excluded):
+            yield cell
+
+
+def travel_distance(path, start=(0, 0), scale=(1., 1.)):
+    r'''Total straight-line travel along path from start, with the grid units scaled by scale (e.g. the grid size in m).'''
+    coordinates = np.asarray([start] + list(path), dtype=np.float64) * np.asarray(scale)
+    if len(coordinates) < 2:
+        return 0.
+    return float(np.sqrt((np.diff(coordinates, axis=0) ** 2).sum(axis=1)).sum())
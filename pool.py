@@ -0,0 +1,173 @@
+# pool.py
+r'''
+A NanonisController holding connections on several Nanonis ports.
+
+Nanonis serves one client per port on 6501-6504 and executes the commands
+of different ports independently. PooledNanonisController keeps one
+connection (with its own lock) per port and routes every command to a port.
+Slow blocking commands such as Scan.WaitEndOfScan or Motor.StartMove
+(wait=1) therefore do not hold up fast Current.Get polling from another
+thread.
+
+    nanonis = PooledNanonisController(PORTS=(6501, 6502, 6503))
+    nanonis.set_route('Scan.', 6502)      # every Scan.* command
+    nanonis.set_route('Current.Get', 6503)
+'''
+
+import logging
+import threading
+import time
+import _thread as thread
+
+from core import NanonisController
+from interface import ConnectionLost, NanonisConnection, get_codec, nanonisException
+
+
+# Commands which can block their connection for a long time.
+SLOW_COMMANDS = ('Scan.WaitEndOfScan', 'Motor.StartMove', 'ZCtrl.Withdraw', 'Bias.Pulse')
+# Commands polled at a high rate.
+POLL_COMMANDS = ('Current.Get', 'Signals.ValGet', 'Signals.ValsGet', 'ZCtrl.ZPosGet')
+
+
+class PoolMember:
+
+    r'''
+    One port of the pool: the connection, its lock and its health.
+    '''
+
+    def __init__(self, IP, PORT, connection=None, lock=None):
+        self.IP = IP
+        self.PORT = PORT
+        self.lock = lock if lock is not None else thread.allocate_lock()
+        self.connection = connection if connection is not None else NanonisConnection(IP, PORT)
+        self.healthy = True
+        self.failures = 0
+        self.reconnects = 0
+        self.last_used = time.monotonic()
+
+    def reconnect(self):
+        self.connection.reconnect()
+        self.healthy = True
+        self.reconnects += 1
+
+
+class PooledNanonisController(NanonisController):
+
+    r'''
+    Args:
+        IP : str
+        PORTS : list of int
+            The first port is the default route.
+        routes : dict
+            Command name or module prefix (ending with '.') -> port.
+            By default, slow blocking commands go to the second port and high-rate
+            polling commands to the third port (when the pool has that many ports).
+        health_check_interval : float
+            Seconds between background health checks of idle connections, 0 disables them.
+    '''
+
+    def __init__(self, IP='127.0.0.1', PORTS=(6501, 6502), routes=None, health_check_interval=0):
+        PORTS = list(PORTS)
+        super().__init__(IP, PORTS[0])
+        self.members = {PORTS[0]: PoolMember(IP, PORTS[0], self.connection, self.lock)}
+        for port in PORTS[1:]:
+            self.members[port] = PoolMember(IP, port)
+        self.default_port = PORTS[0]
+
+        self.routes = {}
+        if routes is None:
+            routes = {}
+            if len(PORTS) > 1:
+                routes.update({name: PORTS[1] for name in SLOW_COMMANDS})
+            if len(PORTS) > 2:
+                routes.update({name: PORTS[2] for name in POLL_COMMANDS})
+        for name, port in routes.items():
+            self.set_route(name, port)
+
+        self._stop_health_checks = threading.Event()
+        if health_check_interval > 0:
+            threading.Thread(target=self._health_check_loop, args=(health_check_interval,),
+                             name='NanonisHealthCheck', daemon=True).start()
+
+    def set_route(self, command_name, port):
+        r'''
+        Send command_name over port. A name ending with '.' routes a whole module, e.g. 'Scan.'.
+        '''
+        if port not in self.members:
+            raise nanonisException('Port {} is not in the pool'.format(port))
+        self.routes[command_name] = port
+
+    def port_of(self, command_name):
+        port = self.routes.get(command_name)
+        if port is None:
+            port = self.routes.get(command_name[:command_name.find('.') + 1], self.default_port)
+        if not self.members[port].healthy:
+            port = self.default_port
+        return port
+
+    def route(self, command_name):
+        member = self.members[self.port_of(command_name)]
+        member.last_used = time.monotonic()
+        return member.connection, member.lock
+
+    def _member_of(self, connection):
+        for member in self.members.values():
+            if member.connection is connection:
+                return member
+        return None
+
+    def reconnect(self, connection, cause=None):
+        # called with the lock of the member held, the connection is reopened in place
+        member = self._member_of(connection)
+        if member is None:
+            return super().reconnect(connection, cause)
+        member.failures += 1
+        member.healthy = False
+        super().reconnect(connection, cause)
+        member.healthy = True
+        member.reconnects += 1
+
+    def _reconnect(self, member):
+        try:
+            self.reconnect(member.connection)
+        except ConnectionLost as e:
+            logging.error('Reconnect to Nanonis port {} failed: {}'.format(member.PORT, e))
+
+    def health_check(self, timeout=1.):
+        r'''
+        Ping every idle connection with Bias.Get, reconnect the ones that do not answer.
+        Returns a dict port -> healthy.
+        '''
+        ping = get_codec('Bias.Get').encode()
+        for member in self.members.values():
+            if not member.lock.acquire(timeout=timeout):
+                continue  # busy with a long command, which means it is alive
+            try:
+                if member.connection.dead:
+                    raise ConnectionLost('closed after an interrupted command')
+                # the next command sets its own timeout again
+                member.connection.settimeout(timeout)
+                member.connection.exchange(ping)
+                member.healthy = True
+            except (OSError, nanonisException):
+                self._reconnect(member)
+            finally:
+                member.lock.release()
+        return {port: member.healthy for port, member in self.members.items()}
+
+    def _health_check_loop(self, interval):
+        while not self._stop_health_checks.wait(interval):
+            now = time.monotonic()
+            if any(now - member.last_used > interval for member in self.members.values()):
+                self.health_check()
+
+    def close(self):
+        self._stop_health_checks.set()
+        for member in self.members.values():
+            member.connection.close()
+        if self.telemetry is not None:
+            self.telemetry.close()
+        if self.archive is not None:
+            self.archive.close()
+        if self.io is not None:
+            self.io.close()
@@ -0,0 +1,183 @@
+# profiler.py
+r'''
+Opt-in profiler of where the wall-clock time of a run goes.
+
+Profiler collects the latency of every Nanonis command (histograms with
+p50/p95/p99), the time of every wait of the Waiter (settles, sleeps,
+polls) and the phases of every Operate.do (safety_check, _operate,
+_reset) as a tree of nested spans, e.g.
+
+    TipRepair > _operate > SingleAreaTipRepairer > _operate > MultiPulse > _operate > cmd Bias.Pulse
+
+report() prints the command table and the span tree with total and self
+times (a flame graph as text), export() writes both to JSON together with
+folded stacks for flamegraph.pl / speedscope.
+
+    nanonis = NanonisController(profile=True)
+    ...
+    print(nanonis.profiler.report())
+'''
+
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class Profiler:
+
+    def __init__(self):
+        self.latencies = {}  # command -> list of latencies (s)
+        self.spans = {}  # path (tuple of names) -> [count, total (s)]
+        self.started = time.time()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            thread = threading.current_thread()
+            # spans of other threads (samplers, health checks) get their own root
+            stack = self._local.stack = [] if thread is threading.main_thread() else [thread.name]
+        return stack
+
+    def _add(self, path, elapsed):
+        with self._lock:
+            record = self.spans.get(path)
+            if record is None:
+                record = self.spans[path] = [0, 0.]
+            record[0] += 1
+            record[1] += elapsed
+
+    @contextmanager
+    def span(self, name):
+        r'''Time the block as a child of the current span.'''
+        stack = self._stack()
+        stack.append(name)
+        path = tuple(stack)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._add(path, time.perf_counter() - start)
+            stack.pop()
+
+    def leaf(self, name, elapsed):
+        r'''Record a span measured elsewhere as a child of the current span.'''
+        self._add(tuple(self._stack()) + (name,), elapsed)
+
+    def command(self, command_name, latency):
+        with self._lock:
+            samples = self.latencies.get(command_name)
+            if samples is None:
+                samples = self.latencies[command_name] = []
+            samples.append(latency)
+        self.leaf('cmd ' + command_name, latency)
+
+    def wait(self, name, elapsed):
+        self.leaf('wait ' + name, elapsed)
+
+    # results
+
+    def command_stats(self):
+        r'''command -> count, total, mean, p50, p95, p99 and max latency (s), sorted by total time.'''
+        with self._lock:
+            latencies = {name: np.array(samples) for name, samples in self.latencies.items()}
+        stats = {}
+        for name, samples in sorted(latencies.items(), key=lambda item: -item[1].sum()):
+            p50, p95, p99 = np.percentile(samples, (50, 95, 99))
+            stats[name] = {'count': len(samples), 'total': float(samples.sum()), 'mean': float(samples.mean()),
+                           'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'max': float(samples.max())}
+        return stats
+
+    def histogram(self, command_name, bins=20):
+        r'''(counts, edges) of the latencies of command_name on log-spaced bins.'''
+        samples = np.array(self.latencies.get(command_name, []))
+        if len(samples) == 0:
+            return np.zeros(bins, dtype=int), np.zeros(bins + 1)
+        low, high = max(samples.min(), 1e-7), max(samples.max(), 1e-7)
+        return np.histogram(samples, np.geomspace(low, high * 1.0001, bins + 1))
+
+    def span_tree(self):
+        r'''[(path, count, total, self time)] in depth-first order, children sorted by total time.'''
+        with self._lock:
+            spans = {path: tuple(record) for path, record in self.spans.items()}
+        children = {}
+        for path in spans:
+            children.setdefault(path[:-1], []).append(path)
+        rows = []
+
+        def visit(parent):
+            for path in sorted(children.get(parent, ()), key=lambda p: -spans[p][1]):
+                count, total = spans[path]
+                child_total = sum(spans[child][1] for child in children.get(path, ()))
+                rows.append((path, count, total, max(0., total - child_total)))
+                visit(path)
+        visit(())
+        return rows
+
+    def folded(self):
+        r'''Folded stacks ("a;b;c microseconds" per line) of the self times, for flamegraph tools.'''
+        return ['{} {}'.format(';'.join(path), int(self_time * 1e6))
+                for path, _, _, self_time in self.span_tree() if self_time > 0]
+
+    def report(self, max_depth=None, min_fraction=0.001):
+        r'''Text report: the command latency table, then the span tree with total and self times.'''
+        lines = ['{:<28}{:>8}{:>11}{:>10}{:>10}{:>10}{:>10}'.format(
+            'command', 'count', 'total (s)', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'max (ms)')]
+        for name, s in self.command_stats().items():
+            lines.append('{:<28}{:>8}{:>11.2f}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}'.format(
+                name, s['count'], s['total'], s['p50'] * 1e3, s['p95'] * 1e3, s['p99'] * 1e3, s['max'] * 1e3))
+        tree = self.span_tree()
+        wall = time.time() - self.started
+        lines.append('')
+        lines.append('{:<60}{:>8}{:>11}{:>11}{:>8}'.format('span', 'count', 'total (s)', 'self (s)', '%'))
+        for path, count, total, self_time in tree:
+            if max_depth is not None and len(path) > max_depth:
+                continue
+            if wall > 0 and total / wall < min_fraction:
+                continue
+            name = '  ' * (len(path) - 1) + path[-1]
+            lines.append('{:<60}{:>8}{:>11.2f}{:>11.2f}{:>8.1f}'.format(
+                name[:59], count, total, self_time, 100 * total / wall if wall > 0 else 0.))
+        return '\n'.join(lines)
+
+    def export(self, path):
+        r'''Write the command statistics, the span tree and the folded stacks to a JSON file.'''
+        with open(path, 'w') as f:
+            json.dump({
+                'started': self.started,
+                'wall_time': time.time() - self.started,
+                'commands': self.command_stats(),
+                'spans': [{'path': list(p), 'count': count, 'total': total, 'self': self_time}
+                          for p, count, total, self_time in self.span_tree()],
+                'folded': self.folded(),
+            }, f, indent=1)
+        return path
+
+
+def log_run_report(session, time_start, export_path=None):
+    r'''
+    Log the total time of a run, the wait statistics and, when the session is profiled,
+    the profiler report (also exported to export_path if given).
+    '''
+    m, s = divmod(time.time() - time_start, 60)
+    h, m = divmod(m, 60)
+    logging.info('Total time cost: {:.0f}h {:02.0f}m {:02.0f}s'.format(h, m, s))
+    logging.info('Wait statistics:\n' + session.waiter.report())
+    retry = getattr(session, 'retry', None)
+    if retry is not None and (retry.counts['lost'] or retry.counts['desyncs'] or retry.counts['timeouts']):
+        logging.info('Connection recovery: {}'.format(retry.stats()))
+    io = getattr(session, 'io', None)
+    if io is not None:
+        stats = io.stats()
+        logging.info('Background I/O: {} MB in {} writes, {} errors, blocked {} times for {:.2f} s'.format(
+            stats['written'] >> 20, stats['writes'], stats['errors'], stats['stalls'], stats['stalled']))
+    profiler = getattr(session, 'profiler', None)
+    if profiler is not None:
+        logging.info('Profile:\n' + profiler.report())
+        if export_path is not None:
+            logging.info('Profile exported to {}'.format(profiler.export(export_path)))
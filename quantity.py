@@ -0,0 +1,108 @@
+# quantity.py
+r'''
+Parsing of physical quantities written with SI prefixes.
+
+parse_quantity turns the literals used all over the tasks and modules into
+floats in SI base units. It accepts scientific notation, an explicit sign,
+the full set of SI prefixes and an optional unit suffix:
+
+    '-300p'  -> -3e-10        '1e-9'  -> 1e-9        '+5n'   -> 5e-9
+    '300pm'  -> 3e-10         '5nA'   -> 5e-9        '2.5 kHz' -> 2500.
+    '10M'    -> 1e7           '100u'  -> 1e-4        '3mV'   -> 3e-3
+
+A suffix is read as a prefix first, so '5m' is 5e-3 (not 5 metres) and
+'1T' is 1e12; a unit is only split off when the suffix is not a prefix
+('5mm' is 5e-3 metres). An exa prefix must be separated from the number
+('1 E'), '1E' is taken for an exponent with its digits missing. The results are memoized, the same literals are
+parsed over and over by the setters and constructors.
+
+parse_quantities parses a list or array of values at once, e.g. the
+points of a grid or of a bias sweep:
+
+    parse_quantities(['-1', '-500m', '0', '500m', '1'])
+    parse_quantities('100p, 200p, 300p')
+'''
+
+import re
+from functools import lru_cache
+
+import numpy as np
+
+
+SI_PREFIXES = {
+    'y': 1e-24, 'z': 1e-21, 'a': 1e-18, 'f': 1e-15, 'p': 1e-12, 'n': 1e-9,
+    'u': 1e-6, 'µ': 1e-6, 'μ': 1e-6, 'm': 1e-3, '': 1.0,
+    'k': 1e3, 'M': 1e6, 'G': 1e9, 'T': 1e12, 'P': 1e15, 'E': 1e18,
+}
+
+# units which may follow the prefix, they do not change the value
+UNITS = ('m', 'A', 'V', 'Hz', 's', 'F', 'H', 'T', 'W', 'C', 'K', 'Ohm', 'ohm', 'Ω', 'S', 'N', 'deg', 'rad', '%')
+
+_QUANTITY = re.compile(r'^\s*([+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?)(\s*)(\S*?)\s*$')
+
+
+class QuantityError(ValueError):
+    pass
+
+
+def _multiplier(suffix):
+    multiplier = SI_PREFIXES.get(suffix)
+    if multiplier is not None:
+        return multiplier
+    for unit in UNITS:
+        if suffix.endswith(unit):
+            multiplier = SI_PREFIXES.get(suffix[:-len(unit)])
+            if multiplier is not None:
+                return multiplier
+    raise QuantityError('Malformed number: SI prefix not recognized: {!r}'.format(suffix))
+
+
+@lru_cache(maxsize=1024)
+def parse_quantity(text):
+    r'''
+    Converts a number followed by an SI prefix (and optionally a unit) into number * 10^{prefix exponent}
+
+    Args:
+        text : str
+
+    Returns:
+        Float
+    '''
+    match = _QUANTITY.match(text)
+    if match is None:
+        raise QuantityError('Malformed number: Not a correctly formatted number: {!r}'.format(text))
+    number, separator, suffix = match.groups()
+    if suffix[:1] == 'E' and not separator:
+        raise QuantityError('Malformed number: exponent without digits or exa prefix without a space: {!r}'.format(text))
+    return float(number) * _multiplier(suffix)
+
+
+def to_quantity(value):
+    r'''value as a float, strings are parsed with parse_quantity.'''
+    if type(value) is str:
+        return parse_quantity(value)
+    return float(value)
+
+
+def parse_quantities(values):
+    r'''
+    Parses many values at once into a float64 array of the same shape.
+
+    Args:
+        values : str, list or array
+            A comma or whitespace separated string, a (nested) list mixing strings and numbers,
+            or an array. Every distinct literal is parsed once.
+
+    Returns:
+        numpy.ndarray
+    '''
+    if isinstance(values, str):
+        values = [value for value in re.split(r'[,;\s]+', values.strip()) if value]
+    array = np.asarray(values)
+    if array.dtype.kind in 'biuf':
+        return array.astype(np.float64)
+    if array.dtype.kind not in 'UO':
+        raise QuantityError('Cannot parse values of type {}'.format(array.dtype))
+    literals, inverse = np.unique(array.astype(str), return_inverse=True)
+    parsed = np.fromiter((parse_quantity(str(literal)) for literal in literals), np.float64, len(literals))
+    return parsed[inverse].reshape(array.shape)
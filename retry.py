@@ -0,0 +1,64 @@
+# retry.py
+r'''
+Recovery from broken connections.
+
+When a command fails because the connection to Nanonis broke (a socket
+error, Nanonis closing it, no response within the command timeout, or a
+response that does not belong to the command, i.e. the framing is out of
+sync), the connection is reopened with exponential backoff. The command
+is then sent again only if it is idempotent (see interface.is_idempotent):
+reads and setters of absolute values are, motion and pulses
+(Motor.StartMove, Bias.Pulse, ...) are not, since it is unknown whether
+Nanonis executed them before the connection broke. Those raise
+interface.ConnectionLost on the new connection, chained to the error
+which broke the old one. Without a policy (nanonis.retry = None) that
+error is raised as it is, and the next command reopens the connection.
+
+    nanonis = NanonisController(retries=3)
+    nanonis.retry = RetryPolicy(retries=3, backoff=0.5)   # or a policy of your own
+    ...
+    nanonis.retry.stats()   # reconnects, retries, commands not retried, ...
+'''
+
+import threading
+
+
+class RetryPolicy:
+
+    r'''
+    Args:
+        retries : int
+            Times an idempotent command is sent again at most, None or 0 for never.
+        reconnect_attempts : int
+            Attempts to reopen a broken connection before giving up.
+        backoff : float
+            Seconds before the second reconnect attempt, doubled for every further attempt.
+        max_backoff : float
+            Longest wait between two reconnect attempts.
+    '''
+
+    def __init__(self, retries=3, reconnect_attempts=6, backoff=0.5, max_backoff=10.):
+        self.retries = 0 if retries is None else retries
+        self.reconnect_attempts = reconnect_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.counts = {'lost': 0, 'desyncs': 0, 'timeouts': 0, 'reconnects': 0, 'reconnect_failures': 0,
+                       'retries': 0, 'not_retried': 0}
+        self.retried = {}  # command -> times it was sent again
+        self._lock = threading.Lock()
+
+    def delay(self, attempt):
+        r'''Seconds to wait before reconnect attempt number attempt (0 is the first).'''
+        if attempt == 0:
+            return 0.
+        return min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+
+    def count(self, event, command_name=None):
+        with self._lock:
+            self.counts[event] += 1
+            if event == 'retries':
+                self.retried[command_name] = self.retried.get(command_name, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts, retried=dict(self.retried))
@@ -0,0 +1,223 @@
+# sampler.py
+r'''
+High-rate signal streaming with bounded memory.
+
+SignalSampler reads one or more signals with Signals.ValsGet at a fixed
+rate on a background thread and stores the samples with their timestamps
+in a fixed-size NumPy ring buffer. Termination and threshold checks are
+computed on windows of the stream instead of a list that grows for the
+whole run.
+
+    sampler = nanonis.StreamSignals(['Current (A)'], rate=50)
+    for t, values in sampler.samples():
+        if sampler.stats(n=20)['max'][0] < 1e-9:
+            break
+    sampler.stop()
+'''
+
+import logging
+import threading
+import time
+
+import numpy as np
+
+from interface import CommandCodec, nanonisException
+
+
+class RingBuffer:
+
+    r'''
+    Fixed-size buffer of timestamped rows, the oldest rows are overwritten.
+
+    Args:
+        capacity : int
+            Number of samples kept.
+        channels : int
+            Number of values per sample.
+    '''
+
+    def __init__(self, capacity, channels, dtype=np.float64):
+        self.capacity = capacity
+        self.channels = channels
+        self.times = np.zeros(capacity)
+        self.values = np.zeros((capacity, channels), dtype=dtype)
+        self.total = 0  # number of samples ever appended
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    def append(self, timestamp, values):
+        with self._lock:
+            i = self.total % self.capacity
+            self.times[i] = timestamp
+            self.values[i] = values
+            self.total += 1
+
+    def since(self, total):
+        r'''
+        Samples appended after the buffer held total samples (at most the last capacity ones),
+        in chronological order. Returns (times, values, new total).
+        '''
+        with self._lock:
+            count = min(self.total - total, self.capacity)
+            return self._last(count) + (self.total,)
+
+    def last(self, n=None):
+        r'''The last n samples (all kept samples by default) in chronological order: (times, values).'''
+        with self._lock:
+            return self._last(len(self) if n is None else min(n, len(self)))
+
+    def window(self, seconds):
+        r'''The samples of the last seconds (relative to the newest sample): (times, values).'''
+        times, values = self.last()
+        if len(times) == 0:
+            return times, values
+        start = np.searchsorted(times, times[-1] - seconds, side='left')
+        return times[start:], values[start:]
+
+    def _last(self, count):
+        end = self.total % self.capacity
+        start = end - count
+        if start >= 0:
+            return self.times[start:end].copy(), self.values[start:end].copy()
+        return np.concatenate((self.times[start:], self.times[:end])), \
+            np.concatenate((self.values[start:], self.values[:end]))
+
+
+class SignalSampler:
+
+    r'''
+    Background sampler of Nanonis signals.
+
+    Args:
+        session : NanonisController
+        indices : list of int
+            Signal indices (see NanonisController.SignalIndexGet).
+        rate : float
+            Samples per second.
+        capacity : int
+            Size of the ring buffer (samples).
+        wait : bool
+            Ask Nanonis to wait for the next sample of the signals before answering.
+    '''
+
+    def __init__(self, session, indices, rate=10., capacity=10000, wait=False):
+        self.session = session
+        self.indices = list(indices)
+        self.rate = rate
+        self.wait = int(wait)
+        self.buffer = RingBuffer(capacity, len(self.indices))
+        n = len(self.indices)
+        # compiled once for this number of signals
+        self.codec = CommandCodec('Signals.ValsGet', ('int',) * (n + 1) + ('uint32',), ('int',) + ('float32',) * n)
+        self.error = None
+        self.missed = 0
+        self._new_sample = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def read(self):
+        r'''Read the signals once, returns a tuple of values.'''
+        values = self.session.execute(self.codec, len(self.indices), *self.indices, self.wait)
+        return values[1:]
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='SignalSampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._new_sample:
+            self._new_sample.notify_all()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _run(self):
+        period = 1. / self.rate
+        next_time = time.monotonic()
+        try:
+            while not self._stop.is_set():
+                values = self.read()
+                self.buffer.append(time.time(), values)
+                with self._new_sample:
+                    self._new_sample.notify_all()
+                next_time += period
+                delay = next_time - time.monotonic()
+                if delay < 0:
+                    # too slow for the rate: skip the missed ticks instead of bursting
+                    missed = int(-delay // period) + 1
+                    self.missed += missed
+                    next_time += missed * period
+                    delay = next_time - time.monotonic()
+                self._stop.wait(max(0., delay))
+        except Exception as e:
+            self.error = e
+            logging.error('Signal sampler stopped: {}'.format(e))
+        finally:
+            with self._new_sample:
+                self._new_sample.notify_all()
+
+    # views
+
+    def samples(self, timeout=None):
+        r'''
+        Iterate over the new samples as (timestamp, values) while the sampler runs.
+        Samples overwritten before the iterator got to them are skipped.
+        '''
+        seen = self.buffer.total
+        while True:
+            with self._new_sample:
+                if self.buffer.total == seen and self.running:
+                    self._new_sample.wait(timeout)
+            times, values, seen_now = self.buffer.since(seen)
+            if len(times) == 0:
+                if self.error is not None:
+                    raise nanonisException('Signal sampler failed: {}'.format(self.error))
+                if not self.running:
+                    return
+                if timeout is not None:
+                    raise nanonisException('No new sample within {} s'.format(timeout))
+            seen = seen_now
+            for t, v in zip(times, values):
+                yield t, v
+
+    def last(self, n=None):
+        return self.buffer.last(n)
+
+    def window(self, seconds):
+        return self.buffer.window(seconds)
+
+    def stats(self, n=None, seconds=None):
+        r'''
+        Statistics per channel over the last n samples or the last seconds:
+        dict of arrays with count, mean, std, min, max and absmax.
+        '''
+        if seconds is not None:
+            _, values = self.buffer.window(seconds)
+        else:
+            _, values = self.buffer.last(n)
+        if len(values) == 0:
+            empty = np.full(self.buffer.channels, np.nan)
+            return {'count': 0, 'mean': empty, 'std': empty, 'min': empty, 'max': empty, 'absmax': empty}
+        return {
+            'count': len(values),
+            'mean': values.mean(axis=0),
+            'std': values.std(axis=0),
+            'min': values.min(axis=0),
+            'max': values.max(axis=0),
+            'absmax': np.abs(values).max(axis=0),
+        }
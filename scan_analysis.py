@@ -0,0 +1,300 @@
+# scan_analysis.py
+r'''
+Vectorized analysis of scan frames.
+
+All filters work on a single frame (rows, cols) or on a stack of frames
+(..., rows, cols) at once, and ignore NaN pixels (lines not scanned yet).
+FrameGeometry converts between pixel indices and piezo coordinates of a
+scan frame of any size, resolution and angle.
+
+    geometry = FrameGeometry(center_x, center_y, width, height, angle, *data.shape)
+    row, col = lowest_points(data, k=1)[0]
+    x, y = geometry.pixel_to_piezo(row, col)
+'''
+
+import math
+import warnings
+
+import numpy as np
+
+
+class FrameGeometry:
+
+    r'''
+    Pixel <-> piezo transform of a scan frame.
+
+    Row 0 is the top edge of the frame (largest y before rotation), column 0 the left edge.
+    The frame is rotated by angle (degrees, clockwise) around its center,
+    like Scan.FrameSet.
+
+    Args:
+        center_x, center_y : float
+            Center of the frame (m).
+        width, height : float
+            Size of the frame (m).
+        angle : float
+            Rotation of the frame (degrees).
+        rows, cols : int
+            Resolution of the frame, cols defaults to rows.
+    '''
+
+    def __init__(self, center_x, center_y, width, height, angle=0., rows=256, cols=None):
+        self.center_x = center_x
+        self.center_y = center_y
+        self.width = width
+        self.height = height
+        self.angle = angle
+        self.rows = rows
+        self.cols = rows if cols is None else cols
+        self._cos = math.cos(math.radians(angle))
+        self._sin = math.sin(math.radians(angle))
+
+    @property
+    def pixel_size(self):
+        r'''(dx, dy) of one pixel (m).'''
+        return self.width / self.cols, self.height / self.rows
+
+    def pixel_to_piezo(self, row, col):
+        r'''Piezo coordinates (x, y) of pixel indices, scalars or arrays.'''
+        u = (np.asarray(col) / self.cols - 0.5) * self.width
+        v = (0.5 - np.asarray(row) / self.rows) * self.height
+        x = self.center_x + self._cos * u + self._sin * v
+        y = self.center_y - self._sin * u + self._cos * v
+        if x.ndim == 0:
+            return float(x), float(y)
+        return x, y
+
+    def piezo_to_pixel(self, x, y):
+        r'''Fractional pixel indices (row, col) of piezo coordinates, scalars or arrays.'''
+        dx = np.asarray(x) - self.center_x
+        dy = np.asarray(y) - self.center_y
+        u = self._cos * dx - self._sin * dy
+        v = self._sin * dx + self._cos * dy
+        row = (0.5 - v / self.height) * self.rows
+        col = (u / self.width + 0.5) * self.cols
+        if row.ndim == 0:
+            return float(row), float(col)
+        return row, col
+
+
+def _valid(data):
+    data = np.asarray(data, dtype=np.float64)
+    mask = np.isfinite(data)
+    return data, mask, np.where(mask, data, 0.)
+
+
+def plane_level(data):
+    r'''Subtract the least-squares plane of every frame.'''
+    data, mask, z = _valid(data)
+    rows, cols = data.shape[-2:]
+    u = np.arange(cols) - (cols - 1) / 2.
+    v = np.arange(rows) - (rows - 1) / 2.
+    w = mask.astype(np.float64)
+    # normal equations of z = a + b*u + c*v from row and column sums only
+    w_rows, w_cols = w.sum(-1), w.sum(-2)
+    n = w_rows.sum(-1)
+    su, sv = w_cols @ u, w_rows @ v
+    suu, svv, suv = w_cols @ (u * u), w_rows @ (v * v), (w @ u) @ v
+    sz, szu, szv = z.sum((-2, -1)), (z @ u).sum(-1), z.sum(-1) @ v
+    A = np.stack([np.stack([n, su, sv], -1),
+                  np.stack([su, suu, suv], -1),
+                  np.stack([sv, suv, svv], -1)], -2)
+    a, b, c = np.moveaxis((np.linalg.pinv(A) @ np.stack([sz, szu, szv], -1)[..., None])[..., 0], -1, 0)
+    plane = a[..., None, None] + b[..., None, None] * u + c[..., None, None] * v[:, None]
+    return data - plane
+
+
+def line_level(data, order=0):
+    r'''
+    Level every scan line on its own: order 0 subtracts the median of the line,
+    order 1 its least-squares line.
+    '''
+    data, mask, z = _valid(data)
+    if order == 0:
+        if mask.all():
+            return data - np.median(data, axis=-1, keepdims=True)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # lines without any valid pixel
+            return data - np.nanmedian(data, axis=-1, keepdims=True)
+    u = np.arange(data.shape[-1]) - (data.shape[-1] - 1) / 2.
+    w = mask.astype(np.float64)
+    n, su, suu = w.sum(-1), w @ u, w @ (u * u)
+    sz, szu = z.sum(-1), z @ u
+    det = n * suu - su * su
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where(det > 0, (n * szu - su * sz) / det, 0.)
+        offset = np.where(n > 0, (sz - slope * su) / n, 0.)
+    return data - offset[..., None] - slope[..., None] * u
+
+
+def _gaussian_kernel(sigma, truncate):
+    radius = max(1, int(truncate * sigma + 0.5))
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 * (x / sigma) ** 2)
+    return kernel / kernel.sum()
+
+
+def _shifted(padded, i, n, axis):
+    # window i..i+n of the padded array along axis -1 or -2, without copying
+    return padded[..., i:i + n] if axis == -1 else padded[..., i:i + n, :]
+
+
+def _convolve_axis(data, kernel, axis):
+    radius = len(kernel) // 2
+    n = data.shape[axis]
+    pad = [(0, 0)] * data.ndim
+    pad[axis] = (radius, radius)
+    padded = np.pad(data, pad)
+    out = kernel[0] * _shifted(padded, 0, n, axis)
+    for i in range(1, len(kernel)):
+        out += kernel[i] * _shifted(padded, i, n, axis)
+    return out
+
+
+def gaussian_smooth(data, sigma=1., truncate=3.):
+    r'''
+    Separable Gaussian filter of width sigma (pixels). NaN pixels and the outside of
+    the frame do not contribute (normalized convolution), pixels without any valid
+    neighbour stay NaN.
+    '''
+    data, mask, z = _valid(data)
+    if sigma <= 0:
+        return data
+    kernel = _gaussian_kernel(sigma, truncate)
+    numerator = _convolve_axis(_convolve_axis(z, kernel, -1), kernel, -2)
+    if mask.all():
+        # the weights only depend on the distance to the edges
+        rows, cols = data.shape[-2:]
+        weight = np.outer(_convolve_axis(np.ones(rows), kernel, -1), _convolve_axis(np.ones(cols), kernel, -1))
+    else:
+        weight = _convolve_axis(_convolve_axis(mask.astype(np.float64), kernel, -1), kernel, -2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(weight > 1e-12, numerator / weight, np.nan)
+
+
+def _box_sum(data, size):
+    # sum over a size x size window centered on every pixel, zero outside the frame
+    radius = size // 2
+    out = data
+    for axis in (-1, -2):
+        n = out.shape[axis]
+        pad = [(0, 0)] * out.ndim
+        pad[axis] = (radius + 1, radius)
+        cumulative = np.cumsum(np.pad(out, pad), axis=axis)
+        out = _shifted(cumulative, size, n, axis) - _shifted(cumulative, 0, n, axis)
+    return out
+
+
+def local_std(data, size=5):
+    r'''Standard deviation of the valid pixels in a size x size window around every pixel.'''
+    data, mask, z = _valid(data)
+    count = _box_sum(mask.astype(np.float64), size)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = _box_sum(z, size) / count
+        variance = _box_sum(z * z, size) / count - mean * mean
+    return np.where(count > 0, np.sqrt(np.maximum(variance, 0.)), np.nan)
+
+
+def _window_min(data, size, axis):
+    # minimum over a window of size pixels centered on every pixel along axis -1 or -2
+    radius = size // 2
+    n = data.shape[axis]
+    pad = [(0, 0)] * data.ndim
+    pad[axis] = (radius, size - 1 - radius)
+    padded = np.pad(data, pad, constant_values=np.inf)
+    out = _shifted(padded, 0, n, axis).copy()
+    for i in range(1, size):
+        np.minimum(out, _shifted(padded, i, n, axis), out=out)
+    return out
+
+
+def _first_of_flat(values, peaks, size):
+    # peaks in the window of each other have the same value (a flat minimum), keep the first of them
+    rows, cols = np.nonzero(peaks)
+    ranked = np.sort(values[rows, cols])
+    if not (ranked[1:] == ranked[:-1]).any():
+        return rows, cols
+    radius = size // 2
+    tied = np.flatnonzero(np.isin(values[rows, cols], ranked[1:][ranked[1:] == ranked[:-1]]))
+    if len(tied) <= 1024:
+        # compare the tied peaks pairwise, np.nonzero lists them in raster order
+        r, c = rows[tied], cols[tied]
+        near = (np.abs(r[:, None] - r) <= radius) & (np.abs(c[:, None] - c) <= radius)
+        keep = np.ones(len(rows), dtype=bool)
+        keep[tied] = ~np.tril(near, -1).any(axis=1)
+        return rows[keep], cols[keep]
+    index = np.where(peaks, np.arange(peaks.size, dtype=np.float64).reshape(peaks.shape), np.inf)
+    first = index
+    for axis in (-1, -2):
+        first = _window_min(first, size, axis)
+    return np.nonzero(peaks & (index == first))
+
+
+def local_minima(data, k=1, size=5, border=0):
+    r'''
+    The k lowest local minima of one frame: pixels which are the minimum of the
+    size x size window around them. A flat minimum (several equal pixels) counts once,
+    at its first pixel in raster order. Pixels closer than border to the edge are skipped.
+
+    Returns an int array of (row, col) pairs, lowest first (fewer than k if there are fewer minima).
+    '''
+    data = np.asarray(data, dtype=np.float64)
+    if data.ndim != 2:
+        raise ValueError('local_minima takes one frame, got shape {}'.format(data.shape))
+    finite = np.isfinite(data)
+    values = np.where(finite, data, np.inf)
+    window_min = values
+    for axis in (-1, -2):
+        window_min = _window_min(window_min, size, axis)
+    rows, cols = _first_of_flat(values, finite & (values == window_min), size)
+    if border > 0:
+        inside = (rows >= border) & (rows < data.shape[0] - border) & (cols >= border) & (cols < data.shape[1] - border)
+        rows, cols = rows[inside], cols[inside]
+    order = np.argsort(values[rows, cols], kind='stable')[:k]
+    return np.stack([rows[order], cols[order]], -1)
+
+
+def _per_frame(func, data, *args):
+    data = np.asarray(data)
+    if data.ndim == 2:
+        return func(data, *args)
+    return [func(frame, *args) for frame in data.reshape((-1,) + data.shape[-2:])]
+
+
+def lowest_points(data, k=1, sigma=1., size=5, border=0):
+    r'''
+    The k lowest areas of a frame after plane leveling and Gaussian smoothing,
+    as (row, col) pairs. A stack of frames returns one array per frame.
+    '''
+    smoothed = gaussian_smooth(plane_level(data), sigma)
+    return _per_frame(local_minima, smoothed, k, size, border)
+
+
+def flat_regions(data, k=1, size=9, border=0):
+    r'''
+    The centers of the k flattest size x size regions of a frame (lowest local
+    standard deviation after plane leveling), as (row, col) pairs.
+    A stack of frames returns one array per frame.
+    '''
+    roughness = local_std(plane_level(data), size)
+    return _per_frame(local_minima, roughness, k, size, max(border, size // 2))
+
+
+def found_low_area(frame, depth, sigma=1., size=5, margin=None, min_rows=8):
+    r'''
+    Early-stop test on a partially scanned frame (lines not scanned yet are NaN): True when
+    the lowest area of the completed lines lies at least depth below their median, and at
+    least margin lines (default size) away from any line not scanned yet, i.e. it is complete.
+    '''
+    done = np.isfinite(frame).all(axis=-1)
+    if done.sum() < min_rows:
+        return False
+    smoothed = gaussian_smooth(plane_level(frame), sigma)
+    points = local_minima(smoothed, 1, size)
+    if len(points) == 0:
+        return False
+    row, col = points[0]
+    pending = np.flatnonzero(~done)
+    if len(pending) and np.abs(pending - row).min() < (size if margin is None else margin):
+        return False
+    return np.nanmedian(smoothed) - smoothed[row, col] >= depth
@@ -0,0 +1,106 @@
+# scan_stream.py
+r'''
+Line-by-line acquisition of a running scan.
+
+ScanStream grabs the frame with Scan.FrameDataGrab on a fixed cadence while
+the scan runs and yields the lines completed since the previous grab, so
+the caller can analyse the frame as it grows and stop the scan as soon as
+it has seen enough, instead of waiting for the whole frame.
+
+    stream = nanonis.ScanStream(nanonis.SignalIndexGet('Z (m)'))
+    for row, line in stream.lines():
+        ...
+    frame = stream.run(lambda frame, rows: found_something(frame))
+'''
+
+import time
+
+import numpy as np
+
+
+class ScanStream:
+
+    r'''
+    Args:
+        session : NanonisController
+        channel_index : int
+            Signal index of the channel (see NanonisController.SignalIndexGet).
+        data_dir : int
+            1 forward, 0 backward data.
+        interval : float
+            Seconds between two frame grabs.
+        timeout : float
+            Stop the scan and give up after timeout seconds, None waits for the end of the scan.
+    '''
+
+    def __init__(self, session, channel_index, data_dir=1, interval=0.2, timeout=None):
+        self.session = session
+        self.channel_index = channel_index
+        self.data_dir = data_dir
+        self.interval = interval
+        self.timeout = timeout
+        self.frame = None  # latest frame, lines not scanned yet are NaN
+        self.done = None  # completed lines of self.frame
+        self.scan_direction = 0
+        self.grabs = 0
+        self.stopped_early = False
+
+    @property
+    def lines_done(self):
+        return 0 if self.done is None else int(self.done.sum())
+
+    def grab(self):
+        r'''Grab the frame once, returns the indices of the lines completed since the last grab in scan order.'''
+        result = self.session.ScanFrameData(self.channel_index, self.data_dir, view=True)
+        self.grabs += 1
+        frame = result['data'].astype(np.float32)  # native, and half the size of the default float64 copy
+        done = np.isfinite(frame).all(axis=1)
+        if self.done is None or self.done.shape != done.shape:
+            previous = np.zeros_like(done)
+        else:
+            previous = self.done
+        self.frame, self.done, self.scan_direction = frame, done, result['scan_direction']
+        new = np.flatnonzero(done & ~previous)
+        # 'down' scans (direction 0) fill the frame from the first row, 'up' scans from the last
+        return new if self.scan_direction == 0 else new[::-1]
+
+    def chunks(self):
+        r'''
+        Iterate over the indices of the lines completed by every grab while the scan runs,
+        the final frame included. Grabs without new lines are skipped.
+        '''
+        waiter = self.session.waiter
+        start = time.monotonic()
+        while True:
+            running = self.session.ScanStatusGet()
+            rows = self.grab()
+            if len(rows):
+                yield rows
+            if not running:
+                return
+            if self.timeout is not None and time.monotonic() - start >= self.timeout:
+                self.stop()
+                return
+            waiter.sleep(self.interval, 'scan stream')
+
+    def lines(self):
+        r'''Iterate over the completed lines as (row index, line) while the scan runs.'''
+        for rows in self.chunks():
+            for row in rows:
+                yield int(row), self.frame[row]
+
+    def run(self, predicate=None):
+        r'''
+        Follow the scan until it ends or predicate(frame, rows) returns True, in which case
+        the scan is stopped. predicate gets the partial frame (NaN where not scanned yet) and
+        the indices of the new lines after every grab. Returns the frame.
+        '''
+        for rows in self.chunks():
+            if predicate is not None and predicate(self.frame, rows):
+                self.stop()
+                break
+        return self.frame
+
+    def stop(self):
+        self.session.ScanStop()
+        self.stopped_early = True
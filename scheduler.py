@@ -0,0 +1,179 @@
+# scheduler.py
+r'''
+Concurrent execution of a DAG of operations.
+
+Every Operate subclass declares the hardware it drives in its resources
+attribute (see core.Resource); operations without a declaration hold all
+resources. OperationScheduler runs the nodes of a DAG on worker threads as
+soon as their dependencies are done and none of their resources is held by
+a running node, so e.g. a PLL check can overlap the analysis of the last
+frame or a telemetry flush, but never a bias pulse and a Z move.
+
+    scheduler = OperationScheduler()
+    scheduler.add('pll', CheckFrequencyShift(nanonis))
+    scheduler.add('analysis', lambda: lowest_points(frame), resources=())
+    scheduler.add('pulse', MultiPulse(nanonis, 7), after=['pll'])
+    results = scheduler.run()
+
+tasks.TipRepairOn2DIce.SingleAreaTipRepairer uses it to let the PLL lock
+while the tip moves to the next point and Z settles.
+'''
+
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from core import Operate
+from interface import current_deadline, nanonisException, set_deadline
+
+
+class ResourceLocks:
+
+    r'''
+    All-or-nothing locks on sets of resources: a set is acquired only when none of its
+    resources is held, so two holders can never deadlock on each other.
+    '''
+
+    def __init__(self):
+        self.held = {}  # resource -> name of the holder
+        self._changed = threading.Condition()
+
+    def available(self, resources):
+        return not any(resource in self.held for resource in resources)
+
+    def try_acquire(self, resources, holder):
+        with self._changed:
+            if not self.available(resources):
+                return False
+            for resource in resources:
+                self.held[resource] = holder
+            return True
+
+    def acquire(self, resources, holder, timeout=None):
+        with self._changed:
+            if not self._changed.wait_for(lambda: self.available(resources), timeout):
+                raise nanonisException('{} could not get {} within {} s (held by {})'.format(
+                    holder, ', '.join(r.name for r in resources), timeout,
+                    ', '.join(sorted({self.held[r] for r in resources if r in self.held}))))
+            for resource in resources:
+                self.held[resource] = holder
+
+    def release(self, resources):
+        with self._changed:
+            for resource in resources:
+                self.held.pop(resource, None)
+            self._changed.notify_all()
+
+    @contextmanager
+    def hold(self, resources, holder='', timeout=None):
+        r'''Hold resources for the block.'''
+        self.acquire(resources, holder, timeout)
+        try:
+            yield
+        finally:
+            self.release(resources)
+
+
+class Node:
+
+    def __init__(self, name, task, after, resources):
+        self.name = name
+        self.task = task
+        self.after = tuple(after)
+        self.resources = frozenset(resources)
+        self.result = None
+        self.error = None
+        self.state = 'pending'  # pending, running, done, failed, skipped
+
+
+class OperationScheduler:
+
+    r'''
+    Args:
+        max_workers : int
+            Number of operations running at the same time at most.
+        locks : ResourceLocks
+            Share one ResourceLocks between schedulers of the same session.
+    '''
+
+    def __init__(self, max_workers=4, locks=None):
+        self.max_workers = max_workers
+        self.locks = ResourceLocks() if locks is None else locks
+        self.nodes = {}
+
+    def add(self, name, task, after=(), resources=None):
+        r'''
+        Add a node. task is an Operate (run with do()) or any callable; resources defaults
+        to the resources of the Operate, and to none for a plain callable.
+        after lists the names of the nodes which must be done first.
+        '''
+        if name in self.nodes:
+            raise nanonisException('Duplicate operation {}'.format(name))
+        for dependency in after:
+            if dependency not in self.nodes:
+                raise nanonisException('{} depends on unknown operation {}'.format(name, dependency))
+        if resources is None:
+            resources = task.resources if isinstance(task, Operate) else ()
+        self.nodes[name] = Node(name, task, after, resources)
+        return name
+
+    def _execute(self, node, deadline):
+        # the nodes run under the deadline of the thread calling run()
+        previous = set_deadline(deadline)
+        try:
+            if isinstance(node.task, Operate):
+                return node.task.do()
+            return node.task()
+        finally:
+            set_deadline(previous)
+            self.locks.release(node.resources)
+
+    def _ready(self, node):
+        return node.state == 'pending' and all(self.nodes[d].state == 'done' for d in node.after)
+
+    def run(self):
+        r'''
+        Run every node, returns name -> result. When a node fails, its dependents are skipped,
+        no new node is started, and the first error is raised once the running nodes are done.
+        '''
+        running = {}
+        error = None
+        deadline = current_deadline()
+        with ThreadPoolExecutor(self.max_workers, thread_name_prefix='Operation') as pool:
+            while True:
+                if error is None:
+                    # start in insertion order whatever is ready and free
+                    for node in self.nodes.values():
+                        if len(running) >= self.max_workers:
+                            break
+                        if self._ready(node) and self.locks.try_acquire(node.resources, node.name):
+                            node.state = 'running'
+                            running[pool.submit(self._execute, node, deadline)] = node
+                if not running:
+                    ready = [node for node in self.nodes.values() if self._ready(node)] if error is None else []
+                    if not ready:
+                        break
+                    # the resources are held outside this scheduler (shared locks), wait for them
+                    node = ready[0]
+                    self.locks.acquire(node.resources, node.name)
+                    node.state = 'running'
+                    running[pool.submit(self._execute, node, deadline)] = node
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    try:
+                        node.result = future.result()
+                        node.state = 'done'
+                    except Exception as e:
+                        node.error = e
+                        node.state = 'failed'
+                        logging.error('Operation {} failed: {}'.format(node.name, e))
+                        if error is None:
+                            error = e
+        for node in self.nodes.values():
+            if node.state == 'pending':
+                node.state = 'skipped'
+        if error is not None:
+            raise error
+        return {name: node.result for name, node in self.nodes.items()}
@@ -0,0 +1,139 @@
+# signal_registry.py
+r'''
+Indexed table of the Nanonis signal names.
+
+Signals.NamesGet is parsed once into name -> index and index -> name
+dictionaries holding the raw Nanonis indices, which are the indices
+expected by Signals.ValGet, Signals.ValsGet and Scan.FrameDataGrab.
+The table can be shared across sessions through an on-disk cache keyed
+by host and port, and expires after a time-to-live (a day by default), so
+a table cached from another Nanonis (e.g. the simulator on localhost) is
+not used for long.
+'''
+
+import json
+import logging
+import os
+import time
+
+from interface import nanonisException
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'nanonis_control')
+DEFAULT_TTL = 24 * 3600.
+
+
+class SignalRegistry:
+
+    r'''
+    Args:
+        fetch : callable
+            Returns the list of all signal names in Nanonis order (one Signals.NamesGet).
+        host : str
+            Key of the on-disk cache, with port.
+        ttl : float
+            Seconds after which the table is fetched again, None never expires
+            (use refresh() after changing the signals in Nanonis).
+        cache_dir : str
+            Directory of the on-disk cache, None disables it.
+        port : int
+    '''
+
+    def __init__(self, fetch=None, host='127.0.0.1', ttl=DEFAULT_TTL, cache_dir=DEFAULT_CACHE_DIR, port=6501):
+        self.fetch = fetch
+        self.host = host
+        self.port = port
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self.names = []
+        self.index_of = {}
+        self.name_of = {}
+        self.loaded_at = None
+        self.fetches = 0
+
+    @property
+    def cache_path(self):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, 'signals-{}-{}.json'.format(self.host.replace(':', '_'), self.port))
+
+    def expired(self):
+        if self.loaded_at is None:
+            return True
+        return self.ttl is not None and time.time() - self.loaded_at > self.ttl
+
+    def update(self, names, loaded_at=None, save=True):
+        r'''Replace the table with a fresh list of names.'''
+        self.names = list(names)
+        self.index_of = {}
+        for index, name in enumerate(self.names):
+            self.index_of.setdefault(name, index)
+        self.name_of = dict(enumerate(self.names))
+        self.loaded_at = time.time() if loaded_at is None else loaded_at
+        if save:
+            self._save()
+
+    def refresh(self):
+        r'''Fetch the names from Nanonis now.'''
+        if self.fetch is None:
+            raise nanonisException('Signal registry has no fetch function')
+        self.fetches += 1
+        self.update(self.fetch())
+
+    def ensure(self):
+        r'''Load the table from memory, the on-disk cache or Nanonis, whichever is still valid.'''
+        if not self.expired():
+            return
+        if self._load():
+            return
+        self.refresh()
+
+    def invalidate(self):
+        r'''Drop the table in memory and on disk.'''
+        self.loaded_at = None
+        path = self.cache_path
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+    def index(self, name):
+        self.ensure()
+        try:
+            return self.index_of[name]
+        except KeyError:
+            raise nanonisException('Invalid signal name: {}'.format(name))
+
+    def name(self, index):
+        self.ensure()
+        try:
+            return self.name_of[index]
+        except KeyError:
+            raise nanonisException('Invalid signal index: {}'.format(index))
+
+    def _load(self):
+        path = self.cache_path
+        if path is None or not os.path.exists(path):
+            return False
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+            loaded_at = cached['time']
+            names = cached['names']
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning('Ignoring broken signal cache {}: {}'.format(path, e))
+            return False
+        if self.ttl is not None and time.time() - loaded_at > self.ttl:
+            return False
+        self.update(names, loaded_at, save=False)
+        return True
+
+    def _save(self):
+        path = self.cache_path
+        if path is None:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temporary = path + '.tmp'
+            with open(temporary, 'w') as f:
+                json.dump({'host': self.host, 'port': self.port, 'time': self.loaded_at, 'names': self.names}, f)
+            os.replace(temporary, path)
+        except OSError as e:
+            logging.warning('Cannot write signal cache {}: {}'.format(path, e))
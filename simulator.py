@@ -0,0 +1,509 @@
+# simulator.py
+r'''
+A local stand-in for Nanonis which speaks the 40 byte header TCP protocol,
+so NanonisController, the modules and the tasks can run without hardware.
+
+The simulator keeps a small state model of the Bias, ZCtrl, FolMe, Motor,
+AutoApproach, PLL, Piezo, Scan and Signals modules. Every response is
+delayed by a configurable latency plus a seeded random jitter, which makes
+throughput and latency measurements of the client reproducible.
+
+Run it from a script or a test:
+    sim = NanonisSimulator(port=0, latency=1e-3).start()
+    nanonis = NanonisController('127.0.0.1', sim.port, signal_cache_dir=None)
+    ...
+    sim.stop()
+
+Or from the command line:
+    python simulator.py --port 6501 --latency 0.002 --jitter 0.001
+'''
+
+import asyncio
+import math
+import random
+import socket
+import struct
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+from interface import command_registry, construct_header, nanonisException
+from scan_analysis import FrameGeometry
+
+
+SIGNAL_NAMES = ['Current (A)', 'Bias (V)', 'Z (m)', 'X (m)', 'Y (m)'] + \
+               ['Input {} (V)'.format(i) for i in range(1, 25)] + \
+               ['Output {} (V)'.format(i) for i in range(1, 9)] + \
+               ['Phase (deg)', 'Amplitude (m)', 'Frequency Shift (Hz)', 'Excitation (V)']
+
+
+class SimulatorState:
+
+    r'''
+    The simulated instrument. All values are in SI units.
+    '''
+
+    def __init__(self, seed=0, pixels=256, scan_time=2.0, approach_time=0.5, motor_step_time=1e-3):
+        self.rng = random.Random(seed)
+        self.pixels = pixels
+        self.scan_time = scan_time
+        self.approach_time = approach_time
+        self.motor_step_time = motor_step_time
+
+        self.bias = 0.1
+        self.x = 0.
+        self.y = 0.
+        self.z = 0.
+        self.z_ctrl_on = 0
+        self.setpoint = 1e-10
+        self.gain = [1e-11, 5e-5, 2e-7]
+        self.z_limits = (2e-7, -2e-7)
+        self.piezo_range = (1e-6, 1e-6, 4e-7)
+        self.surface = 0.  # height of the surface below the tip at the feedback setpoint
+        self.approached = False
+        self.approach_end = None
+        self.motor_position = [0, 0, 0]
+
+        self.pll_output = 0
+        self.pll_amp_ctrl = 0
+        self.pll_phase_ctrl = 0
+        self.freq_shift = -8.
+        self.freq_shift_target = -1.5
+        self.elevate_probability = 0.6
+
+        self.scan_frame = (0., 0., 1.5e-7, 5e-8, 0.)
+        self.scan_start = None
+        self.scan_direction = 0
+        self.scan_progress = 1.  # fraction of the last frame scanned, kept when the scan is stopped
+
+        self.user_out_mode = {}
+        self.user_out = {}
+        self.etch_start = None
+        self.tip_shaper_props = None
+
+    # topography and signals
+
+    def topography(self, x, y):
+        r'''Synthetic surface height (m): a tilted plane with a few terraces and dips.'''
+        return 2e-10 * np.sin(x / 3e-8) * np.cos(y / 4e-8) + 5e-3 * x - 2e-3 * y - \
+            3e-10 * np.exp(-((x - 2e-8) ** 2 + (y + 1e-8) ** 2) / (2 * (1e-8) ** 2))
+
+    def scan_fraction(self):
+        if self.scan_start is None:
+            return self.scan_progress
+        return min(1., (time.monotonic() - self.scan_start) / self.scan_time)
+
+    def update(self):
+        now = time.monotonic()
+        if self.approach_end is not None and now >= self.approach_end:
+            self.approach_end = None
+            self.approached = True
+            self.z_ctrl_on = 1
+            self.surface = self.rng.uniform(-5e-8, 5e-8)
+        if self.scan_start is not None and now - self.scan_start >= self.scan_time:
+            self.scan_start = None
+            self.scan_progress = 1.
+        if self.z_ctrl_on and self.approached:
+            self.z = self.surface + float(self.topography(self.x, self.y))
+            self.z = min(max(self.z, self.z_limits[1]), self.z_limits[0])
+
+    def current(self):
+        self.update()
+        if self.z_ctrl_on and self.approached:
+            return self.setpoint * (1 + self.rng.gauss(0, 0.02))
+        return self.rng.gauss(0, 1e-13)
+
+    def signal(self, index):
+        name = SIGNAL_NAMES[index] if 0 <= index < len(SIGNAL_NAMES) else ''
+        if name == 'Current (A)':
+            return self.current()
+        if name == 'Bias (V)':
+            return self.bias
+        if name == 'Z (m)':
+            self.update()
+            return self.z
+        if name == 'X (m)':
+            return self.x
+        if name == 'Y (m)':
+            return self.y
+        if name == 'Frequency Shift (Hz)':
+            return self.freq_shift
+        if name.startswith('Input') and self.etch_start is not None:
+            # voltage over the etching resistor, decays while the wire thins
+            elapsed = time.monotonic() - self.etch_start
+            return 0.05 * math.exp(-elapsed / 2.) + self.rng.gauss(0, 1e-4)
+        return self.rng.gauss(0, 1e-3)
+
+    def frame(self, channel_index, data_dir):
+        r'''Synthetic frame of the current scan, lines not scanned yet are NaN.'''
+        cx, cy, w, h, angle = self.scan_frame
+        rows = cols = self.pixels
+        row, col = np.mgrid[0:rows, 0:cols]
+        xx, yy = FrameGeometry(cx, cy, w, h, angle, rows, cols).pixel_to_piezo(row, col)
+        name = SIGNAL_NAMES[channel_index] if 0 <= channel_index < len(SIGNAL_NAMES) else 'Unknown'
+        if name == 'Current (A)':
+            data = self.setpoint * (1 + 0.02 * np.sin(xx / 1e-9))
+        else:
+            data = self.surface + self.topography(xx, yy)
+        data = data.astype(np.float32)
+        if data_dir == 0:
+            data = data[:, ::-1]
+        progress = self.scan_fraction()
+        if progress < 1.:
+            done = int(rows * progress)
+            if self.scan_direction == 0:
+                data[done:, :] = np.nan
+            else:
+                data[:rows - done, :] = np.nan
+        return name, data
+
+
+def pack_string(value):
+    encoded = value.encode('latin1')
+    return struct.pack('>i', len(encoded)) + encoded
+
+
+class NanonisSimulator:
+
+    r'''
+    Asyncio TCP server simulating Nanonis.
+
+    Args:
+        host : str
+        port : int
+            0 picks a free port, read it back from .port after start().
+        ports : optional list of ports, all served from the same state (like Nanonis 6501-6504).
+        latency : float
+            Delay (s) added to every response.
+        jitter : float
+            Maximum random deviation (s) of the delay, drawn from a seeded generator.
+        seed : int
+        state : SimulatorState
+    '''
+
+    def __init__(self, host='127.0.0.1', port=6501, ports=None, latency=0., jitter=0., seed=0, state=None):
+        self.host = host
+        self.ports = list(ports) if ports is not None else [port]
+        self.latency = latency
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.state = state if state is not None else SimulatorState(seed)
+        self.command_counts = Counter()
+        self.handlers = {}
+        self._register_handlers()
+        self._loop = None
+        self._servers = []
+        self._thread = None
+        self._ready = threading.Event()
+        self.faults = []  # [command name or None, 'before' or 'after'], see drop_connection
+
+    @property
+    def port(self):
+        return self.ports[0]
+
+    def drop_connection(self, command_name=None, when='before'):
+        r'''
+        Close the client connection at the next command_name (any command if None), 'before' executing it
+        or 'after' executing it but before answering, to test the recovery of the client.
+        '''
+        self.faults.append([command_name, when])
+
+    def _fault(self, command_name):
+        for fault in self.faults:
+            if fault[0] is None or fault[0] == command_name:
+                self.faults.remove(fault)
+                return fault[1]
+        return None
+
+    # server plumbing
+
+    async def _serve_client(self, reader, writer):
+        responses = asyncio.Queue()
+        writer_task = asyncio.ensure_future(self._write_responses(writer, responses))
+        try:
+            while True:
+                header = await reader.readexactly(40)
+                command_name = header[:32].rstrip(b'\0').decode('latin1')
+                body_size = struct.unpack('>i', header[32:36])[0]
+                body = await reader.readexactly(body_size)
+                fault = self._fault(command_name)
+                if fault == 'before':
+                    break  # the command is lost
+                response_body = await self.dispatch(command_name, body)
+                self.command_counts[command_name] += 1
+                if fault == 'after':
+                    break  # executed, but the response is lost
+                if header[36:38] == b'\0\0':
+                    continue  # the client does not want a response
+                delay = max(0., self.latency + self.rng.uniform(-self.jitter, self.jitter))
+                await responses.put((time.monotonic() + delay,
+                                     construct_header(command_name, len(response_body)) + response_body))
+        except (asyncio.IncompleteReadError, asyncio.CancelledError, ConnectionError):
+            pass
+        finally:
+            writer_task.cancel()
+            writer.close()
+
+    async def _write_responses(self, writer, responses):
+        # Responses leave in order, each one not before its own due time, so
+        # pipelined commands share the latency instead of adding it up.
+        while True:
+            due, message = await responses.get()
+            wait = due - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            writer.write(message)
+            await writer.drain()
+
+    async def serve(self):
+        for i, port in enumerate(self.ports):
+            server = await asyncio.start_server(self._serve_client, self.host, port)
+            for sock in server.sockets:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.ports[i] = server.sockets[0].getsockname()[1]
+            self._servers.append(server)
+
+    def start(self):
+        r'''Run the server on an event loop in a daemon thread. Returns self.'''
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self.serve())
+            self._ready.set()
+            self._loop.run_forever()
+            for server in self._servers:
+                server.close()
+            tasks = asyncio.all_tasks(self._loop)
+            for task in tasks:
+                task.cancel()
+            self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self._loop.close()
+        self._thread = threading.Thread(target=run, name='NanonisSimulator', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    # commands
+
+    async def dispatch(self, command_name, body):
+        r'''
+        Run the handler of a command and return the response body including the error fields.
+        Registered commands get their arguments decoded and their values encoded by the command codec.
+        '''
+        handler = self.handlers.get(command_name)
+        if handler is None:
+            message = ('Unknown command: ' + command_name).encode('latin1')
+            return struct.pack('>Ii', 1, len(message)) + message
+        codec = command_registry.get(command_name)
+        if codec is not None:
+            if len(body) != codec.packer.size:
+                raise nanonisException('Simulator received a malformed ' + command_name)
+            values = await handler(*codec.packer.unpack(body))
+            if values is None:
+                values = ()
+            return codec.unpacker.pack(*values, 0, 0)
+        return await handler(body) + struct.pack('>Ii', 0, 0)
+
+    def _register_handlers(self):
+        st = self.state
+
+        def setter(attribute):
+            async def handler(value):
+                setattr(st, attribute, value)
+            return handler
+
+        def getter(read):
+            async def handler(*args):
+                st.update()
+                return read(*args)
+            return handler
+
+        h = self.handlers
+        h['Bias.Set'] = setter('bias')
+        h['Bias.Get'] = getter(lambda: (st.bias,))
+        h['Bias.Pulse'] = self._bias_pulse
+        h['FolMe.XYPosSet'] = self._xy_set
+        h['FolMe.XYPosGet'] = getter(lambda wait: (st.x, st.y))
+        h['ZCtrl.ZPosSet'] = self._z_set
+        h['ZCtrl.ZPosGet'] = getter(lambda: (st.z,))
+        h['ZCtrl.OnOffSet'] = self._z_ctrl_set
+        h['ZCtrl.OnOffGet'] = getter(lambda: (st.z_ctrl_on,))
+        h['ZCtrl.Withdraw'] = self._withdraw
+        h['ZCtrl.Home'] = self._home
+        h['ZCtrl.SetpntSet'] = setter('setpoint')
+        h['ZCtrl.SetpntGet'] = getter(lambda: (st.setpoint,))
+        h['ZCtrl.GainSet'] = self._gain_set
+        h['ZCtrl.GainGet'] = getter(lambda: tuple(st.gain))
+        h['ZCtrl.LimitsGet'] = getter(lambda: st.z_limits)
+        h['Current.Get'] = getter(lambda: (st.current(),))
+        h['Motor.StartMove'] = self._motor_move
+        h['AutoApproach.Open'] = getter(lambda: ())
+        h['AutoApproach.OnOffSet'] = self._approach_set
+        h['AutoApproach.OnOffGet'] = getter(lambda: (int(st.approach_end is not None),))
+        h['PLL.OutOnOffSet'] = self._pll_set('pll_output')
+        h['PLL.AmpCtrlOnOffSet'] = self._pll_set('pll_amp_ctrl')
+        h['PLL.PhasCtrlOnOffSet'] = self._pll_set('pll_phase_ctrl')
+        h['PLL.FreqShiftGet'] = getter(lambda modulator: (st.freq_shift,))
+        h['Piezo.RangeGet'] = getter(lambda: st.piezo_range)
+        h['Scan.Action'] = self._scan_action
+        h['Scan.StatusGet'] = getter(lambda: (int(st.scan_start is not None),))
+        h['Scan.FrameSet'] = self._scan_frame_set
+        h['Scan.FrameDataGrab'] = self._frame_data_grab
+        h['Scan.WaitEndOfScan'] = self._wait_end_of_scan
+        h['Signals.NamesGet'] = self._names_get
+        h['Signals.ValGet'] = getter(lambda index, wait: (st.signal(index),))
+        h['Signals.ValsGet'] = self._vals_get
+        h['UserOut.ModeSet'] = self._user_out_mode_set
+        h['UserOut.ValSet'] = self._user_out_set
+        h['TipShaper.PropsSet'] = self._tip_shaper_props_set
+
+    async def _bias_pulse(self, wait, width, bias, z_hold, mode):
+        st = self.state
+        if wait:
+            await asyncio.sleep(width)
+        st.update()
+        if st.approached and st.rng.random() < st.elevate_probability:
+            st.surface += st.rng.uniform(1e-11, 1e-10)  # the tip apex got longer
+        # every pulse moves the frequency shift a bit towards the good tip
+        st.freq_shift += (st.freq_shift_target - st.freq_shift) * st.rng.uniform(0.05, 0.3)
+
+    async def _xy_set(self, x, y, wait):
+        st = self.state
+        st.x, st.y = x, y
+
+    async def _z_set(self, z):
+        st = self.state
+        if not st.z_ctrl_on:
+            st.z = z
+
+    async def _z_ctrl_set(self, on):
+        st = self.state
+        st.z_ctrl_on = int(on)
+
+    async def _withdraw(self, wait, timeout):
+        st = self.state
+        st.z_ctrl_on = 0
+        st.z = st.z_limits[0]
+
+    async def _home(self):
+        st = self.state
+        st.z_ctrl_on = 0
+        st.z = 0.
+
+    async def _gain_set(self, p, t, i):
+        self.state.gain = [p, t, i]
+
+    async def _motor_move(self, direction, steps, group, wait):
+        st = self.state
+        axis, sign = divmod(direction, 2)
+        st.motor_position[axis] += -steps if sign else steps
+        if direction == 4:  # Z+ retracts the tip from the surface
+            st.approached = False
+            st.z_ctrl_on = 0
+        if wait:
+            await asyncio.sleep(steps * st.motor_step_time)
+
+    async def _approach_set(self, on):
+        st = self.state
+        if on:
+            st.approach_end = time.monotonic() + st.approach_time
+        else:
+            st.approach_end = None
+
+    def _pll_set(self, attribute):
+        async def handler(modulator, on):
+            setattr(self.state, attribute, on)
+        return handler
+
+    async def _scan_action(self, action, direction):
+        st = self.state
+        if action == 0:
+            st.scan_start = time.monotonic()
+            st.scan_direction = direction
+        elif action == 1:
+            if st.scan_start is not None:
+                st.scan_progress = st.scan_fraction()
+            st.scan_start = None
+
+    async def _scan_frame_set(self, cx, cy, w, h, angle):
+        self.state.scan_frame = (cx, cy, w, h, angle)
+
+    async def _frame_data_grab(self, body):
+        channel_index, data_dir = struct.unpack('>II', body)
+        st = self.state
+        st.update()
+        name, data = st.frame(channel_index, data_dir)
+        rows, cols = data.shape
+        return pack_string(name) + struct.pack('>ii', rows, cols) + \
+            data.astype('>f4').tobytes() + struct.pack('>I', st.scan_direction)
+
+    async def _wait_end_of_scan(self, body):
+        timeout = struct.unpack('>i', body)[0]
+        st = self.state
+        st.update()
+        deadline = None if timeout < 0 else time.monotonic() + timeout / 1000
+        while st.scan_start is not None:
+            if deadline is not None and time.monotonic() >= deadline:
+                return struct.pack('>Ii', 1, 0)
+            await asyncio.sleep(0.01)
+            st.update()
+        return struct.pack('>Ii', 0, 0)
+
+    async def _names_get(self, body):
+        names = b''.join(pack_string(name) for name in SIGNAL_NAMES)
+        return struct.pack('>ii', len(names), len(SIGNAL_NAMES)) + names
+
+    async def _vals_get(self, body):
+        count = struct.unpack_from('>i', body)[0]
+        indices = struct.unpack_from('>{}i'.format(count), body, 4)
+        values = [self.state.signal(index) for index in indices]
+        return struct.pack('>i{}f'.format(count), count, *values)
+
+    async def _user_out_mode_set(self, output, mode):
+        self.state.user_out_mode[output] = mode
+
+    async def _user_out_set(self, output, value):
+        st = self.state
+        st.user_out[output] = value
+        st.etch_start = time.monotonic() if value != 0 else None
+
+    async def _tip_shaper_props_set(self, *props):
+        self.state.tip_shaper_props = props
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Local Nanonis TCP simulator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, nargs='+', default=[6501])
+    parser.add_argument('--latency', type=float, default=0.)
+    parser.add_argument('--jitter', type=float, default=0.)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    simulator = NanonisSimulator(args.host, ports=args.port, latency=args.latency,
+                                 jitter=args.jitter, seed=args.seed)
+
+    async def main():
+        await simulator.serve()
+        print('Nanonis simulator listening on {} port(s) {}'.format(args.host, simulator.ports))
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
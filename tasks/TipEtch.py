@@ -1,48 +1,55 @@
 # TipEtch.py by CoccaGuo at 2022/05/19 14:00
 
-import time
 import matplotlib.pyplot as plt
-from core import Operate
+from core import Operate, Resource
+from sampler import SignalSampler
 
 
 class TipEtch(Operate):
-    def __init__(self, session, etch_level='200u', volt=-10, input=7, output=2, resistance=100, N=4):
+    resources = frozenset({Resource.USER_OUTPUT})
+
+    def __init__(self, session, etch_level='200u', volt=-10, input=7, output=2, resistance=100, N=4,
+                 rate=10, buffer_size=36000):
         super().__init__(session)
         self.etch_level = self.session.try_convert(etch_level)
         self.volt = self.session.try_convert(volt)
         self.input = input
+        # raw signal index of the input, resolved once through the signal registry
+        self.channel = self.session.SignalIndexGet('Input {} (V)'.format(input))
         self.output = output
         self.resistance = resistance
         self.N = N
+        self.rate = rate  # samples per second
+        self.buffer_size = buffer_size  # samples kept for the etching curve
 
     def curr(self):
-        ch = self.input - 1
-        volt = self.session.parse_response(self.session.send('Signals.ValGet', 'int', ch, 'uint32', 1), 'float32')['0']
+        volt = self.session.query('Signals.ValGet', self.channel, 1)
         return volt / self.resistance
     
     def bias(self, value):
-        self.session.send('UserOut.ValSet', 'int', self.output, 'float32', value)
+        self.session.query('UserOut.ValSet', self.output, value)
 
     def _operate(self):
-        current_list = []
         self.bias(self.volt)
-        i = self.curr()
-        count = 0
-        while count < self.N:
-            i = self.curr()
-            if abs(i) < self.etch_level:
-                count += 1
-            current_list.append(i*1000)
-            time.sleep(0.1)
-        self.bias(0)
-        plt.plot(current_list)
+        sampler = SignalSampler(self.session, [self.channel], self.rate, self.buffer_size, wait=True)
+        try:
+            with sampler:
+                for _ in sampler.samples():
+                    # etching is finished when the last N samples are all below the etch level
+                    stats = sampler.stats(n=self.N)
+                    if stats['count'] == self.N and stats['absmax'][0] / self.resistance < self.etch_level:
+                        break
+        finally:
+            self.bias(0)
+        times, volts = sampler.last()
+        plt.plot(times - times[0], volts[:, 0] / self.resistance * 1000)
         plt.title('Tip Etching Curve')
-        plt.xlabel('Time (0.1s)')
+        plt.xlabel('Time (s)')
         plt.ylabel('Current (mA)')
         plt.show()
 
     def safety_check(self):
-        self.session.send('UserOut.ModeSet', 'int', self.output, 'uint16', 0)
+        self.session.query('UserOut.ModeSet', self.output, 0)
         return True
 
 
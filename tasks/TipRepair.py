@@ -3,11 +3,13 @@
 import logging
 import time
 from core import ExceptionType, Operate
-from interface import nanonisException
+from deadline import unbounded
+from interface import Cancelled, current_deadline, nanonisException
 from modules.IterateOperation import IterateOperation
 from modules.BaisOperation import MultiPulse
 from modules.MotorOperation import ChangeArea
 from modules.PLLOperation import CheckFrequencyShift
+from profiler import log_run_report
 
 
 class SingleAreaTipRepairer(IterateOperation):
@@ -19,8 +21,9 @@ class SingleAreaTipRepairer(IterateOperation):
      - check frequency shift
     '''
 
-    def __init__(self, session, gridX='200n', gridY='200n', padding='15n', interval_time=1, init_pulse=7):
-        super().__init__(session, gridX, gridY, padding, interval_time)
+    def __init__(self, session, gridX='200n', gridY='200n', padding='15n', interval_time=1, init_pulse=7, planner='spiral',
+                 checkpoint=None, area=0):
+        super().__init__(session, gridX, gridY, padding, interval_time, planner, checkpoint=checkpoint, area=area)
         self.multi_pulse = MultiPulse(self.session, init_pulse)
 
     def _task(self):
@@ -43,6 +46,9 @@ class SingleAreaTipRepairer(IterateOperation):
                 logging.warn('Pulse bais set to {}'.format(
                     self.multi_pulse.value))
 
+    def progress(self):
+        return {'pulse_bias': self.multi_pulse.value}
+
     def _operate(self):
         try:
             super()._operate()
@@ -59,11 +65,26 @@ class SingleAreaTipRepairer(IterateOperation):
 
 class TipRepair(Operate):
 
-    def __init__(self, session, direction='Y-', init_pulse_bias=7, area_counts=100):
+    def __init__(self, session, direction='Y-', init_pulse_bias=7, area_counts=100, checkpoint=None, report_path=None,
+                 area_timeout=None):
         super().__init__(session)
         self.direction = direction
         self.pulse_bias = init_pulse_bias
         self.area_counts = area_counts
+        # time budget (s) of every area, an area running out of it is skipped
+        self.area_timeout = area_timeout
+        self.checkpoint = checkpoint
+        # the profile of a profiled session is exported there at the end of the run
+        self.report_path = report_path
+
+    def out_of_time(self):
+        r'''Whether the deadline of the whole run (not just of an area) passed.'''
+        deadline = current_deadline()
+        return deadline is not None and deadline.expired
+
+    def save(self, **state):
+        if self.checkpoint is not None:
+            self.checkpoint.update(**state)
 
     def safety_check(self):
         logging.warn('Start Auto Tip Repairing Operation')
@@ -77,33 +98,48 @@ class TipRepair(Operate):
             self.session.MotorMoveSet('Z+', 10)
         logging.info('Try auto approach')
         self.session.AutoApproachOpen()
-        # wait till auto-approach is finished
-        while self.session.AutoApproachGet():
-            time.sleep(2)
+        self.session.WaitForApproach()
         logging.info('Auto approach finished')
         self.session.Withdraw()
         logging.info('Basic Safety check finished.')
-        time.sleep(1)
+        self.session.waiter.sleep(1, 'safety check')
         return True
 
     def _operate(self):
         time_start = time.time()  # record the start time
         logging.info('Start tip repairing process')
         count = 0
+        if self.checkpoint is not None:
+            count = self.checkpoint.get('area', 0)
+            self.pulse_bias = self.checkpoint.get('pulse_bias', self.pulse_bias)
+            logging.info('Resuming at area {}, pulse bias {}'.format(count, self.pulse_bias))
+            if self.checkpoint.get('moving', False):
+                ChangeArea(self.session).do()
+                self.save(moving=False)
         while count < self.area_counts:
             try:
                 self.pulse_bias = SingleAreaTipRepairer(
-                    self.session, init_pulse=self.pulse_bias).do()
+                    self.session, init_pulse=self.pulse_bias, checkpoint=self.checkpoint, area=count).do(self.area_timeout)
                 count += 1
                 logging.warn('Area number {} finished'.format(count))
+                self.save(area=count, pulse_bias=self.pulse_bias, moving=True)
                 ChangeArea(self.session).do()
+                self.save(moving=False)
+            except Cancelled as e:
+                if self.out_of_time():
+                    raise
+                # only the budget of this area ran out, the next one gets a fresh one
+                logging.warn('Area number {} skipped: {}'.format(count + 1, e))
+                self.session.Withdraw()
+                count += 1
+                self.save(area=count, moving=True)
+                ChangeArea(self.session).do()
+                self.save(moving=False)
             except nanonisException as e:
                 if e.code == ExceptionType.PROCESS_FINISHED:
-                    time_pass = time.time() - time_start
-                    m, s = divmod(time_pass, 60)
-                    h, m = divmod(m, 60)
-                    logging.info(
-                        'Total time cost: {}h {:2d}m {:2d}s'.format(h, m, s))
+                    log_run_report(self.session, time_start, self.report_path)
+                    if self.checkpoint is not None:
+                        self.checkpoint.finish()
                     break
                 else:
                     logging.fatal(
@@ -114,5 +150,12 @@ class TipRepair(Operate):
                 logging.fatal(
                     'Unexpected error: {}'.format(e))
                 self.session.Withdraw()
-            finally: 
-                self.session.Home()
+            finally:
+                # the tip is homed even when the deadline of the run passed
+                with unbounded():
+                    self.session.Home()
+        else:
+            # every area done
+            log_run_report(self.session, time_start, self.report_path)
+            if self.checkpoint is not None:
+                self.checkpoint.finish()
@@ -2,33 +2,41 @@
 
 import logging
 import time
-import numpy as np
-from core import ExceptionType, Operate
-from interface import nanonisException
+from core import ExceptionType, Operate, Resource
+from deadline import unbounded
+from interface import Cancelled, current_deadline, nanonisException
 from modules.BaisOperation import MultiPulse
 from modules.IterateOperation import IterateOperation
 from modules.MotorOperation import ChangeArea
 from modules.PLLOperation import CheckFrequencyShift
+from profiler import log_run_report
 from modules.ScanOperation import Scan
 from modules.TipShaper import TipShaper
+from scan_analysis import FrameGeometry, found_low_area, lowest_points
+from scheduler import OperationScheduler
 
 
 class LowerAreaFinder(Scan):
-    def __init__(self, session, center_x, center_y, width_x='150n', width_y='50n', angle=0, channel='Z (m)'):
-        super().__init__(session, center_x, center_y, width_x, width_y, angle, channel)
+    def __init__(self, session, center_x, center_y, width_x='150n', width_y='50n', angle=0, channel='Z (m)', sigma=1.,
+                 stop_depth='200p', tip_state=None):
+        super().__init__(session, center_x, center_y, width_x, width_y, angle, channel, tip_state)
+        self.sigma = sigma
+        # stop the scan once an area this deep is complete, None scans the whole frame
+        self.stop_depth = None if stop_depth is None else self.session.try_convert(stop_depth)
+
+    def found(self, frame, rows):
+        return found_low_area(frame, self.stop_depth, self.sigma)
 
     def _operate(self):
         super()._operate()
-        while self.session.ScanStatusGet():
-            time.sleep(1)
-        data = self._get_scan_data()
-        x_s, y_s = np.where(data==np.min(data))
-        y_s, x_s = x_s[0], y_s[0]
-        start_x = self.center_x - self.width_x/2
-        start_y = self.center_y + self.width_y/2
-        p_x = start_x + x_s/256*self.width_x
-        p_y = start_y - y_s/256*self.width_y
-        return (p_x, p_y)
+        data = self._stream_scan_data(None if self.stop_depth is None else self.found)
+        # lowest area after removing the tilt, not the lowest (possibly noisy) pixel
+        points = lowest_points(data, k=1, sigma=self.sigma)
+        if len(points) == 0:
+            raise nanonisException('No valid scan data to find the lower area')
+        geometry = FrameGeometry(self.center_x, self.center_y, self.width_x, self.width_y,
+                                 self.angle, *data.shape)
+        return geometry.pixel_to_piezo(*points[0])
             
 
 
@@ -43,19 +51,28 @@ class SingleAreaTipRepairer(IterateOperation):
         - if frequency shift is small, do tip shaper
     '''
 
-    def __init__(self, session, gridX='200n', gridY='100n', padding='15n', interval_time=1):
-        super().__init__(session, gridX, gridY, padding, interval_time)
+    def __init__(self, session, gridX='200n', gridY='100n', padding='15n', interval_time=1, planner='spiral',
+                 checkpoint=None, area=0):
+        super().__init__(session, gridX, gridY, padding, interval_time, planner, checkpoint=checkpoint, area=area)
         self.freq = 0
 
-    def _task(self):
-        pos = LowerAreaFinder(self.session, self.x, self.y).do()
+    def _settle(self, pos):
         self.session.TipXYSet(pos[0], pos[1])
-        time.sleep(1)
+        self.session.waiter.sleep(1, 'XY move settle')
         self.session.ZCtrlOnOffSet(True)
         self.session.WaitForZCtrlWork()
-        time.sleep(2)
-        
-        self.freq = CheckFrequencyShift(self.session).do()
+        self.session.WaitForZSettle(2)
+
+    def _task(self):
+        tip_state = {'area': self.area, 'cell': [self.x_recorder, self.y_recorder], 'freq_shift': self.freq}
+        pos = LowerAreaFinder(self.session, self.x, self.y, tip_state=tip_state).do()
+        # the PLL locks while the tip moves and settles, the frequency shift is read once both are done
+        pll = CheckFrequencyShift(self.session)
+        scheduler = OperationScheduler(max_workers=2)
+        scheduler.add('settle', lambda: self._settle(pos), resources={Resource.XY_PIEZO, Resource.Z_CONTROLLER})
+        scheduler.add('PLL lock', pll.lock, resources=pll.resources)
+        scheduler.add('frequency shift', pll.read, after=['settle', 'PLL lock'], resources=pll.resources)
+        self.freq = scheduler.run()['frequency shift']
         logging.info('Frequency shift now: {:.2f}'.format(self.freq))
         if CheckFrequencyShift.check_frequency_shift(self.freq):
             logging.critical(
@@ -75,10 +92,25 @@ class SingleAreaTipRepairer(IterateOperation):
 
 class TipRepair(Operate):
 
-    def __init__(self, session, direction='Y-', area_counts=100):
+    def __init__(self, session, direction='Y-', area_counts=100, checkpoint=None, report_path=None,
+                 area_timeout=None):
         super().__init__(session)
         self.direction = direction
         self.area_counts = area_counts
+        # time budget (s) of every area, an area running out of it is skipped
+        self.area_timeout = area_timeout
+        self.checkpoint = checkpoint
+        # the profile of a profiled session is exported there at the end of the run
+        self.report_path = report_path
+
+    def out_of_time(self):
+        r'''Whether the deadline of the whole run (not just of an area) passed.'''
+        deadline = current_deadline()
+        return deadline is not None and deadline.expired
+
+    def save(self, **state):
+        if self.checkpoint is not None:
+            self.checkpoint.update(**state)
 
     def safety_check(self):
         logging.warn('Start Auto Tip Repairing Operation On 2D Ice')
@@ -92,39 +124,49 @@ class TipRepair(Operate):
             self.session.MotorMoveSet('Z+', 10)
         logging.info('Try auto approach')
         self.session.AutoApproachOpen()
-        # wait till auto-approach is finished
-        while self.session.AutoApproachGet():
-            time.sleep(2)
+        self.session.WaitForApproach()
         logging.info('Auto approach finished')
         self.session.Withdraw()
         logging.info('Basic Safety check finished.')
-        time.sleep(1)
+        self.session.waiter.sleep(1, 'safety check')
         return True
 
     def _operate(self):
         time_start = time.time()  # record the start time
         logging.info('Start tip repairing process.')
         count = 0
+        if self.checkpoint is not None:
+            count = self.checkpoint.get('area', 0)
+            logging.info('Resuming at area {}'.format(count))
+            if self.checkpoint.get('moving', False):
+                ChangeArea(self.session).do()
+                self.save(moving=False)
         while count < self.area_counts:
             try:
-                SingleAreaTipRepairer(self.session).do()
+                SingleAreaTipRepairer(self.session, checkpoint=self.checkpoint, area=count).do(self.area_timeout)
                 count += 1
                 logging.warn('Area number {} finished'.format(count))
+                self.save(area=count, moving=True)
+                ChangeArea(self.session).do()
+                self.save(moving=False)
+            except Cancelled as e:
+                if self.out_of_time():
+                    raise
+                # only the budget of this area ran out, the next one gets a fresh one
+                logging.warn('Area number {} skipped: {}'.format(count + 1, e))
+                self.session.Withdraw()
+                count += 1
+                self.save(area=count, moving=True)
                 ChangeArea(self.session).do()
+                self.save(moving=False)
             except nanonisException as e:
                 if e.code == ExceptionType.PROCESS_FINISHED:
-                    time_pass = time.time() - time_start
-                    m, s = divmod(time_pass, 60)
-                    h, m = divmod(m, 60)
-                    logging.info(
-                        'Total time cost: {}h {:2d}m {:2d}s'.format(h, m, s))
+                    log_run_report(self.session, time_start, self.report_path)
+                    if self.checkpoint is not None:
+                        self.checkpoint.finish()
                     break
                 else:
-                    time_pass = time.time() - time_start
-                    m, s = divmod(time_pass, 60)
-                    h, m = divmod(m, 60)
-                    logging.info(
-                        'Total time cost: {}h {:2d}m {:2d}s'.format(h, m, s))
+                    log_run_report(self.session, time_start, self.report_path)
                     logging.fatal(
                         'Unexpected error: {}'.format(e))
                     self.session.Home()
@@ -135,4 +177,11 @@ class TipRepair(Operate):
                 self.session.Home()
                 break
             finally:
-                self.session.Home()
+                # the tip is homed even when the deadline of the run passed
+                with unbounded():
+                    self.session.Home()
+        else:
+            # every area done
+            log_run_report(self.session, time_start, self.report_path)
+            if self.checkpoint is not None:
+                self.checkpoint.finish()
@@ -0,0 +1,248 @@
+# telemetry.py
+r'''
+Structured record of every command and operation of a run.
+
+TelemetryRecorder collects one row per Nanonis command (name, start time,
+latency, bytes sent and received, parsed result, error) and one row per
+Operate.do (operation, start time, duration, result, error). The control
+thread only appends the row to an in-memory list; a background thread
+(its own, or the IOWorker of the session) writes the rows as compressed
+NPZ chunks of columns:
+
+    <directory>/commands-000001.npz
+    <directory>/operations-000001.npz
+
+TelemetryReader loads the chunks back as NumPy columns for analysis:
+
+    reader = TelemetryReader('telemetry/run1')
+    pulses = reader.commands('Bias.Pulse')
+    z = reader.commands('ZCtrl.ZPosGet')['value']
+    print(reader.summary())
+'''
+
+import glob
+import logging
+import numbers
+import os
+import threading
+import time
+
+import numpy as np
+
+
+# table -> ordered (column, dtype) of a row
+TABLES = {
+    'commands': (('command', 'U'), ('start', np.float64), ('latency', np.float64), ('sent', np.int64),
+                 ('received', np.int64), ('value', np.float64), ('result', 'U'), ('error', 'U')),
+    'operations': (('operation', 'U'), ('start', np.float64), ('duration', np.float64),
+                   ('value', np.float64), ('result', 'U'), ('error', 'U')),
+}
+
+
+# file name of a chunk after the table name, see TelemetryRecorder._write
+CHUNK_PATTERN = '-' + '[0-9]' * 6 + '.npz'
+
+
+def scalar_value(result):
+    r'''The result as a float when it is a single number (or a single-valued tuple), NaN otherwise.'''
+    if isinstance(result, tuple) and len(result) == 1:
+        result = result[0]
+    if isinstance(result, numbers.Real):
+        return float(result)
+    return np.nan
+
+
+def result_text(result):
+    if result is None:
+        return ''
+    if isinstance(result, dict) and 'body_size' in result:
+        return '<{} bytes>'.format(result['body_size'])
+    if isinstance(result, np.ndarray):
+        return '<array {}>'.format(result.shape)
+    return str(result)
+
+
+class TelemetryRecorder:
+
+    r'''
+    Args:
+        directory : str
+            Directory of the chunks, created if missing.
+        chunk_size : int
+            Rows per chunk file.
+        flush_interval : float
+            Seconds after which pending rows are written even if the chunk is not full.
+        worker : IOWorker
+            Writes the chunks on its thread instead of a thread of the recorder.
+    '''
+
+    def __init__(self, directory, chunk_size=4096, flush_interval=5., worker=None):
+        self.directory = directory
+        self.worker = worker
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        os.makedirs(directory, exist_ok=True)
+        self.pending = {table: [] for table in TABLES}
+        self.chunks = {table: self._next_chunk(table) for table in TABLES}
+        self.rows = {table: 0 for table in TABLES}
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _next_chunk(self, table):
+        # continue the numbering of an existing directory
+        existing = glob.glob(os.path.join(self.directory, table + CHUNK_PATTERN))
+        return max([int(os.path.basename(path)[len(table) + 1:-4]) for path in existing], default=0) + 1
+
+    def start(self):
+        if self.worker is not None:
+            self.worker.every(self.flush_interval, self.flush)
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='TelemetryWriter', daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        r'''Write the pending rows and stop the writer thread.'''
+        if self.worker is not None:
+            self.worker.cancel(self.flush)
+            self.worker.flush()
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # recording, called from the control thread
+
+    def command(self, command, start, latency, sent, received, result=None, error=None):
+        self._append('commands', (command, start, latency, sent, received, scalar_value(result),
+                                  result_text(result), '' if error is None else str(error)))
+
+    def operation(self, operation, start, duration, result=None, error=None):
+        self._append('operations', (operation, start, duration, scalar_value(result),
+                                    result_text(result), '' if error is None else str(error)))
+
+    def _append(self, table, row):
+        with self._lock:
+            rows = self.pending[table]
+            rows.append(row)
+            full = len(rows) == self.chunk_size
+        if full:
+            if self.worker is not None:
+                self.worker.call(self.flush)
+            else:
+                self._wake.set()
+
+    # writing, on the writer thread
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error('Telemetry writer failed: {}'.format(e))
+
+    def flush(self):
+        r'''Write every pending row now.'''
+        for table, columns in TABLES.items():
+            with self._lock:
+                rows, self.pending[table] = self.pending[table], []
+            for start in range(0, len(rows), self.chunk_size):
+                self._write(table, columns, rows[start:start + self.chunk_size])
+
+    def _write(self, table, columns, rows):
+        arrays = {}
+        for i, (name, dtype) in enumerate(columns):
+            values = [row[i] for row in rows]
+            arrays[name] = np.array(values, dtype=dtype) if dtype != 'U' else np.array(values, dtype=str)
+        with self._lock:
+            chunk = self.chunks[table]
+            self.chunks[table] += 1
+        path = os.path.join(self.directory, '{}-{:06d}.npz'.format(table, chunk))
+        temporary = path[:-4] + '.tmp.npz'
+        np.savez_compressed(temporary, **arrays)
+        os.replace(temporary, path)
+        self.rows[table] += len(rows)
+
+
+class TelemetryReader:
+
+    r'''
+    Columns of the chunks written by a TelemetryRecorder.
+
+    Args:
+        directory : str
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def load(self, table):
+        r'''All rows of table as a dict of columns, sorted by start time.'''
+        # a .tmp.npz left by a writer killed halfway is not a chunk
+        paths = sorted(glob.glob(os.path.join(self.directory, table + CHUNK_PATTERN)))
+        parts = []
+        for path in paths:
+            with np.load(path) as chunk:
+                parts.append({name: chunk[name] for name in chunk.files})
+        columns = {}
+        for name, dtype in TABLES[table]:
+            if parts:
+                columns[name] = np.concatenate([part[name] for part in parts])
+            else:
+                columns[name] = np.array([], dtype=dtype if dtype != 'U' else str)
+        order = np.argsort(columns['start'], kind='stable')
+        return {name: column[order] for name, column in columns.items()}
+
+    @staticmethod
+    def select(columns, key, name=None, since=None, until=None, errors=None):
+        mask = np.ones(len(columns['start']), dtype=bool)
+        if name is not None:
+            if name.endswith('.'):
+                mask &= np.char.startswith(columns[key], name)
+            else:
+                mask &= columns[key] == name
+        if since is not None:
+            mask &= columns['start'] >= since
+        if until is not None:
+            mask &= columns['start'] < until
+        if errors is not None:
+            mask &= (columns['error'] != '') == errors
+        return {column: values[mask] for column, values in columns.items()}
+
+    def commands(self, name=None, since=None, until=None, errors=None):
+        r'''
+        Rows of the commands table. name is a command name or a module prefix ending with '.',
+        since/until are time.time() stamps, errors=True/False keeps the failed/successful commands.
+        '''
+        return self.select(self.load('commands'), 'command', name, since, until, errors)
+
+    def operations(self, name=None, since=None, until=None, errors=None):
+        r'''Rows of the operations table, name is the class name of the Operate subclass.'''
+        return self.select(self.load('operations'), 'operation', name, since, until, errors)
+
+    def summary(self):
+        r'''command -> count, errors, total and mean latency (s), bytes sent and received.'''
+        columns = self.load('commands')
+        names, inverse = np.unique(columns['command'], return_inverse=True)
+        count = np.bincount(inverse, minlength=len(names))
+        total = np.bincount(inverse, columns['latency'], minlength=len(names))
+        errors = np.bincount(inverse, columns['error'] != '', minlength=len(names))
+        sent = np.bincount(inverse, columns['sent'], minlength=len(names))
+        received = np.bincount(inverse, columns['received'], minlength=len(names))
+        return {str(name): {'count': int(count[i]), 'errors': int(errors[i]), 'total': float(total[i]),
+                            'mean': float(total[i] / count[i]), 'sent': int(sent[i]), 'received': int(received[i])}
+                for i, name in enumerate(names)}
@@ -0,0 +1,128 @@
+import os
+import queue
+import random
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+
+import pytest
+
+# the modules of the package are imported flat, as the scripts at the top level do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from interface import construct_header  # noqa: E402
+
+
+class FakeNanonis(socketserver.ThreadingTCPServer):
+
+    r'''
+    Minimal Nanonis TCP server for the tests.
+
+    Every request is answered with construct_header(name) + respond(name, body).
+    Replies leave in order, each one latency seconds after its request arrived,
+    written in random pieces of chunk bytes (a (min, max) pair) when given.
+    events lists ('recv', name) and ('send', name) in the order they happened.
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, respond, latency=0., chunk=None, seed=0):
+        self.respond = respond
+        self.latency = latency
+        self.chunk = chunk
+        self.rng = random.Random(seed)
+        self.events = []
+        self.events_lock = threading.Lock()
+        super().__init__(('127.0.0.1', 0), FakeNanonisHandler)
+        self.port = self.server_address[1]
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def record(self, event, name):
+        with self.events_lock:
+            self.events.append((event, name))
+
+    def round_trips(self):
+        r'''Number of times the client sent again after being answered.'''
+        trips = 0
+        previous = 'send'
+        for event, _ in self.events:
+            if event == 'recv' and previous == 'send':
+                trips += 1
+            previous = event
+        return trips
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeNanonisHandler(socketserver.BaseRequestHandler):
+
+    def recv_exactly(self, size):
+        data = b''
+        while len(data) < size:
+            received = self.request.recv(size - len(data))
+            if not received:
+                raise ConnectionError
+            data += received
+        return data
+
+    def handle(self):
+        server = self.server
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        replies = queue.Queue()
+        writer = threading.Thread(target=self.write, args=(replies,), daemon=True)
+        writer.start()
+        try:
+            while True:
+                header = self.recv_exactly(40)
+                name = header[:32].rstrip(b'\0').decode('latin1')
+                body = self.recv_exactly(struct.unpack('>i', header[32:36])[0])
+                server.record('recv', name)
+                reply = server.respond(name, body)
+                replies.put((time.monotonic() + server.latency, name,
+                             construct_header(name, len(reply)) + reply))
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            replies.put(None)
+            writer.join()
+
+    def write(self, replies):
+        server = self.server
+        while True:
+            item = replies.get()
+            if item is None:
+                return
+            due, name, message = item
+            time.sleep(max(0., due - time.monotonic()))
+            server.record('send', name)
+            try:
+                if server.chunk is None:
+                    self.request.sendall(message)
+                    continue
+                while message:
+                    size = server.rng.randint(*server.chunk)
+                    self.request.sendall(message[:size])
+                    message = message[size:]
+            except OSError:
+                return
+
+
+@pytest.fixture
+def fake_nanonis():
+    servers = []
+
+    def start(respond, **kwargs):
+        server = FakeNanonis(respond, **kwargs)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
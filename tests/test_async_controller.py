@@ -0,0 +1,42 @@
+import asyncio
+
+import pytest
+
+from async_core import AsyncNanonisController
+from modules.ScanOperation import Scan
+from simulator import NanonisSimulator, SimulatorState
+from tasks.TipRepairOn2DIce import LowerAreaFinder
+
+
+class GrabFrames(Scan):
+
+    def safety_check(self):
+        return True
+
+    def _operate(self):
+        return self._get_scan_data(['Z (m)', 'Current (A)'], (1, 0))
+
+
+@pytest.fixture
+def simulator():
+    with NanonisSimulator(port=0, seed=0, state=SimulatorState(seed=0, pixels=64, scan_time=0.5)) as sim:
+        yield sim
+
+
+def run(simulator, operate_class, *args, **kwargs):
+    async def main():
+        async with AsyncNanonisController('127.0.0.1', simulator.port, signal_cache_dir=None) as nanonis:
+            return await nanonis.run(operate_class, *args, **kwargs)
+    return asyncio.run(main())
+
+
+def test_streaming_scan_on_the_async_controller(simulator):
+    x, y = run(simulator, LowerAreaFinder, 0., 0., stop_depth=None)
+    assert abs(x) < 1e-6 and abs(y) < 1e-6
+    assert simulator.command_counts['Scan.FrameDataGrab'] >= 1
+    assert simulator.command_counts['Scan.StatusGet'] >= 1
+
+
+def test_frame_grab_on_the_async_controller(simulator):
+    data = run(simulator, GrabFrames, 0., 0., '10n', '10n')
+    assert data.shape == (2, 2, 64, 64)
@@ -0,0 +1,68 @@
+import struct
+import time
+
+import pytest
+
+from interface import ZLimits, nanonisException, nanonis_programming_interface
+
+LATENCY = 0.1
+OK = struct.pack('>Ii', 0, 0)
+VALUES = {'Bias.Get': (0.5,), 'Current.Get': (2.5e-10,), 'ZCtrl.LimitsGet': (1e-7, -1e-7)}
+
+
+def respond(name, body):
+    if name == 'ZCtrl.SetpntGet':
+        return b'\0\0'  # too short, the response does not parse
+    values = VALUES[name]
+    return struct.pack('>{}f'.format(len(values)), *values) + OK
+
+
+@pytest.fixture
+def session(fake_nanonis):
+    server = fake_nanonis(respond, latency=LATENCY)
+    nanonis = nanonis_programming_interface(PORT=server.port)
+    yield server, nanonis
+    nanonis.close()
+
+
+def test_batch_is_one_round_trip_in_request_order(session):
+    server, nanonis = session
+    start = time.monotonic()
+    with nanonis.batch() as batch:
+        limits = batch.query('ZCtrl.LimitsGet')
+        bias = batch.query('Bias.Get')
+        current = batch.query('Current.Get')
+    elapsed = time.monotonic() - start
+    assert server.round_trips() == 1
+    assert elapsed < 2 * LATENCY
+    assert [name for event, name in server.events if event == 'send'] == \
+        ['ZCtrl.LimitsGet', 'Bias.Get', 'Current.Get']
+    assert limits.value == ZLimits(*struct.unpack('>2f', struct.pack('>2f', 1e-7, -1e-7)))
+    assert bias.value == 0.5
+    assert current.value == struct.unpack('>f', struct.pack('>f', 2.5e-10))[0]
+
+
+def test_serial_queries_pay_one_round_trip_each(session):
+    server, nanonis = session
+    start = time.monotonic()
+    nanonis.query('ZCtrl.LimitsGet')
+    nanonis.query('Bias.Get')
+    nanonis.query('Current.Get')
+    assert server.round_trips() == 3
+    assert time.monotonic() - start >= 3 * LATENCY
+
+
+def test_error_in_a_batch_keeps_the_other_results(session):
+    server, nanonis = session
+    with pytest.raises(nanonisException, match='Response parse error: ZCtrl.SetpntGet'):
+        with nanonis.batch() as batch:
+            bias = batch.query('Bias.Get')
+            setpoint = batch.query('ZCtrl.SetpntGet')
+            limits = batch.query('ZCtrl.LimitsGet')
+    assert server.round_trips() == 1
+    assert bias.value == 0.5
+    assert limits.value.high == pytest.approx(1e-7)
+    with pytest.raises(nanonisException, match='not flushed'):
+        setpoint.value
+    # the framing is still in sync
+    assert nanonis.query('Bias.Get') == 0.5
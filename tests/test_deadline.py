@@ -0,0 +1,104 @@
+import asyncio
+import struct
+import time
+
+import pytest
+
+from async_core import AsyncNanonisController
+from core import NanonisController, Operate
+from deadline import Deadline, budget
+from interface import Cancelled, nanonis_programming_interface
+from simulator import NanonisSimulator, SimulatorState
+
+OK = struct.pack('>Ii', 0, 0)
+
+
+@pytest.fixture
+def simulator():
+    with NanonisSimulator(port=0, seed=0, state=SimulatorState(seed=0, pixels=32, scan_time=5.)) as sim:
+        yield sim
+
+
+def test_wait_end_of_scan_cut_by_the_deadline_raises(simulator):
+    nanonis = NanonisController('127.0.0.1', simulator.port, signal_cache_dir=None)
+    nanonis.ScanStart()
+    start = time.monotonic()
+    with pytest.raises(Cancelled, match='Scan.WaitEndOfScan'):
+        with budget(1., 'scan'):
+            nanonis.WaitEndOfScan()
+    assert time.monotonic() - start < 1.
+    assert nanonis.ScanStatusGet() == 1  # the scan really is still running
+    nanonis.ScanStop()
+    nanonis.close()
+
+
+def slow_withdraw(name, body):
+    # Nanonis waits for the withdraw until its timeout (ms), the tip never gets up
+    timeout = struct.unpack('>Ii', body)[1]
+    time.sleep(0.8 if timeout < 0 else min(timeout / 1000, 0.8))
+    return OK
+
+
+def test_withdraw_cut_by_the_deadline_raises(fake_nanonis):
+    server = fake_nanonis(slow_withdraw)
+    nanonis = nanonis_programming_interface(PORT=server.port)
+    with pytest.raises(Cancelled, match='ZCtrl.Withdraw'):
+        with budget(1., 'withdraw'):
+            nanonis.Withdraw()
+    # an explicit timeout within the budget is left to the caller, as without a deadline
+    with budget(5.):
+        nanonis.Withdraw(timeout=100)
+    nanonis.close()
+
+
+class Measure(Operate):
+
+    def safety_check(self):
+        return True
+
+    def _operate(self):
+        return self.session.CurrentGet()
+
+
+class WaitScan(Operate):
+
+    def safety_check(self):
+        return True
+
+    def _operate(self):
+        self.session.ScanStart()
+        self.session.WaitEndOfScan()
+
+
+def run_async(simulator, *operations):
+    async def main():
+        async with AsyncNanonisController('127.0.0.1', simulator.port, signal_cache_dir=None) as nanonis:
+            results = []
+            for operation in operations:
+                try:
+                    results.append(await operation(nanonis))
+                except Cancelled as e:
+                    results.append(e)
+            await nanonis.ScanStop()
+            return results
+    return asyncio.run(main())
+
+
+def test_async_blocking_calls_honour_the_deadline(simulator):
+    simulator.latency = 2.
+    start = time.monotonic()
+    cancelled, = run_async(simulator, lambda nanonis: nanonis.run(Measure, deadline=Deadline(0.3)))
+    assert isinstance(cancelled, Cancelled)
+    # the 2 s response is not waited for, only ScanStop at the end is
+    assert time.monotonic() - start < 3.
+
+
+def test_async_server_waits_honour_the_deadline(simulator):
+    start = time.monotonic()
+    cancelled, current = run_async(
+        simulator,
+        lambda nanonis: Operate.async_do(WaitScan(nanonis.blocking()), timeout=1.),
+        lambda nanonis: nanonis.CurrentGet())
+    assert isinstance(cancelled, Cancelled) and 'Scan.WaitEndOfScan' in str(cancelled)
+    assert isinstance(current, float)
+    assert time.monotonic() - start < 2.
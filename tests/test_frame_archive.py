@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import pytest
+
+from frame_archive import FrameArchive
+from io_worker import IOWorker
+
+
+def frame(i, shape=(4, 6)):
+    return np.full(shape, i, dtype=np.float32) + np.arange(shape[1], dtype=np.float32)
+
+
+def chunks(directory):
+    return sorted(name for name in os.listdir(directory) if name.startswith('chunk-'))
+
+
+@pytest.mark.parametrize('worker', [False, True])
+def test_append_and_read_back(tmp_path, worker):
+    io = IOWorker().start() if worker else None
+    with FrameArchive(str(tmp_path), chunk_frames=3, worker=io) as archive:
+        for i in range(7):
+            assert archive.append(frame(i), channel='Z (m)', area=i // 2) == i
+        # another shape goes to chunks of its own
+        archive.append(np.ones((2, 2)), channel='Current (A)')
+        assert len(archive) == 8
+        np.testing.assert_array_equal(archive[5], frame(5))
+        assert not archive[5].flags.writeable
+        assert archive.metadata(6)['chunk'] == 3 and archive.metadata(6)['slot'] == 0
+        assert archive.select(channel='Z (m)', area=lambda a: a >= 2) == [4, 5, 6]
+        stack = archive.load([1, 4, 6])
+        np.testing.assert_array_equal(stack, [frame(1), frame(4), frame(6)])
+        assert [frame_id for frame_id, _ in archive.frames()] == list(range(8))
+    if io is not None:
+        io.close()
+    assert chunks(tmp_path) == ['chunk-000001.npy', 'chunk-000002.npy', 'chunk-000003.npy', 'chunk-000004.npy']
+
+
+def test_big_endian_frames_are_stored_native(tmp_path):
+    with FrameArchive(str(tmp_path)) as archive:
+        archive.append(frame(3).astype('>f4'))
+        assert archive[0].dtype == np.dtype('=f4')
+        np.testing.assert_array_equal(archive[0], frame(3))
+
+
+def test_reopened_archive_fills_the_last_chunk(tmp_path):
+    with FrameArchive(str(tmp_path), chunk_frames=4) as archive:
+        for i in range(5):
+            archive.append(frame(i), run=1)
+    with FrameArchive(str(tmp_path), chunk_frames=4) as archive:
+        assert len(archive) == 5
+        assert archive.append(frame(5), run=2) == 5
+        assert (archive.metadata(5)['chunk'], archive.metadata(5)['slot']) == (2, 1)
+        for i in range(5):
+            np.testing.assert_array_equal(archive[i], frame(i))
+        np.testing.assert_array_equal(archive[5], frame(5))
+        assert archive.select(run=2) == [5]
+    assert chunks(tmp_path) == ['chunk-000001.npy', 'chunk-000002.npy']
+
+
+def test_torn_index_line_is_dropped(tmp_path):
+    with FrameArchive(str(tmp_path)) as archive:
+        archive.append(frame(0))
+        archive.append(frame(1))
+    index = tmp_path / 'index.jsonl'
+    # killed while writing the line of a third frame
+    index.write_text(index.read_text() + '{"id": 2, "chu')
+    with FrameArchive(str(tmp_path)) as archive:
+        assert len(archive) == 2
+        np.testing.assert_array_equal(archive[1], frame(1))
+    with FrameArchive(str(tmp_path)) as archive:
+        assert archive.append(frame(2)) == 2
+    with FrameArchive(str(tmp_path)) as archive:
+        assert len(archive) == 3
+        np.testing.assert_array_equal(archive[2], frame(2))
@@ -0,0 +1,54 @@
+import struct
+
+from interface import NanonisConnection, construct_command
+
+
+def pattern(size):
+    return bytes(i * 7 % 251 for i in range(size))
+
+
+def sized_reply(name, body):
+    # the request asks for a body of this many bytes
+    return pattern(struct.unpack('>I', body)[0])
+
+
+def test_frames_split_into_tiny_chunks(fake_nanonis):
+    server = fake_nanonis(sized_reply, chunk=(1, 7))
+    connection = NanonisConnection('127.0.0.1', server.port, buffer_size=64)
+    try:
+        for size in (0, 1, 8, 23, 24, 63, 100, 1000):
+            frame = connection.exchange(construct_command('Test.Size', 'uint32', size))
+            assert bytes(frame[:9]) == b'Test.Size'
+            assert struct.unpack('>i', frame[32:36])[0] == size
+            assert bytes(frame[40:]) == pattern(size)
+    finally:
+        connection.close()
+
+
+def test_body_larger_than_the_buffer(fake_nanonis):
+    server = fake_nanonis(sized_reply, chunk=(1, 7))
+    connection = NanonisConnection('127.0.0.1', server.port, buffer_size=64)
+    try:
+        frame = connection.exchange(construct_command('Test.Size', 'uint32', 50000))
+        assert bytes(frame[40:]) == pattern(50000)
+        assert len(connection.buffer) >= 50040
+        # the grown buffer is reused, smaller frames that follow are still complete
+        buffer = connection.buffer
+        frame = connection.exchange(construct_command('Test.Size', 'uint32', 300))
+        assert bytes(frame[40:]) == pattern(300)
+        assert connection.buffer is buffer
+    finally:
+        connection.close()
+
+
+def test_back_to_back_frames_stay_in_sync(fake_nanonis):
+    server = fake_nanonis(sized_reply, chunk=(1, 7), seed=3)
+    connection = NanonisConnection('127.0.0.1', server.port, buffer_size=64)
+    sizes = [5, 4096, 0, 777, 12]
+    try:
+        connection.sendall(b''.join(construct_command('Test.Size', 'uint32', size) for size in sizes))
+        for size in sizes:
+            frame = connection.recv_frame()
+            assert bytes(frame[40:]) == pattern(size)
+    finally:
+        connection.close()
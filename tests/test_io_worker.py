@@ -0,0 +1,92 @@
+import os
+import threading
+
+import pytest
+
+import io_worker
+from interface import nanonisException
+from io_worker import IOWorker, write_at
+
+
+@pytest.fixture
+def fd(tmp_path):
+    fd = os.open(str(tmp_path / 'data'), os.O_RDWR | os.O_CREAT)
+    yield fd
+    os.close(fd)
+
+
+def content(fd):
+    return os.pread(fd, 1 << 16, 0)
+
+
+def blocked(worker):
+    # holds the worker thread, once it has taken the call off the queue, until the returned event is set
+    running, release = threading.Event(), threading.Event()
+    worker.call(lambda: (running.set(), release.wait()))
+    running.wait()
+    return release
+
+
+def test_adjacent_writes_are_gathered_in_order(fd):
+    worker = IOWorker().start()
+    release = blocked(worker)
+    done = []
+    for i in range(10):
+        worker.write(fd, bytes([65 + i]) * 4, 4 * i, then=lambda i=i: done.append(i))
+    # not adjacent: a write of its own, and it overwrites what came before
+    worker.write(fd, b'zz', 2)
+    release.set()
+    worker.flush()
+    assert content(fd) == b'AAzzBBBB' + b''.join(bytes([65 + i]) * 4 for i in range(2, 10))
+    assert done == list(range(10))
+    assert worker.stats()['writes'] == 2 and worker.stats()['written'] == 42
+    worker.close()
+
+
+def test_close_writes_everything_and_runs_the_periodic_jobs(fd):
+    worker = IOWorker().start()
+    ticks = []
+    worker.every(3600., lambda: ticks.append(os.pread(fd, 8, 0)))
+    release = blocked(worker)
+    worker.write(fd, b'abcd', 0)
+    worker.write(fd, b'efgh', 4)
+    release.set()
+    worker.close()
+    # the last periodic run sees every write
+    assert ticks == [b'abcdefgh']
+    assert worker.stats()['pending'] == 0
+    # without a thread the writes are done in place
+    worker.write(fd, b'ijkl', 8)
+    assert content(fd) == b'abcdefghijkl'
+
+
+def test_backpressure(fd):
+    worker = IOWorker(max_jobs=2).start()
+    release = blocked(worker)
+    worker.write(fd, b'a', 0)
+    worker.write(fd, b'b', 1)
+    with pytest.raises(nanonisException, match='still full'):
+        worker.write(fd, b'c', 2, timeout=0.05)
+    assert worker.stats()['stalls'] == 1
+    release.set()
+    worker.write(fd, b'c', 2, timeout=1.)
+    worker.close()
+    assert content(fd) == b'abc'
+
+
+def test_failed_job_does_not_stop_the_worker(fd):
+    worker = IOWorker().start()
+    worker.call(lambda: 1 / 0)
+    worker.write(fd, b'ok', 0)
+    worker.flush()
+    assert worker.stats()['errors'] == 1 and content(fd) == b'ok'
+    worker.close()
+
+
+@pytest.mark.skipif(not hasattr(os, 'pwritev'), reason='no pwritev')
+def test_write_at_finishes_a_short_pwritev(fd, monkeypatch):
+    pwritev = os.pwritev
+    # the kernel may write less than asked, here only the first buffer and 2 bytes of the second
+    monkeypatch.setattr(io_worker.os, 'pwritev', lambda fd, buffers, offset: pwritev(fd, [buffers[0], buffers[1][:2]], offset))
+    write_at(fd, [memoryview(b'0123'), memoryview(b'4567'), memoryview(b'89')], 10)
+    assert content(fd)[10:] == b'0123456789'
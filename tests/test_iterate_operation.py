@@ -0,0 +1,87 @@
+from collections import namedtuple
+
+import pytest
+
+from checkpoint import CheckpointStore
+from modules.IterateOperation import IterateOperation
+
+Range = namedtuple('Range', 'x y')
+
+
+class Waiter:
+
+    def sleep(self, seconds, name):
+        pass
+
+
+class Session:
+
+    def __init__(self):
+        self.waiter = Waiter()
+        self.calls = []
+
+    def try_convert(self, value):
+        return {'200n': 200e-9, '20n': 20e-9}.get(value, value)
+
+    def to_nano(self, value):
+        return '{:.0f}n'.format(value * 1e9)
+
+    def PiezoRangeGet(self):
+        return Range(1e-6, 1e-6)
+
+    def __getattr__(self, name):
+        # every other command is recorded
+        return lambda *args: self.calls.append((name,) + args)
+
+
+class Iterate(IterateOperation):
+
+    def _task(self):
+        self.session.calls.append(('task', self.x_recorder, self.y_recorder))
+
+
+def test_moves_straight_between_points():
+    session = Session()
+    Iterate(session)._operate()
+    names = [call[0] for call in session.calls]
+    assert 'Home' not in names
+    moves = [call[1:] for call in session.calls if call[0] == 'TipXYSet']
+    tasks = [call[1:] for call in session.calls if call[0] == 'task']
+    assert len(moves) == len(tasks) == 25
+    assert moves[0] == (0., 0.)
+
+
+class Interrupted(Exception):
+    pass
+
+
+class Stops(Iterate):
+
+    def __init__(self, *args, stop_at=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stop_at = stop_at
+
+    def _task(self):
+        if self.this == self.stop_at:
+            raise Interrupted()
+        super()._task()
+
+
+def test_resumed_area_skips_the_visited_points(tmp_path):
+    with CheckpointStore(str(tmp_path / 'runs.sqlite')) as store:
+        checkpoint = store.start('Iterate')
+        first = Session()
+        with pytest.raises(Interrupted):
+            Stops(first, checkpoint=checkpoint, area=3, stop_at=10)._operate()
+        done = [call[1:] for call in first.calls if call[0] == 'task']
+        assert len(done) == 10 and checkpoint.visited(3) == set(done)
+
+        second = Session()
+        resumed = Stops(second, checkpoint=store.resume('Iterate'), area=3)
+        assert resumed.this == 10
+        resumed._operate()
+        rest = [call[1:] for call in second.calls if call[0] == 'task']
+        assert len(rest) == 15 and not set(rest) & set(done)
+        assert len(checkpoint.visited(3)) == resumed.this == resumed.points == 25
+        # the other areas start from scratch
+        assert checkpoint.visited(4) == set()
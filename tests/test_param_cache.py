@@ -0,0 +1,80 @@
+import struct
+import time
+
+import pytest
+
+from core import NanonisController
+from param_cache import ParameterCache, QUASI_STATIC_TTLS
+
+OK = struct.pack('>Ii', 0, 0)
+
+
+def error(message):
+    return struct.pack('>Ii', 1, len(message)) + message
+
+
+class Bias:
+
+    def __init__(self):
+        self.value = 0.5
+
+    def __call__(self, name, body):
+        if name == 'Bias.Get':
+            return struct.pack('>f', self.value) + OK
+        value = struct.unpack('>f', body)[0]
+        if abs(value) > 5:
+            return error(b'Bias out of range')
+        self.value = value
+        return OK
+
+
+@pytest.fixture
+def nanonis(fake_nanonis):
+    bias = Bias()
+    server = fake_nanonis(bias)
+    session = NanonisController('127.0.0.1', server.port, signal_cache_dir=None, param_ttls={'Bias.Get': 0.3})
+    session.server, session.bias = server, bias
+    yield session
+    session.close()
+
+
+def gets(server):
+    return sum(1 for event, name in server.events if (event, name) == ('recv', 'Bias.Get'))
+
+
+def test_nothing_is_cached_by_default():
+    assert not ParameterCache().cacheable('Bias.Get')
+    assert ParameterCache(QUASI_STATIC_TTLS).cacheable('Bias.Get')
+
+
+def test_setter_writes_through(nanonis):
+    assert nanonis.query('Bias.Get') == 0.5
+    nanonis.query('Bias.Set', 2.)
+    assert nanonis.query('Bias.Get') == 2.
+    assert gets(nanonis.server) == 1
+
+
+def test_failed_setter_does_not_write_through(nanonis):
+    assert nanonis.query('Bias.Get') == 0.5
+    nanonis.query('Bias.Set', 7.)
+    # the failed setter invalidates the entry, the value is read again
+    assert nanonis.query('Bias.Get') == 0.5
+    assert gets(nanonis.server) == 2
+
+
+def test_failed_setter_in_a_batch_does_not_write_through(nanonis):
+    nanonis.query('Bias.Get')
+    with nanonis.batch() as batch:
+        batch.query('Bias.Set', 7.)
+    assert nanonis.query('Bias.Get') == 0.5
+    assert gets(nanonis.server) == 2
+
+
+def test_entries_expire(nanonis):
+    nanonis.query('Bias.Get')
+    # changed in the Nanonis GUI
+    nanonis.bias.value = 1.
+    assert nanonis.query('Bias.Get') == 0.5
+    time.sleep(0.35)
+    assert nanonis.query('Bias.Get') == 1.
+    assert gets(nanonis.server) == 2
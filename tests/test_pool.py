@@ -0,0 +1,93 @@
+import struct
+import threading
+import time
+
+import pytest
+
+from pool import PooledNanonisController
+from retry import RetryPolicy
+
+OK = struct.pack('>Ii', 0, 0)
+
+
+def respond(name, body):
+    if name == 'Scan.WaitEndOfScan':
+        time.sleep(0.5)  # blocks its port until the scan is done
+        return struct.pack('>Ii', 0, 0) + OK
+    if name == 'Scan.StatusGet':
+        return struct.pack('>I', 1) + OK
+    return struct.pack('>f', 1e-10) + OK
+
+
+def names(server):
+    return [name for event, name in server.events if event == 'recv']
+
+
+@pytest.fixture
+def servers(fake_nanonis):
+    return [fake_nanonis(respond) for _ in range(3)]
+
+
+@pytest.fixture
+def pool(servers):
+    nanonis = PooledNanonisController(PORTS=[server.port for server in servers])
+    yield nanonis
+    nanonis.close()
+
+
+def test_default_routes(servers, pool):
+    pool.BiasGet()
+    pool.CurrentGet()
+    pool.WaitEndOfScan()
+    pool.ScanStatusGet()
+    assert names(servers[0]) == ['Bias.Get', 'Scan.StatusGet']
+    assert names(servers[1]) == ['Scan.WaitEndOfScan']
+    assert names(servers[2]) == ['Current.Get']
+
+
+def test_module_route(servers, pool):
+    pool.set_route('Scan.', servers[2].port)
+    pool.ScanStatusGet()
+    # a route of the command wins over the route of its module
+    pool.WaitEndOfScan()
+    assert names(servers[2]) == ['Scan.StatusGet']
+    assert names(servers[1]) == ['Scan.WaitEndOfScan']
+
+
+def test_polling_is_not_held_up_by_a_slow_command(pool):
+    scan = threading.Thread(target=pool.WaitEndOfScan)
+    scan.start()
+    time.sleep(0.05)
+    start = time.monotonic()
+    for _ in range(10):
+        pool.CurrentGet()
+    assert time.monotonic() - start < 0.4
+    scan.join()
+
+
+def test_broken_member_is_reconnected(fake_nanonis, servers):
+    dropped = []
+
+    def drop_once(name, body):
+        if not dropped:
+            dropped.append(name)
+            raise ConnectionError  # the fake server closes the connection
+        return respond(name, body)
+
+    flaky = fake_nanonis(drop_once)
+    pool = PooledNanonisController(PORTS=[servers[0].port, servers[1].port, flaky.port])
+    pool.retry = RetryPolicy(retries=1, backoff=0.01)
+    assert pool.CurrentGet() == pytest.approx(1e-10)
+    member = pool.members[flaky.port]
+    assert (member.failures, member.reconnects, member.healthy) == (1, 1, True)
+    assert pool.members[servers[0].port].reconnects == 0
+    pool.close()
+
+
+def test_health_check_reopens_a_dead_connection(servers, pool):
+    member = pool.members[servers[2].port]
+    member.connection.kill()
+    assert pool.health_check() == {server.port: True for server in servers}
+    assert member.reconnects == 1
+    pool.CurrentGet()
+    assert names(servers[2]) == ['Current.Get']
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from quantity import QuantityError, parse_quantities, parse_quantity
+
+
+@pytest.mark.parametrize('text, value', [
+    ('+5n', 5e-9),
+    ('-300p', -3e-10),
+    ('5m', 5e-3),
+    ('5mm', 5e-3),
+    ('.5u', 5e-7),
+    ('5.', 5.),
+    ('1e-9', 1e-9),
+    ('1E3', 1e3),
+    ('1 E', 1e18),
+    ('2.5 kHz', 2.5e3),
+    ('5nA', 5e-9),
+    ('3µV', 3e-6),
+    (' 10M ', 1e7),
+    ('1T', 1e12),
+])
+def test_parse_quantity(text, value):
+    assert parse_quantity(text) == pytest.approx(value)
+
+
+@pytest.mark.parametrize('text', ['1E', '1EV', '', 'n', '5 n n', '1e', '++5', '5x', '5nX', '1.2.3', 'e5'])
+def test_invalid_quantities(text):
+    with pytest.raises(QuantityError):
+        parse_quantity(text)
+
+
+def test_parse_quantities():
+    np.testing.assert_allclose(parse_quantities('100p, 200p;300p 4e-10'), [1e-10, 2e-10, 3e-10, 4e-10])
+    np.testing.assert_allclose(parse_quantities([['-1', 0.5], ['+5n', 2]]), [[-1., 0.5], [5e-9, 2.]])
+    with pytest.raises(QuantityError):
+        parse_quantities(['1', '1E'])
+
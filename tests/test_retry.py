@@ -0,0 +1,79 @@
+import pytest
+
+from core import NanonisController
+from interface import ConnectionLost
+from retry import RetryPolicy
+from simulator import NanonisSimulator
+
+
+@pytest.fixture
+def simulator():
+    with NanonisSimulator(port=0, seed=0) as sim:
+        yield sim
+
+
+def session(simulator, retry):
+    nanonis = NanonisController('127.0.0.1', simulator.port, signal_cache_dir=None)
+    nanonis.retry = retry
+    return nanonis
+
+
+def test_idempotent_command_is_sent_again(simulator):
+    nanonis = session(simulator, RetryPolicy(retries=3, backoff=0.01))
+    simulator.drop_connection('Current.Get')
+    nanonis.CurrentGet()
+    assert nanonis.retry.stats()['retried'] == {'Current.Get': 1}
+    nanonis.close()
+
+
+@pytest.mark.parametrize('retries', [None, 0])
+def test_no_retries(simulator, retries):
+    nanonis = session(simulator, RetryPolicy(retries=retries, backoff=0.01))
+    simulator.drop_connection('Current.Get')
+    with pytest.raises(ConnectionLost, match='retried 0 times'):
+        nanonis.CurrentGet()
+    # reconnected for the next command
+    nanonis.CurrentGet()
+    assert nanonis.retry.counts['reconnects'] == 1
+    nanonis.close()
+
+
+def test_command_which_is_not_idempotent_is_not_sent_again(simulator):
+    nanonis = session(simulator, RetryPolicy(retries=3, backoff=0.01))
+    simulator.drop_connection('Bias.Pulse', when='after')
+    with pytest.raises(ConnectionLost, match='not idempotent'):
+        nanonis.BiasPulse(1.)
+    assert simulator.command_counts['Bias.Pulse'] == 1
+    nanonis.close()
+
+
+def hang_up(name, body):
+    raise ConnectionError  # the fake server closes the connection
+
+
+def test_without_policy_the_error_is_raised_as_is(fake_nanonis):
+    server = fake_nanonis(hang_up)
+    nanonis = NanonisController('127.0.0.1', server.port, signal_cache_dir=None)
+    nanonis.retry = None
+    with pytest.raises(ConnectionLost) as error:
+        nanonis.CurrentGet()
+    assert 'reconnect' not in str(error.value) and 'not sent again' not in str(error.value)
+    # reopened by the next command only
+    assert len([event for event in server.events if event[0] == 'recv']) == 1
+    assert nanonis.connection.dead
+    nanonis.close()
+
+
+def test_failed_reconnect_is_chained_to_the_first_error(fake_nanonis):
+    server = fake_nanonis(hang_up)
+    nanonis = NanonisController('127.0.0.1', server.port, signal_cache_dir=None)
+    nanonis.retry = RetryPolicy(retries=3, reconnect_attempts=2, backoff=0.01)
+    server.close()  # the open connection stays, new ones are refused
+    with pytest.raises(ConnectionLost, match='Could not reconnect') as error:
+        nanonis.CurrentGet()
+    # the message tells why the last attempt failed, the cause is the error which broke the connection
+    assert isinstance(error.value.__cause__, (OSError, ConnectionLost))
+    assert not isinstance(error.value.__cause__, ConnectionRefusedError)
+    assert 'refused' in str(error.value)
+    assert nanonis.retry.counts['reconnect_failures'] == 1
+    nanonis.close()
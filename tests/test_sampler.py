@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from core import NanonisController
+from sampler import RingBuffer, SignalSampler
+from simulator import NanonisSimulator
+
+
+def filled(capacity, count):
+    buffer = RingBuffer(capacity, 2)
+    for i in range(count):
+        buffer.append(float(i), (i, -i))
+    return buffer
+
+
+@pytest.mark.parametrize('count', [0, 3, 5, 12, 15])
+def test_ring_buffer_keeps_the_last_samples_in_order(count):
+    buffer = filled(5, count)
+    times, values = buffer.last()
+    expected = np.arange(max(0, count - 5), count, dtype=float)
+    np.testing.assert_array_equal(times, expected)
+    np.testing.assert_array_equal(values, np.stack([expected, -expected], -1).reshape(-1, 2))
+    assert len(buffer) == min(count, 5)
+
+
+def test_ring_buffer_last_and_window_across_the_wrap():
+    buffer = filled(5, 12)
+    times, values = buffer.last(3)
+    np.testing.assert_array_equal(times, [9., 10., 11.])
+    np.testing.assert_array_equal(values[:, 1], [-9., -10., -11.])
+    assert len(buffer.last(50)[0]) == 5
+    times, _ = buffer.window(2.)
+    np.testing.assert_array_equal(times, [9., 10., 11.])
+
+
+def test_ring_buffer_since():
+    buffer = filled(5, 4)
+    times, _, total = buffer.since(2)
+    np.testing.assert_array_equal(times, [2., 3.])
+    for i in range(4, 11):
+        buffer.append(float(i), (i, -i))
+    # 7 new samples, the 2 oldest of them were overwritten
+    times, _, total = buffer.since(total)
+    np.testing.assert_array_equal(times, [6., 7., 8., 9., 10.])
+    assert total == 11
+    assert len(buffer.since(total)[0]) == 0
+
+
+def test_sampler_streams_into_the_ring_buffer():
+    with NanonisSimulator(port=0, seed=0) as simulator:
+        nanonis = NanonisController('127.0.0.1', simulator.port, signal_cache_dir=None)
+        sampler = SignalSampler(nanonis, [0, 1], rate=200., capacity=8)
+        with sampler:
+            seen = [t for (t, _), _ in zip(sampler.samples(timeout=2), range(20))]
+        assert sampler.error is None and not sampler.running
+        assert sampler.buffer.total >= 20 and len(sampler.buffer) == 8
+        times, values = sampler.last()
+        assert values.shape == (8, 2) and np.all(np.diff(times) > 0)
+        assert np.all(np.diff(seen) > 0)
+        assert sampler.stats(n=4)['count'] == 4
+        nanonis.close()
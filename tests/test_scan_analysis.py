@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from scan_analysis import FrameGeometry, found_low_area, gaussian_smooth, local_minima, plane_level
+
+
+def test_frame_geometry_is_clockwise():
+    # a 90 degree frame of Scan.FrameSet: its top edge points to +x, its right edge to -y
+    geometry = FrameGeometry(1., 2., 4., 2., 90., rows=2, cols=4)
+    assert geometry.pixel_to_piezo(0, 2) == pytest.approx((2., 2.))
+    assert geometry.pixel_to_piezo(1, 4) == pytest.approx((1., 0.))
+    assert geometry.piezo_to_pixel(2., 2.) == pytest.approx((0., 2.))
+    assert geometry.piezo_to_pixel(1., 0.) == pytest.approx((1., 4.))
+
+
+@pytest.mark.parametrize('angle', [0., 30., -75., 180.])
+def test_frame_geometry_round_trip(angle):
+    geometry = FrameGeometry(1e-7, -2e-7, 3e-7, 1e-7, angle, rows=64, cols=128)
+    rows, cols = np.meshgrid(np.arange(64.), np.arange(128.), indexing='ij')
+    back = geometry.piezo_to_pixel(*geometry.pixel_to_piezo(rows, cols))
+    np.testing.assert_allclose(back, (rows, cols), atol=1e-9)
+
+
+def test_plane_level_removes_the_tilt():
+    rows, cols = np.meshgrid(np.arange(20.), np.arange(30.), indexing='ij')
+    bump = np.zeros((20, 30))
+    bump[5, 7] = -1.
+    frame = 3. + 0.2 * rows - 0.1 * cols + bump
+    frame[15:] = np.nan  # lines not scanned yet
+    levelled = plane_level(frame)
+    assert np.isnan(levelled[15:]).all()
+    assert np.nanargmin(levelled) == 5 * 30 + 7
+    assert np.ptp(np.delete(levelled[:15].ravel(), 5 * 30 + 7)) < 0.01
+
+
+def test_plane_level_of_a_stack():
+    rows, cols = np.meshgrid(np.arange(8.), np.arange(8.), indexing='ij')
+    stack = np.stack([rows, cols, rows + cols])
+    np.testing.assert_allclose(plane_level(stack), 0., atol=1e-12)
+
+
+def test_gaussian_smooth():
+    frame = np.zeros((21, 21))
+    frame[10, 10] = 1.
+    smoothed = gaussian_smooth(frame, sigma=2.)
+    assert smoothed.sum() == pytest.approx(1., rel=1e-3)
+    assert smoothed[10, 10] == smoothed.max()
+    np.testing.assert_allclose(smoothed, smoothed.T)
+    # constant frames stay constant up to the edges, NaN pixels do not contribute
+    flat = np.full((10, 10), 5.)
+    flat[3, 4] = np.nan
+    np.testing.assert_allclose(gaussian_smooth(flat, sigma=1.5), 5.)
+
+
+def test_local_minima_lowest_first():
+    frame = np.ones((20, 20))
+    frame[3, 4] = -1.
+    frame[15, 12] = -2.
+    frame[1, 18] = -3.
+    np.testing.assert_array_equal(local_minima(frame, k=3), [[1, 18], [15, 12], [3, 4]])
+    np.testing.assert_array_equal(local_minima(frame, k=2, border=3), [[15, 12], [3, 4]])
+
+
+def test_local_minima_of_a_plateau():
+    frame = np.ones((20, 20))
+    frame[8:12, 5:15] = 0.
+    # the plateau and the flat background around it count once each
+    np.testing.assert_array_equal(local_minima(frame, k=10), [[8, 5], [0, 0]])
+    assert len(local_minima(np.zeros((30, 30)), k=100)) == 1
+
+
+def test_found_low_area():
+    frame = np.zeros((40, 40))
+    frame[10:13, 20:23] = -1e-9
+    partial = frame.copy()
+    partial[14:] = np.nan
+    # too close to the lines not scanned yet
+    assert not found_low_area(partial, 5e-10)
+    assert found_low_area(frame, 5e-10)
+    assert not found_low_area(frame, 5e-9)
+    # not enough lines
+    partial[5:] = np.nan
+    assert not found_low_area(partial, 5e-10)
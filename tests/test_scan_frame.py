@@ -0,0 +1,54 @@
+import struct
+
+import numpy as np
+import pytest
+
+from core import NanonisController, decode_frame_data, stack_frames
+
+
+def frame_body(frame, channel_name='Z (m)', scan_direction=1):
+    name = channel_name.encode('latin1')
+    rows, cols = frame.shape
+    return struct.pack('>i', len(name)) + name + struct.pack('>ii', rows, cols) + \
+        frame.astype('>f4').tobytes() + struct.pack('>I', scan_direction)
+
+
+FRAME = np.arange(12, dtype=np.float32).reshape(3, 4) * 1e-10
+
+
+def test_default_is_a_writable_native_copy():
+    body = frame_body(FRAME)
+    result = decode_frame_data(body)
+    data = result['data']
+    assert data.dtype == np.float64 and data.dtype.isnative
+    assert data.flags.writeable
+    np.testing.assert_array_equal(data, FRAME)
+    data[0, 0] = 1.
+    assert decode_frame_data(body)['data'][0, 0] == 0.
+    assert (result['row'], result['col'], result['scan_direction'], result['channel_name']) == (3, 4, 1, 'Z (m)')
+
+
+def test_view_is_zero_copy():
+    body = bytearray(frame_body(FRAME))
+    data = decode_frame_data(body, view=True)['data']
+    assert data.dtype == np.dtype('>f4')
+    np.testing.assert_array_equal(data, FRAME)
+    # a view on the response, not a copy of it
+    assert np.shares_memory(data, np.frombuffer(body, dtype=np.uint8))
+
+
+def test_stack_frames_is_native_float32():
+    bodies = [frame_body(FRAME * (i + 1)) for i in range(4)]
+    stacked = stack_frames(bodies, [0, 1], [1, 0])
+    assert stacked['data'].dtype == np.float32 and stacked['data'].shape == (2, 2, 3, 4)
+    np.testing.assert_array_equal(stacked['data'][1, 0], FRAME * 3)
+
+
+@pytest.mark.parametrize('view', [False, True])
+def test_scan_frame_data(fake_nanonis, view):
+    server = fake_nanonis(lambda name, body: frame_body(FRAME) + struct.pack('>Ii', 0, 0))
+    nanonis = NanonisController('127.0.0.1', server.port, signal_cache_dir=None)
+    data = nanonis.ScanFrameData(0, view=view)['data']
+    np.testing.assert_array_equal(data, FRAME)
+    assert data.flags.writeable != view
+    nanonis.close()
@@ -0,0 +1,48 @@
+import threading
+import time
+
+import pytest
+
+from core import Resource
+from interface import nanonisException
+from scheduler import OperationScheduler
+
+
+def tracked(spans, name, seconds=0.1):
+    def task():
+        start = time.monotonic()
+        time.sleep(seconds)
+        spans[name] = (start, time.monotonic())
+        return name
+    return task
+
+
+def overlap(a, b):
+    return a[0] < b[1] and b[0] < a[1]
+
+
+def test_independent_resources_overlap_and_shared_ones_do_not():
+    spans = {}
+    scheduler = OperationScheduler()
+    scheduler.add('pll', tracked(spans, 'pll'), resources={Resource.PLL})
+    scheduler.add('settle', tracked(spans, 'settle'), resources={Resource.XY_PIEZO, Resource.Z_CONTROLLER})
+    scheduler.add('pulse', tracked(spans, 'pulse'), resources={Resource.BIAS, Resource.Z_CONTROLLER})
+    results = scheduler.run()
+    assert results == {'pll': 'pll', 'settle': 'settle', 'pulse': 'pulse'}
+    assert overlap(spans['pll'], spans['settle'])
+    assert not overlap(spans['settle'], spans['pulse'])
+
+
+def test_failure_skips_dependents():
+    ran = threading.Event()
+
+    def fail():
+        raise nanonisException('broken')
+
+    scheduler = OperationScheduler()
+    scheduler.add('check', fail, resources=())
+    scheduler.add('after', ran.set, after=['check'], resources=())
+    with pytest.raises(nanonisException, match='broken'):
+        scheduler.run()
+    assert not ran.is_set()
+    assert scheduler.nodes['after'].state == 'skipped'
@@ -0,0 +1,26 @@
+import json
+import time
+
+from signal_registry import SignalRegistry
+
+
+def test_disk_cache_is_keyed_by_host_and_port(tmp_path):
+    simulator = SignalRegistry(lambda: ['Z (m)', 'Current (A)'], '127.0.0.1', cache_dir=str(tmp_path), port=40000)
+    simulator.ensure()
+    nanonis = SignalRegistry(lambda: ['Current (A)', 'Bias (V)', 'Z (m)'], '127.0.0.1',
+                             cache_dir=str(tmp_path), port=6501)
+    assert nanonis.index('Z (m)') == 2
+    assert nanonis.fetches == 1
+    # a later session on the same port reads the cache instead of fetching
+    again = SignalRegistry(None, '127.0.0.1', cache_dir=str(tmp_path), port=40000)
+    assert again.index('Current (A)') == 1
+
+
+def test_disk_cache_expires(tmp_path):
+    stale = SignalRegistry(lambda: ['Z (m)'], '127.0.0.1', cache_dir=str(tmp_path))
+    stale.update(['Z (m)'], loaded_at=time.time() - 2 * 24 * 3600)
+    with open(stale.cache_path) as f:
+        assert json.load(f)['port'] == 6501
+    fresh = SignalRegistry(lambda: ['Bias (V)', 'Z (m)'], '127.0.0.1', cache_dir=str(tmp_path))
+    assert fresh.index('Z (m)') == 1
+    assert fresh.fetches == 1
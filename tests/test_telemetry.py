@@ -0,0 +1,84 @@
+import os
+import struct
+
+import numpy as np
+import pytest
+
+from core import NanonisController, Operate
+from io_worker import IOWorker
+from telemetry import TelemetryReader, TelemetryRecorder
+
+OK = struct.pack('>Ii', 0, 0)
+
+
+def record(recorder, offset=0):
+    recorder.command('Bias.Get', 1. + offset, 0.001, 40, 52, 0.5)
+    recorder.command('ZCtrl.GainGet', 2. + offset, 0.002, 40, 60, (1e-12, 2e-9, 3e-4))
+    recorder.command('Scan.FrameDataGrab', 3. + offset, 0.010, 48, 1064, {'body_size': 1024})
+    recorder.command('Bias.Pulse', 4. + offset, 0.003, 58, 48, None, error='Pulse failed')
+    recorder.operation('MultiPulse', 5. + offset, 1.5, 7.)
+
+
+@pytest.mark.parametrize('worker', [False, True])
+def test_npz_round_trip(tmp_path, worker):
+    io = IOWorker().start() if worker else None
+    with TelemetryRecorder(str(tmp_path), chunk_size=3, worker=io) as recorder:
+        record(recorder)
+        record(recorder, offset=10.)
+    if io is not None:
+        io.close()
+    # 8 commands in chunks of 3
+    assert sorted(os.listdir(tmp_path))[:3] == ['commands-000001.npz', 'commands-000002.npz', 'commands-000003.npz']
+    reader = TelemetryReader(str(tmp_path))
+    commands = reader.commands()
+    assert list(commands['command'][:4]) == ['Bias.Get', 'ZCtrl.GainGet', 'Scan.FrameDataGrab', 'Bias.Pulse']
+    np.testing.assert_array_equal(commands['start'], [1., 2., 3., 4., 11., 12., 13., 14.])
+    np.testing.assert_array_equal(commands['sent'][:4], [40, 40, 48, 58])
+    assert commands['value'][0] == 0.5 and np.isnan(commands['value'][1:4]).all()
+    assert list(commands['result'][1:4]) == ['(1e-12, 2e-09, 0.0003)', '<1024 bytes>', '']
+    assert list(reader.commands(errors=True)['error']) == ['Pulse failed'] * 2
+    assert len(reader.commands('Bias.')['command']) == 4
+    assert len(reader.commands(since=10., until=12.5)['command']) == 2
+    operations = reader.operations('MultiPulse')
+    np.testing.assert_array_equal(operations['duration'], [1.5, 1.5])
+    np.testing.assert_array_equal(operations['value'], [7., 7.])
+    summary = reader.summary()
+    assert summary['Bias.Pulse'] == {'count': 2, 'errors': 2, 'total': pytest.approx(0.006),
+                                     'mean': pytest.approx(0.003), 'sent': 116, 'received': 96}
+
+
+def test_reopened_directory_continues_the_chunks(tmp_path):
+    with TelemetryRecorder(str(tmp_path)) as recorder:
+        record(recorder)
+    # left by a writer killed halfway
+    (tmp_path / 'commands-000002.tmp.npz').write_bytes(b'partial')
+    with TelemetryRecorder(str(tmp_path)) as recorder:
+        record(recorder, offset=10.)
+    assert (tmp_path / 'commands-000002.npz').exists()
+    assert len(TelemetryReader(str(tmp_path)).commands()['command']) == 8
+
+
+def test_empty_directory(tmp_path):
+    reader = TelemetryReader(str(tmp_path))
+    assert len(reader.commands()['command']) == 0
+    assert reader.summary() == {}
+
+
+class Probe(Operate):
+
+    def safety_check(self):
+        return True
+
+    def _operate(self):
+        return self.session.BiasGet()
+
+
+def test_session_records_commands_and_operations(fake_nanonis, tmp_path):
+    server = fake_nanonis(lambda name, body: struct.pack('>f', 0.25) + OK)
+    nanonis = NanonisController('127.0.0.1', server.port, signal_cache_dir=None, telemetry_dir=str(tmp_path))
+    assert Probe(nanonis).do() == 0.25
+    nanonis.close()
+    reader = TelemetryReader(str(tmp_path))
+    commands = reader.commands('Bias.Get')
+    assert list(commands['value']) == [0.25] and commands['received'][0] == 52
+    assert list(reader.operations()['operation']) == ['Probe']
@@ -0,0 +1,96 @@
+import time
+from collections import namedtuple
+
+import tasks.TipRepairOn2DIce as task
+
+Range = namedtuple('Range', 'x y')
+
+
+class Waiter:
+
+    def __init__(self, events):
+        self.events = events
+
+    def sleep(self, seconds, name):
+        self.events.append(name)
+
+    def stable(self, read, name, *args, **kwargs):
+        self.events.append(name)
+        return read()
+
+
+class Session:
+
+    def __init__(self, freq_shift=-3.):
+        self.events = []
+        self.waiter = Waiter(self.events)
+        self.freq_shift = freq_shift
+
+    def try_convert(self, value):
+        return {'200n': 200e-9, '100n': 100e-9, '15n': 15e-9}.get(value, value)
+
+    def PiezoRangeGet(self):
+        return Range(1e-6, 1e-6)
+
+    def TipXYSet(self, x, y):
+        self.events.append('TipXYSet')
+
+    def ZCtrlOnOffSet(self, on):
+        self.events.append('ZCtrlOnOffSet')
+
+    def WaitForZCtrlWork(self):
+        self.events.append('WaitForZCtrlWork')
+
+    def WaitForZSettle(self, max_time):
+        # slower than the PLL lock, a read not waiting for it comes first
+        time.sleep(0.2)
+        self.events.append('WaitForZSettle')
+
+    def PLLOutputSet(self, on):
+        self.events.append('PLLOutputSet({})'.format(on))
+
+    def PLLAmpCtrlSet(self, on):
+        pass
+
+    def PLLPhasCtrlSet(self, on):
+        pass
+
+    def PLLFreqShiftGet(self):
+        self.events.append('PLLFreqShiftGet')
+        return self.freq_shift
+
+
+class Finder:
+
+    def __init__(self, session, *args, **kwargs):
+        pass
+
+    def do(self):
+        return 10e-9, 20e-9
+
+
+class Shaper:
+
+    runs = 0
+
+    def __init__(self, session, *args, **kwargs):
+        pass
+
+    def do(self):
+        Shaper.runs += 1
+
+
+def test_frequency_shift_is_read_after_settle(monkeypatch):
+    monkeypatch.setattr(task, 'LowerAreaFinder', Finder)
+    monkeypatch.setattr(task, 'TipShaper', Shaper)
+    session = Session()
+    repairer = task.SingleAreaTipRepairer(session)
+    repairer._task()
+    events = session.events
+    read = len(events) - 1 - events[::-1].index('PLLFreqShiftGet')
+    # the lock overlaps the settle, the read comes after both
+    assert events.index('PLLOutputSet(True)') < events.index('WaitForZSettle')
+    assert events.index('WaitForZSettle') < events.index('PLL hold') < read
+    assert events.index('PLLOutputSet(False)') > read
+    assert repairer.freq == -3.
+    assert Shaper.runs == 1
@@ -0,0 +1,124 @@
+import pytest
+
+import tasks.TipRepair
+import tasks.TipRepairOn2DIce
+from checkpoint import CheckpointStore
+from core import ExceptionType
+from deadline import Deadline
+from interface import Cancelled, current_deadline, nanonisException
+from waiter import Waiter
+
+
+class Session:
+
+    def __init__(self):
+        self.waiter = Waiter()
+        self.calls = []
+
+    def Home(self):
+        # a command checks the deadline before it is sent
+        deadline = current_deadline()
+        if deadline is not None:
+            deadline.check('ZCtrl.Home')
+        self.calls.append('Home')
+
+    def Withdraw(self):
+        self.calls.append('Withdraw')
+
+
+def fake_area(finished_at=None):
+    areas = []
+
+    class Area:
+
+        def __init__(self, session, *args, area=0, **kwargs):
+            self.area = area
+
+        def do(self, timeout=None):
+            areas.append(self.area)
+            if self.area == finished_at:
+                raise nanonisException('Process finished', ExceptionType.PROCESS_FINISHED)
+            return 7
+
+    return Area, areas
+
+
+class ChangeArea:
+
+    def __init__(self, session, *args, **kwargs):
+        pass
+
+    def do(self):
+        pass
+
+
+TASKS = [(tasks.TipRepair, tasks.TipRepair.TipRepair), (tasks.TipRepairOn2DIce, tasks.TipRepairOn2DIce.TipRepair)]
+
+
+@pytest.mark.parametrize('module, task', TASKS)
+@pytest.mark.parametrize('finished_at', [None, 1])
+def test_finished_run_is_not_resumed(tmp_path, monkeypatch, module, task, finished_at):
+    # None: all area_counts areas are done, 1: PROCESS_FINISHED is raised in the second area
+    area, areas = fake_area(finished_at)
+    monkeypatch.setattr(module, 'SingleAreaTipRepairer', area)
+    monkeypatch.setattr(module, 'ChangeArea', ChangeArea)
+    with CheckpointStore(str(tmp_path / 'runs.sqlite')) as store:
+        checkpoint = store.start('TipRepair', {'direction': 'Y-'})
+        task(Session(), area_counts=3, checkpoint=checkpoint)._operate()
+        assert areas == ([0, 1, 2] if finished_at is None else [0, 1])
+        assert store.resume('TipRepair') is None
+
+
+@pytest.mark.parametrize('module, task', TASKS)
+def test_interrupted_run_is_resumed(tmp_path, monkeypatch, module, task):
+    area, areas = fake_area()
+    monkeypatch.setattr(module, 'SingleAreaTipRepairer', area)
+    monkeypatch.setattr(module, 'ChangeArea', ChangeArea)
+    with CheckpointStore(str(tmp_path / 'runs.sqlite')) as store:
+        checkpoint = store.start('TipRepair')
+        checkpoint.update(area=2, moving=False)
+        task(Session(), area_counts=4, checkpoint=store.resume('TipRepair'))._operate()
+        assert areas == [2, 3]
+        assert store.resume('TipRepair') is None
+
+
+@pytest.mark.parametrize('module, task', TASKS)
+def test_tip_is_homed_when_the_run_is_out_of_time(monkeypatch, module, task):
+
+    class Area:
+
+        def __init__(self, session, *args, **kwargs):
+            pass
+
+        def do(self, timeout=None):
+            raise Cancelled('run: deadline passed')
+
+    monkeypatch.setattr(module, 'SingleAreaTipRepairer', Area)
+    session = Session()
+    with Deadline(0, name='run').active():
+        with pytest.raises(Cancelled, match='run: deadline passed'):
+            task(session, area_counts=3)._operate()
+    assert session.calls == ['Home']
+
+
+def test_resume_restores_the_run_params(tmp_path):
+    with CheckpointStore(str(tmp_path / 'runs.sqlite')) as store:
+        checkpoint, params = store.open('TipRepair', {'direction': 'X+', 'area_counts': 5})
+        assert params == {'direction': 'X+', 'area_counts': 5}
+        resumed, params = store.open('TipRepair', {'direction': 'Y-', 'area_counts': 100, 'init_pulse_bias': 7},
+                                     resume=True)
+        assert resumed.run == checkpoint.run
+        assert params == {'direction': 'X+', 'area_counts': 5, 'init_pulse_bias': 7}
+
+
+def test_new_runs_supersede_and_replace_old_ones(tmp_path):
+    with CheckpointStore(str(tmp_path / 'runs.sqlite'), keep=2) as store:
+        first = store.start('TipRepair')
+        first.visit(0, (1, 1))
+        second = store.start('TipRepair')
+        # only the newest unfinished run can be resumed
+        assert store.resume('TipRepair').run == second.run
+        assert [run[4] for run in store.runs('TipRepair')] == [0, 2]
+        third = store.start('TipRepair')
+        assert [run[0] for run in store.runs('TipRepair')] == [third.run, second.run]
+        assert first.visited(0) == set()
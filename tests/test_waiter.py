@@ -0,0 +1,39 @@
+import time
+
+from waiter import Waiter
+
+
+class Signal:
+
+    def __init__(self, drift, noise=0.):
+        self.start = time.monotonic()
+        self.drift = drift
+        self.noise = noise
+        self.reads = 0
+
+    def __call__(self):
+        self.reads += 1
+        return self.drift * (time.monotonic() - self.start) + self.noise * (self.reads % 2)
+
+
+def test_stable_waits_for_the_whole_window():
+    waiter = Waiter()
+    start = time.monotonic()
+    assert waiter.stable(Signal(0.), 'flat', tolerance=0.1, window=0.3, interval=0.02, timeout=2) == 0.
+    assert 0.3 <= time.monotonic() - start < 1.
+    assert waiter.stats['flat'].timeouts == 0
+
+
+def test_stable_sees_a_slow_drift():
+    # 0.05 per interval stays within tolerance, 0.5 per window does not
+    waiter = Waiter()
+    start = time.monotonic()
+    waiter.stable(Signal(2.5), 'drift', tolerance=0.2, window=0.2, interval=0.02, timeout=0.5)
+    assert time.monotonic() - start >= 0.5
+    assert waiter.stats['drift'].timeouts == 1
+
+
+def test_stable_tolerates_noise_within_tolerance():
+    waiter = Waiter()
+    assert waiter.stable(Signal(0., noise=0.05), 'noise', tolerance=0.1, window=0.1, interval=0.02, timeout=1) in (0., 0.05)
+    assert waiter.stats['noise'].timeouts == 0
@@ -1,5 +1,6 @@
 import sys
 import logging
+from checkpoint import CheckpointStore
 from core import NanonisController
 from tasks.TipRepairOn2DIce import TipRepair
 
@@ -10,11 +11,23 @@ if __name__ == '__main__':
 
     area_count = 100
 
-    if len(sys.argv) > 1:
-        direction = sys.argv[1].upper()
+    # --resume continues the last unfinished run recorded in the checkpoint file
+    resume = '--resume' in sys.argv
+    # --profile logs where the time went and exports the profile at the end
+    profile = '--profile' in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg not in ('--resume', '--profile')]
+
+    if len(args) > 0:
+        direction = args[0].upper()
         if direction not in direction_list:
             logging.warn('Invalid direction. Using Y-')
             direction = 'Y-'
 
-    nanonis = NanonisController()
-    TipRepair(nanonis, direction=direction, area_counts=area_count).do()
\ No newline at end of file
+    # a resumed run goes on with the parameters it was started with
+    store = CheckpointStore('tip_2d_ice_repairer.sqlite')
+    checkpoint, params = store.open('TipRepair', {'direction': direction, 'area_counts': area_count}, resume)
+
+    # the frames of the lower area scans are kept for later analysis (see frame_archive.FrameArchive)
+    nanonis = NanonisController(profile=profile, archive_dir='tip_2d_ice_repairer-frames')
+    TipRepair(nanonis, checkpoint=checkpoint, report_path='tip_2d_ice_repairer-profile.json' if profile else None,
+              **params).do()
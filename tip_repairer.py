@@ -1,6 +1,7 @@
 
 import sys
 import logging
+from checkpoint import CheckpointStore
 from core import NanonisController
 from tasks.TipRepair import TipRepair
 
@@ -12,11 +13,23 @@ if __name__ == '__main__':
     # max area count of the direction
     area_count = 100
 
-    if len(sys.argv) > 1:
-        direction = sys.argv[1].upper()
+    # --resume continues the last unfinished run recorded in the checkpoint file
+    resume = '--resume' in sys.argv
+    # --profile logs where the time went and exports the profile at the end
+    profile = '--profile' in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg not in ('--resume', '--profile')]
+
+    if len(args) > 0:
+        direction = args[0].upper()
         if direction not in direction_list:
             logging.warn('Invalid direction. Using Y-')
             direction = 'Y-'
 
-    nanonis = NanonisController()
-    TipRepair(nanonis, direction=direction, init_pulse_bias=7, area_counts=area_count).do()
+    # a resumed run goes on with the parameters it was started with
+    store = CheckpointStore('tip_repairer.sqlite')
+    checkpoint, params = store.open('TipRepair', {'direction': direction, 'init_pulse_bias': 7, 'area_counts': area_count},
+                                    resume)
+
+    nanonis = NanonisController(profile=profile)
+    TipRepair(nanonis, checkpoint=checkpoint, report_path='tip_repairer-profile.json' if profile else None,
+              **params).do()
@@ -0,0 +1,201 @@
+# waiter.py
+r'''
+Wait engine for the Operate subclasses.
+
+Instead of polling at a fixed period and sleeping for fixed settle times,
+waits poll with an adaptive backoff (fast at first, then slower) and settle
+times end as soon as a signal is stable. Every wait is recorded by name, so
+the report shows where the wall-clock time of a run goes. The waits of an
+operation run with a deadline (see deadline.py) end with Cancelled as soon
+as it passes or is cancelled.
+
+    waiter = Waiter()
+    waiter.until(lambda: not nanonis.AutoApproachGet(), 'auto approach', timeout=600)
+    waiter.stable(nanonis.TipZGet, 'Z settle', tolerance=20e-12, timeout=4)
+    print(waiter.report())
+'''
+
+import asyncio
+import threading
+import time
+from collections import deque
+
+from interface import current_deadline, nanonisException
+
+
+class WaitTimeout(nanonisException):
+    pass
+
+
+class WaitRecord:
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self.polls = 0
+        self.timeouts = 0
+
+    def add(self, elapsed, polls, timed_out):
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        self.polls += polls
+        self.timeouts += int(timed_out)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.
+
+
+class Waiter:
+
+    r'''
+    Args:
+        initial_interval : float
+            First poll interval (s).
+        max_interval : float
+            Longest poll interval (s).
+        factor : float
+            Growth of the poll interval after every unsuccessful poll.
+    '''
+
+    def __init__(self, initial_interval=0.05, max_interval=1., factor=1.5):
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.stats = {}
+        self.profiler = None  # profiler.Profiler receiving every wait
+        self._lock = threading.Lock()
+
+    def _record(self, name, elapsed, polls=0, timed_out=False):
+        with self._lock:
+            record = self.stats.get(name)
+            if record is None:
+                record = self.stats[name] = WaitRecord()
+            record.add(elapsed, polls, timed_out)
+        if self.profiler is not None:
+            self.profiler.wait(name, elapsed)
+
+    @staticmethod
+    def _sleep(seconds, name):
+        deadline = current_deadline()
+        if deadline is None:
+            time.sleep(seconds)
+        else:
+            deadline.sleep(seconds, name)
+
+    def _intervals(self, initial, max_interval):
+        interval = self.initial_interval if initial is None else initial
+        max_interval = self.max_interval if max_interval is None else max_interval
+        while True:
+            yield interval
+            interval = min(interval * self.factor, max_interval)
+
+    def until(self, predicate, name, timeout=None, initial=None, max_interval=None):
+        r'''
+        Poll predicate with backoff until it returns True.
+
+        Raises WaitTimeout when timeout (s) passes first, timeout=None waits forever.
+        '''
+        start = time.monotonic()
+        polls = 0
+        for interval in self._intervals(initial, max_interval):
+            polls += 1
+            if predicate():
+                self._record(name, time.monotonic() - start, polls)
+                return True
+            elapsed = time.monotonic() - start
+            if timeout is not None and elapsed + interval > timeout:
+                if elapsed < timeout:
+                    self._sleep(timeout - elapsed, name)
+                    polls += 1
+                    if predicate():
+                        self._record(name, time.monotonic() - start, polls)
+                        return True
+                self._record(name, time.monotonic() - start, polls, True)
+                raise WaitTimeout('Timeout after {:.1f} s waiting for {}'.format(timeout, name))
+            self._sleep(interval, name)
+
+    def stable(self, read, name, tolerance, window=0.5, interval=0.1, timeout=None):
+        r'''
+        Read a signal every interval (s) until the readings of the last window seconds lie within
+        tolerance, i.e. the signal has converged: a window of several intervals also sees a slow
+        drift. Replaces a fixed settle sleep of up to timeout seconds: on timeout it returns like
+        the sleep would have, without raising.
+
+        Returns the last reading.
+        '''
+        start = time.monotonic()
+        readings = deque()
+        polls = 0
+        while True:
+            value = read()
+            polls += 1
+            elapsed = time.monotonic() - start
+            if self._converged(readings, elapsed, value, tolerance, window):
+                self._record(name, elapsed, polls)
+                return value
+            if timeout is not None and elapsed >= timeout:
+                self._record(name, elapsed, polls, True)
+                return value
+            self._sleep(interval if timeout is None else max(0., min(interval, timeout - elapsed)), name)
+
+    @staticmethod
+    def _converged(readings, elapsed, value, tolerance, window):
+        # readings holds (elapsed, value) of the last window seconds, and the reading just before them
+        readings.append((elapsed, value))
+        while len(readings) > 1 and readings[1][0] <= elapsed - window:
+            readings.popleft()
+        values = [reading for _, reading in readings]
+        return readings[0][0] <= elapsed - window and max(values) - min(values) <= tolerance
+
+    async def until_async(self, predicate, name, timeout=None, initial=None, max_interval=None):
+        r'''Coroutine version of until, predicate is a coroutine function.'''
+        start = time.monotonic()
+        polls = 0
+        for interval in self._intervals(initial, max_interval):
+            polls += 1
+            if await predicate():
+                self._record(name, time.monotonic() - start, polls)
+                return True
+            elapsed = time.monotonic() - start
+            if timeout is not None and elapsed + interval > timeout:
+                self._record(name, elapsed, polls, True)
+                raise WaitTimeout('Timeout after {:.1f} s waiting for {}'.format(timeout, name))
+            await asyncio.sleep(interval)
+
+    async def stable_async(self, read, name, tolerance, window=0.5, interval=0.1, timeout=None):
+        r'''Coroutine version of stable, read is a coroutine function.'''
+        start = time.monotonic()
+        readings = deque()
+        polls = 0
+        while True:
+            value = await read()
+            polls += 1
+            elapsed = time.monotonic() - start
+            if self._converged(readings, elapsed, value, tolerance, window):
+                self._record(name, elapsed, polls)
+                return value
+            if timeout is not None and elapsed >= timeout:
+                self._record(name, elapsed, polls, True)
+                return value
+            await asyncio.sleep(interval if timeout is None else max(0., min(interval, timeout - elapsed)))
+
+    def sleep(self, seconds, name):
+        r'''A fixed sleep, recorded like the other waits.'''
+        start = time.monotonic()
+        self._sleep(seconds, name)
+        self._record(name, time.monotonic() - start)
+
+    def total(self):
+        return sum(record.total for record in self.stats.values())
+
+    def report(self):
+        r'''Table of the waits sorted by total time.'''
+        lines = ['{:<28}{:>7}{:>11}{:>10}{:>10}{:>8}{:>10}'.format(
+            'wait', 'count', 'total (s)', 'mean (s)', 'max (s)', 'polls', 'timeouts')]
+        for name, record in sorted(self.stats.items(), key=lambda item: -item[1].total):
+            lines.append('{:<28}{:>7}{:>11.2f}{:>10.3f}{:>10.3f}{:>8}{:>10}'.format(
+                name, record.count, record.total, record.mean, record.max, record.polls, record.timeouts))
+        return '\n'.join(lines)